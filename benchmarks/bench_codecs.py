@@ -0,0 +1,87 @@
+"""
+Compare the store codecs on realistic Migration documents
+
+    python -m benchmarks.bench_codecs --docs 2000 --mount-points 24
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from src import Credentials, MountPoint, Workload, MigrationTarget, CloudType, Migration
+from src.utils import CODECS, read_json, write_json
+
+
+def make_migration(mount_points: int) -> Migration:
+    storage = [MountPoint(f"/mnt/volume-{i:03d}", (i + 1) * 1024 ** 3) for i in range(mount_points)]
+    source = Workload(ip="10.20.30.40", credentials=Credentials("administrator", "S3cret!pass", "corp.example.com"),
+                      storage=storage)
+    target = MigrationTarget(
+        cloud_type=CloudType.VSPHERE,
+        cloud_credentials=Credentials("svc-migration", "An0ther!secret", "vsphere.example.com"),
+        target_vm=Workload(ip="10.20.30.41", credentials=Credentials("root", "r00t", "local"), storage=storage[:4]),
+    )
+    return Migration(selected_mount_points=storage[::2], source=source, migration_target=target)
+
+
+def stdlib_write(path: Path, obj: dict) -> None:
+    # The original utils.write_json / read_json, as a baseline
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def stdlib_read(path: Path) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def bench(docs: int, mount_points: int) -> dict:
+    doc = make_migration(mount_points).to_dict()
+    results = {}
+    cases = {"stdlib-json (baseline)": (stdlib_write, stdlib_read)}
+    for name, codec in CODECS.items():
+        cases[name] = (lambda path, obj, codec=codec: write_json(path, obj, codec), read_json)
+
+    with tempfile.TemporaryDirectory() as d:
+        for name, (write, read) in cases.items():
+            directory = Path(d) / name.split()[0]
+            directory.mkdir()
+            paths = [directory / f"{i}.json" for i in range(docs)]
+
+            start = time.perf_counter()
+            for path in paths:
+                write(path, doc)
+            write_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for path in paths:
+                read(path)
+            read_s = time.perf_counter() - start
+
+            results[name] = {
+                "bytes_per_doc": paths[0].stat().st_size,
+                "write_us_per_doc": round(write_s / docs * 1e6, 1),
+                "read_us_per_doc": round(read_s / docs * 1e6, 1),
+            }
+
+    return {"docs": docs, "mount_points": mount_points, "codecs": results}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--mount-points", type=int, default=24)
+    args = parser.parse_args(argv)
+
+    print(json.dumps(bench(args.docs, args.mount_points), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
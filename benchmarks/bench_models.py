@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of the model serializers against the original dataclasses.asdict based ones
+
+    python -m benchmarks.bench_models --mount-points 48 --loops 2000
+"""
+
+import argparse
+import json
+import sys
+import time
+from dataclasses import asdict
+
+from src import Credentials, MountPoint, Workload
+
+
+def legacy_to_dict(workload: Workload) -> dict:
+    return {
+        "ip": workload.ip,
+        "credentials": asdict(workload.credentials),
+        "storage": [asdict(mp) for mp in workload.storage],
+        "id": workload.id,
+        "version": workload.version
+    }
+
+
+def legacy_from_dict(data: dict) -> Workload:
+    credentials_data = Credentials(**data["credentials"])
+    storage_data = [MountPoint(**mp) for mp in data["storage"]]
+    if "id" in data and data["id"] is not None:
+        return Workload(ip=data["ip"], credentials=credentials_data, storage=storage_data, id=data["id"])
+    else:
+        return Workload(ip=data["ip"], credentials=credentials_data, storage=storage_data)
+
+
+def timed(func, arg, loops: int) -> float:
+    start = time.perf_counter()
+    for _ in range(loops):
+        func(arg)
+    return round((time.perf_counter() - start) / loops * 1e6, 2)
+
+
+def bench(mount_points: int, loops: int) -> dict:
+    workload = Workload(ip="10.0.0.1", credentials=Credentials("user", "password", "domain"),
+                        storage=[MountPoint(f"/mnt/volume-{i}", i * 1024) for i in range(mount_points)])
+    data = workload.to_dict()
+    assert legacy_to_dict(workload) == data
+
+    results = {
+        "to_dict_us": {"legacy": timed(legacy_to_dict, workload, loops),
+                       "fast": timed(Workload.to_dict, workload, loops)},
+        "from_dict_us": {"legacy": timed(legacy_from_dict, data, loops),
+                         "validated": timed(Workload.from_dict, data, loops),
+                         "trusted": timed(lambda d: Workload.from_dict(d, trusted=True), data, loops)},
+    }
+    results["to_dict_speedup"] = round(results["to_dict_us"]["legacy"] / results["to_dict_us"]["fast"], 1)
+    results["from_dict_speedup"] = {
+        "validated": round(results["from_dict_us"]["legacy"] / results["from_dict_us"]["validated"], 1),
+        "trusted": round(results["from_dict_us"]["legacy"] / results["from_dict_us"]["trusted"], 1),
+    }
+
+    return {"mount_points": mount_points, "loops": loops, **results}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mount-points", type=int, default=48)
+    parser.add_argument("--loops", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    print(json.dumps(bench(args.mount_points, args.loops), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Compare the CPU time of GET and list responses built from entities with the raw document passthrough
+
+    python -m benchmarks.bench_passthrough --docs 2000 --ops 5000 --page-size 100
+
+The entity path is what the routes did before: load the entity, to_dict(), then the FastAPI
+serialization (jsonable_encoder + JSONResponse). The raw path sends the stored bytes
+(Repository.get_raw() / list_raw_page()), the redacted variant decodes and re-encodes the document.
+"""
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from src import MigrationRepository
+from benchmarks.bench_codecs import make_migration
+
+
+def _cpu_us(ops: int, fn) -> float:
+    start = time.process_time()
+    for _ in range(ops):
+        fn()
+    return round((time.process_time() - start) / ops * 1e6, 1)
+
+
+def bench(docs: int, ops: int, page_size: int, mount_points: int, cache_size: int) -> dict:
+    with tempfile.TemporaryDirectory() as d:
+        repository = MigrationRepository(Path(d), cache_size=cache_size)
+        repository.create_many([make_migration(mount_points) for _ in range(docs)])
+        ids = list(repository.iter_ids())
+        rng = random.Random(0)
+        targets = [rng.choice(ids) for _ in range(ops)]
+        cursors = [ids[rng.randrange(max(docs - page_size, 1))] for _ in range(max(ops // page_size, 10))]
+
+        def entity_get():
+            JSONResponse(jsonable_encoder(repository.get(next(get_ids)).to_dict()))
+
+        def raw_get(redact=False):
+            repository.get_raw(next(get_ids), redact)
+
+        def entity_list():
+            page, _ = repository.list_page(page_size, next(list_cursors))
+            JSONResponse(jsonable_encoder([entity.to_dict() for entity in page]))
+
+        def raw_list(redact=False):
+            page, _ = repository.list_raw_page(page_size, next(list_cursors), redact=redact)
+            b"[" + b",".join(page) + b"]"
+
+        results = {}
+        for name, get, list_ in (("entity (baseline)", entity_get, entity_list),
+                                 ("raw", raw_get, raw_list),
+                                 ("raw redacted", lambda: raw_get(True), lambda: raw_list(True))):
+            get_ids = iter(targets)
+            list_cursors = iter(cursors)
+            results[name] = {
+                "cpu_us_per_get": _cpu_us(len(targets), get),
+                "cpu_us_per_list_page": _cpu_us(len(cursors), list_),
+            }
+
+    return {"docs": docs, "ops": ops, "page_size": page_size, "mount_points": mount_points,
+            "cache_size": cache_size, "paths": results}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--mount-points", type=int, default=24)
+    parser.add_argument("--cache-size", type=int, default=1024)
+    args = parser.parse_args(argv)
+
+    print(json.dumps(bench(args.docs, args.ops, args.page_size, args.mount_points, args.cache_size), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,356 @@
+"""
+Scale benchmark of the repositories and the REST routes on seeded synthetic data
+
+    python -m benchmarks.bench_scale --sizes 1000 10000 --output bench.json
+    python -m benchmarks.bench_scale --sizes 1000 10000 --compare bench.json
+
+For every size the store is seeded with `size` workloads, `size / 10` migration targets and
+`size` migrations, then create/get/update/list/query/run are measured for each repository
+and for each route through an in-process ASGI client (no network). The run benchmarks use
+`ops` migrations created for them, the seeded ones are left to the other benchmarks.
+The results are JSON; --compare reports the p50 latency ratios against a previous result
+and exits with 1 if one of them exceeds --threshold.
+"""
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Sequence
+
+from fastapi.testclient import TestClient
+
+from src import (Credentials, MountPoint, Workload, MigrationTarget, CloudType, Migration, WorkloadRepository,
+                 MigrationTargetRepository, MigrationRepository, MigrationRunner, Settings)
+from src.rest_api.main import app
+from src.rest_api.routers import workloads, migration_targets, migrations
+
+CLOUD_TYPES = list(CloudType)
+
+
+# Synthetic data
+def make_workload(rng: random.Random, i: int) -> Workload:
+    storage = [MountPoint(name, size) for name, size in (("C:\\", 100), ("D:\\", 200 * (1 + i % 4)), ("/data", 500))]
+    return Workload(ip=f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+                    credentials=Credentials(f"user{rng.randrange(100)}", "secret", "corp.example.com"),
+                    storage=storage)
+
+
+def make_target(rng: random.Random, i: int) -> MigrationTarget:
+    return MigrationTarget(cloud_type=CLOUD_TYPES[i % len(CLOUD_TYPES)],
+                           cloud_credentials=Credentials("svc", "secret", "cloud.example.com"),
+                           target_vm=Workload(ip=f"172.16.{i >> 8 & 255}.{i & 255}",
+                                              credentials=Credentials("root", "secret", "local"), storage=[]))
+
+
+def make_migration(source: Workload, target: MigrationTarget) -> Migration:
+    return Migration(selected_mount_points=source.storage[1:], source=source, migration_target=target)
+
+
+def seed(settings: Settings, size: int, seed_value: int, batch_size: int = 1000) -> Dict[str, Any]:
+    rng = random.Random(seed_value)
+    workload_repository = WorkloadRepository.from_settings(settings, "workloads")
+    target_repository = MigrationTargetRepository.from_settings(settings, "migration_targets")
+    migration_repository = MigrationRepository.from_settings(settings, "migrations")
+
+    target_list = [make_target(rng, i) for i in range(max(1, size // 10))]
+    target_repository.create_many(target_list)
+    workload_ids: List[str] = []
+    migration_ids: List[str] = []
+    for start in range(0, size, batch_size):
+        batch = [make_workload(rng, i) for i in range(start, min(size, start + batch_size))]
+        workload_repository.create_many(batch)
+        workload_ids.extend(w.id for w in batch)
+        migration_batch = [make_migration(w, rng.choice(target_list)) for w in batch]
+        migration_repository.create_many(migration_batch)
+        migration_ids.extend(m.id for m in migration_batch)
+
+    return {
+        "workloads": workload_repository,
+        "migration_targets": target_repository,
+        "migrations": migration_repository,
+        "workload_ids": workload_ids,
+        "target_ids": [t.id for t in target_list],
+        "migration_ids": migration_ids,
+        "next_index": size,
+        "rng": rng,
+    }
+
+
+def seed_runs(data: Dict[str, Any], n: int) -> List[str]:
+    """
+    Migrations created for a run benchmark (not measured), so that every run benchmark measures `n` runs
+    """
+    rng = data["rng"]
+    start = data["next_index"]
+    data["next_index"] += n
+    sources = [make_workload(rng, i) for i in range(start, start + n)]
+    data["workloads"].create_many(sources)
+    targets = [data["migration_targets"].get(id_obj) for id_obj in data["target_ids"][:10]]
+    migration_list = [make_migration(w, rng.choice(targets)) for w in sources]
+    data["migrations"].create_many(migration_list)
+    return [m.id for m in migration_list]
+
+
+# Measurement
+def summarize(latencies: Sequence[float], total: float) -> Dict[str, float]:
+    ordered = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1e3, 3)
+
+    return {
+        "count": len(ordered),
+        "ops_per_s": round(len(ordered) / total, 1) if total else 0.0,
+        "mean_ms": round(statistics.fmean(ordered) * 1e3, 3),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1e3, 3),
+    }
+
+
+def measure(func: Callable[[Any], Any], args: Sequence[Any]) -> Dict[str, float]:
+    latencies = []
+    start = time.perf_counter()
+    for arg in args:
+        t = time.perf_counter()
+        func(arg)
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def _expect(status: int) -> Callable[[Any], Any]:
+    def check(response):
+        if response.status_code != status:
+            raise RuntimeError(f"{response.request.method} {response.request.url}: "
+                               f"{response.status_code} {response.text[:200]}")
+        return response
+    return check
+
+
+def wait_all(runner: MigrationRunner, ids: Sequence[str]) -> None:
+    for id_obj in ids:
+        runner.wait(id_obj, timeout=60)
+
+
+# Benchmarks
+def bench_repositories(data: Dict[str, Any], ops: int) -> Dict[str, Dict[str, float]]:
+    rng = data["rng"]
+    workload_repository: WorkloadRepository = data["workloads"]
+    target_repository: MigrationTargetRepository = data["migration_targets"]
+    migration_repository: MigrationRepository = data["migrations"]
+    results: Dict[str, Dict[str, float]] = {}
+
+    def new_workloads(n: int) -> List[Workload]:
+        start = data["next_index"]
+        data["next_index"] += n
+        return [make_workload(rng, i) for i in range(start, start + n)]
+
+    def update(repository):
+        def run(id_obj):
+            repository.update(repository.get(id_obj))
+        return run
+
+    for name, repository, ids in (("workloads", workload_repository, data["workload_ids"]),
+                                  ("migration_targets", target_repository, data["target_ids"]),
+                                  ("migrations", migration_repository, data["migration_ids"])):
+        sample = [rng.choice(ids) for _ in range(ops)]
+        repository.cache_clear()
+        results[f"{name}.get_cold"] = measure(repository.get, sample)
+        results[f"{name}.get"] = measure(repository.get, sample)
+        results[f"{name}.update"] = measure(update(repository), sample)
+        results[f"{name}.list_page_100"] = measure(lambda _: repository.list_page(100), range(max(1, ops // 10)))
+
+        start = time.perf_counter()
+        count = sum(1 for _ in repository.iter_all())
+        total = time.perf_counter() - start
+        results[f"{name}.list_all"] = {"count": count, "total_s": round(total, 3),
+                                       "entities_per_s": round(count / total, 1) if total else 0.0}
+
+    created = new_workloads(ops)
+    results["workloads.create"] = measure(workload_repository.create, created)
+    results["workloads.find_by_ip"] = measure(workload_repository.find_by_ip, [w.ip for w in created])
+    results["migration_targets.create"] = measure(target_repository.create,
+                                                  [make_target(rng, i) for i in range(ops)])
+    targets = [target_repository.get(id_obj) for id_obj in data["target_ids"][:10]]
+    results["migrations.create"] = measure(migration_repository.create,
+                                           [make_migration(w, rng.choice(targets)) for w in created])
+    results["migrations.query_state"] = measure(lambda _: migration_repository.query(state="NOT_STARTED"),
+                                                range(max(1, ops // 10)))
+    results["migrations.query_source"] = measure(lambda id_obj: migration_repository.query(source_id=id_obj),
+                                                 [rng.choice(data["workload_ids"]) for _ in range(ops)])
+
+    # Run: submit latency and end-to-end throughput of the runner
+    run_ids = seed_runs(data, ops)
+    runner = MigrationRunner(migration_repository, max_workers=4, max_queue=len(run_ids) + 1)
+    start = time.perf_counter()
+    results["migrations.run_submit"] = measure(runner.submit, run_ids)
+    wait_all(runner, run_ids)
+    total = time.perf_counter() - start
+    runner.shutdown()
+    results["migrations.run_total"] = {"count": len(run_ids), "total_s": round(total, 3),
+                                       "runs_per_s": round(len(run_ids) / total, 1) if total else 0.0}
+
+    return results
+
+
+@contextmanager
+def use_repositories(data: Dict[str, Any], runner: MigrationRunner) -> Iterator[None]:
+    """
+    Point the routers at the seeded repositories
+    """
+    saved = (workloads.workload_repository, migration_targets.migration_target_repository,
+             migrations.migration_repository, migrations.migration_runner)
+    workloads.workload_repository = data["workloads"]
+    migration_targets.migration_target_repository = data["migration_targets"]
+    migrations.migration_repository = data["migrations"]
+    migrations.migration_runner = runner
+    try:
+        yield
+    finally:
+        (workloads.workload_repository, migration_targets.migration_target_repository,
+         migrations.migration_repository, migrations.migration_runner) = saved
+
+
+def bench_routes(data: Dict[str, Any], ops: int) -> Dict[str, Dict[str, float]]:
+    rng = data["rng"]
+    results: Dict[str, Dict[str, float]] = {}
+    runner = MigrationRunner(data["migrations"], max_workers=4, max_queue=ops + 1)
+    ok, accepted = _expect(200), _expect(202)
+
+    with use_repositories(data, runner), TestClient(app) as client:
+        for prefix, ids in (("workloads", data["workload_ids"]),
+                            ("migration_targets", data["target_ids"]),
+                            ("migrations", data["migration_ids"])):
+            sample = [rng.choice(ids) for _ in range(ops)]
+            results[f"GET /{prefix}/{{id}}"] = measure(lambda id_obj: ok(client.get(f"/{prefix}/{id_obj}")), sample)
+
+            def put(id_obj):
+                body = ok(client.get(f"/{prefix}/{id_obj}")).json()
+                ok(client.put(f"/{prefix}/{id_obj}", json=body))
+            results[f"GET+PUT /{prefix}/{{id}}"] = measure(put, sample)
+
+            results[f"GET /{prefix}/?limit=100"] = measure(
+                lambda _: ok(client.get(f"/{prefix}/", params={"limit": 100})), range(max(1, ops // 10)))
+
+        start = data["next_index"]
+        data["next_index"] += ops
+        bodies = [make_workload(rng, i).to_dict() for i in range(start, start + ops)]
+        results["POST /workloads/"] = measure(lambda body: ok(client.post("/workloads/", json=body)), bodies)
+        results["POST /migration_targets/"] = measure(
+            lambda _: ok(client.post("/migration_targets/", json=make_target(rng, 0).to_dict())), range(ops))
+        target = data["migration_targets"].get(data["target_ids"][0]).to_dict()
+        results["POST /migrations/"] = measure(
+            lambda body: ok(client.post("/migrations/", json={"selected_mount_points": body["storage"][1:],
+                                                               "source": body, "migration_target": target})),
+            bodies)
+        results["GET /migrations/?state=NOT_STARTED&limit=100"] = measure(
+            lambda _: ok(client.get("/migrations/", params={"state": "NOT_STARTED", "limit": 100})),
+            range(max(1, ops // 10)))
+
+        run_ids = seed_runs(data, ops)
+        results["POST /migrations/{id}/run"] = measure(
+            lambda id_obj: accepted(client.post(f"/migrations/{id_obj}/run")), run_ids)
+        results["GET /migrations/{id}/status"] = measure(
+            lambda id_obj: ok(client.get(f"/migrations/{id_obj}/status")), run_ids)
+        wait_all(runner, run_ids)
+
+    runner.shutdown()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench(sizes: Sequence[int], ops: int, backend: str, codec: str, seed_value: int,
+          routes: bool = True) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as d:
+            settings = Settings(storage_backend=backend, data_dir=Path(d), codec=codec)
+            start = time.perf_counter()
+            data = seed(settings, size, seed_value)
+            entry: Dict[str, Any] = {"seed_s": round(time.perf_counter() - start, 3)}
+            entry["repository"] = bench_repositories(data, ops)
+            if routes:
+                entry["routes"] = bench_routes(data, ops)
+            results[str(size)] = entry
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": backend,
+            "codec": codec,
+            "ops": ops,
+            "seed": seed_value,
+        },
+        "results": results,
+    }
+
+
+def compare(base: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    """
+    p50 ratios (current / base) of the operations measured in both results
+    """
+    rows = []
+    for size, entry in current["results"].items():
+        base_entry = base["results"].get(size, {})
+        for group in ("repository", "routes"):
+            for op, stats in entry.get(group, {}).items():
+                base_stats = base_entry.get(group, {}).get(op)
+                if not base_stats or "p50_ms" not in stats or not base_stats.get("p50_ms"):
+                    continue
+                ratio = round(stats["p50_ms"] / base_stats["p50_ms"], 2)
+                rows.append({"size": size, "op": f"{group}:{op}", "base_p50_ms": base_stats["p50_ms"],
+                             "p50_ms": stats["p50_ms"], "ratio": ratio, "regression": ratio > threshold})
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--ops", type=int, default=200, help="measured operations per benchmark")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--codec", default="json")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-routes", action="store_true", help="only benchmark the repositories")
+    parser.add_argument("--output", type=Path, default=None, help="write the results to this file")
+    parser.add_argument("--compare", type=Path, default=None, help="previous results to compare with")
+    parser.add_argument("--threshold", type=float, default=1.25, help="p50 ratio counted as a regression")
+    args = parser.parse_args(argv)
+    if args.ops < 1 or min(args.sizes) < 1:
+        parser.error("--sizes and --ops should be at least 1")
+
+    result = bench(args.sizes, args.ops, args.backend, args.codec, args.seed, routes=not args.no_routes)
+    text = json.dumps(result, indent=2)
+    if args.output is not None:
+        args.output.write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    if args.compare is not None:
+        rows = compare(json.loads(args.compare.read_text(encoding="utf-8")), result, args.threshold)
+        regressions = [row for row in rows if row["regression"]]
+        print(json.dumps({"compared": len(rows), "regressions": regressions}, indent=2))
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
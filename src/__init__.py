@@ -12,9 +12,13 @@ from .persistence import (
     MigrationTargetRepository,
     MigrationRepository,
 )
-from .exceptions import BusinessRuleError, NotFoundError, DuplicateError
+from .storage import Storage, FileStorage, SqliteStorage
+from .changelog import ChangeLog
+from .exceptions import BusinessRuleError, NotFoundError, DuplicateError, CapacityError, ConflictError
+from .runner import MigrationRunner
+from .config import Settings
 
-from .utils import write_json, read_json
+from .utils import write_json, read_json, get_codec
 
 __all__ = [
     "Credentials",
@@ -27,7 +31,15 @@ __all__ = [
     "WorkloadRepository",
     "MigrationTargetRepository",
     "MigrationRepository",
+    "MigrationRunner",
+    "Storage",
+    "FileStorage",
+    "SqliteStorage",
+    "ChangeLog",
+    "Settings",
     "BusinessRuleError",
     "NotFoundError",
     "DuplicateError",
+    "CapacityError",
+    "ConflictError",
 ]
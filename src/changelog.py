@@ -0,0 +1,149 @@
+"""Change log shared by the processes using one store, so their caches can trust cached entities"""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows: the log is never rotated
+    fcntl = None
+
+
+class ChangeLog:
+    """
+    Append-only file with one line `<writer> <id>` per written or deleted entity, tailed by every repository
+
+    The sequence number of a change is the end offset of its line in the file, the generation
+    of the file (its inode) changes when the log is rotated. A reader that sees a new generation
+    has missed changes and has to treat everything as changed.
+
+    Appends hold a shared flock of the file, the rotation (after `max_size` bytes) an exclusive one.
+
+    Attributes:
+        max_staleness (float): poll() reads the file at most once per this many seconds,
+            changes of other processes are seen at most this late
+    """
+
+    def __init__(self, path: Path, max_staleness: float = 1.0, max_size: int = 4 << 20):
+        self.path = path
+        self.max_staleness = max_staleness
+        self.max_size = max_size
+        self.writer = uuid4().hex[:8]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._append_fd: Optional[int] = None
+        self._read_fd: Optional[int] = None
+        self._generation: Optional[int] = None
+        self._position = 0
+        self._partial = b""
+        self._last_poll = float("-inf")
+
+    # Writing
+    def _open_append(self) -> int:
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if self._append_fd is not None:
+            os.close(self._append_fd)
+        self._append_fd = fd
+        return fd
+
+    def append(self, ids: Iterable[str]) -> None:
+        data = "".join(f"{self.writer} {id_obj}\n" for id_obj in ids).encode("utf-8")
+        if not data:
+            return
+        with self._lock:
+            fd = self._append_fd if self._append_fd is not None else self._open_append()
+            if fcntl is None:
+                os.write(fd, data)
+                return
+            while True:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                if os.fstat(fd).st_ino == self._inode():
+                    break
+                # Rotated since the file was opened
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                fd = self._open_append()
+            try:
+                os.write(fd, data)
+                end = os.fstat(fd).st_size
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            if end > self.max_size:
+                self._rotate(fd)
+
+    def _inode(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _rotate(self, fd: int) -> None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another process is appending or rotating
+            return
+        try:
+            if os.fstat(fd).st_ino == self._inode():
+                tmp_path = self.path.with_name(f"{self.path.name}.{self.writer}.tmp")
+                open(tmp_path, "wb").close()
+                os.replace(tmp_path, self.path)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    # Reading
+    def sequence(self) -> Tuple[Optional[int], int]:
+        """
+        :return: Generation and current sequence number of the log
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def poll(self, force: bool = False) -> Optional[List[str]]:
+        """
+        Ids changed by other processes since the last poll, without duplicates
+
+        :param force: Read the file even if it was read less than `max_staleness` seconds ago
+        :return: None if changes may have been missed (first poll, rotation): everything has to be treated as changed
+        """
+        now = time.monotonic()
+        if not force and now - self._last_poll < self.max_staleness:
+            return []
+
+        with self._lock:
+            self._last_poll = now
+            generation, size = self.sequence()
+            if generation != self._generation or size < self._position:
+                if self._read_fd is not None:
+                    os.close(self._read_fd)
+                self._read_fd = os.open(self.path, os.O_RDONLY | os.O_CREAT, 0o644)
+                self._generation = os.fstat(self._read_fd).st_ino
+                self._position = os.fstat(self._read_fd).st_size
+                self._partial = b""
+                return None
+            if size == self._position:
+                return []
+
+            data = self._partial + os.pread(self._read_fd, size - self._position, self._position)
+            self._position = size
+            lines = data.split(b"\n")
+            # An append may be read before it is complete
+            self._partial = lines.pop()
+
+        prefix = f"{self.writer} ".encode("utf-8")
+        changed = {line.split(b" ", 1)[1].decode("utf-8") for line in lines
+                   if b" " in line and not line.startswith(prefix)}
+        return sorted(changed)
+
+    def close(self) -> None:
+        with self._lock:
+            for fd in (self._append_fd, self._read_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._append_fd = self._read_fd = None
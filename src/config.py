@@ -0,0 +1,147 @@
+"""Settings of the service, read from environment variables"""
+
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_path(name: str) -> Optional[Path]:
+    value = os.environ.get(name)
+    return Path(value) if value else None
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Service settings
+
+    Attributes:
+        storage_backend (str): "json" (file per entity) or "sqlite" (CLOUDSHIFT_STORAGE)
+        data_dir (Path): Root directory of the stored data (CLOUDSHIFT_DATA_DIR)
+        sqlite_file (str): SQLite database file name inside data_dir (CLOUDSHIFT_SQLITE_FILE)
+        codec (str): Format of written JSON store files: json, compact, orjson or msgpack (CLOUDSHIFT_CODEC)
+        shard_levels (int): Levels of id-prefix subdirectories of a new JSON store, 0 - one flat directory
+            (CLOUDSHIFT_SHARD_LEVELS)
+        cache_size (int): Entities kept in the cache of each repository (CLOUDSHIFT_CACHE_SIZE)
+        migration_references (bool): Store migrations with references to their source and target
+            instead of full copies (CLOUDSHIFT_MIGRATION_REFERENCES)
+        list_cache_bytes (int): Memory for cached list responses, 0 - no cache (CLOUDSHIFT_LIST_CACHE_BYTES)
+        redact_credentials (bool): Read endpoints return "***" instead of the passwords
+            (CLOUDSHIFT_REDACT_CREDENTIALS)
+        change_log (bool): Share writes between processes through a change log, cached entities are then
+            used without checking the stored file (CLOUDSHIFT_CHANGE_LOG)
+        max_staleness (float): Seconds after which the writes of other processes are seen
+            when the change log is used (CLOUDSHIFT_MAX_STALENESS)
+        run_workers (int): Number of migrations executed at the same time (CLOUDSHIFT_RUN_WORKERS)
+        run_queue_size (int): Number of migrations waiting for a worker (CLOUDSHIFT_RUN_QUEUE_SIZE)
+        run_min_to_sleep (int): Simulated duration of a migration in minutes (CLOUDSHIFT_RUN_MIN_TO_SLEEP)
+        run_max_per_target (int): Running migrations per MigrationTarget, 0 - no limit (CLOUDSHIFT_RUN_MAX_PER_TARGET)
+        run_max_per_cloud_type (int): Running migrations per CloudType, 0 - no limit
+            (CLOUDSHIFT_RUN_MAX_PER_CLOUD_TYPE)
+        transfer_enabled (bool): Executing a migration writes its selected data to the transfer directory,
+            otherwise only the simulated duration (run_min_to_sleep) is spent (CLOUDSHIFT_TRANSFER)
+        transfer_max_bytes (int): Bytes transferred by one migration at most, 0 - no limit
+            (CLOUDSHIFT_TRANSFER_MAX_BYTES)
+        transfer_bandwidth (int): Bytes per second transferred by one running migration, 0 - no limit
+            (CLOUDSHIFT_TRANSFER_BANDWIDTH)
+        transfer_chunk_size (int): Bytes written at once by a transfer (CLOUDSHIFT_TRANSFER_CHUNK_SIZE)
+        transfer_unit (int): Bytes per unit of MountPoint.total_size (CLOUDSHIFT_TRANSFER_UNIT)
+        transfer_dir (Path): Directory the transferred data is written to, default <data_dir>/transfers
+            (CLOUDSHIFT_TRANSFER_DIR)
+        transfer_report_interval (float): Seconds between two writes of the transfer progress
+            (CLOUDSHIFT_TRANSFER_REPORT_INTERVAL)
+        profile (bool): Profile every request (CLOUDSHIFT_PROFILE)
+        profile_token (str): Requests with this X-Profile-Token header are profiled, also required
+            by the /admin/profiles endpoints (CLOUDSHIFT_PROFILE_TOKEN)
+        profile_dir (Path): Directory of the stored profiles, default <data_dir>/profiles (CLOUDSHIFT_PROFILE_DIR)
+        profile_keep (int): Number of stored profiles, the oldest are deleted (CLOUDSHIFT_PROFILE_KEEP)
+    """
+    storage_backend: str = "json"
+    data_dir: Path = field(default=Path("./data"))
+    sqlite_file: str = "cloudshift.db"
+    codec: str = "json"
+    shard_levels: int = 0
+    cache_size: int = 1024
+    migration_references: bool = False
+    list_cache_bytes: int = 32 << 20
+    redact_credentials: bool = False
+    change_log: bool = False
+    max_staleness: float = 1.0
+    run_workers: int = 4
+    run_queue_size: int = 100
+    run_min_to_sleep: int = 0
+    run_max_per_target: int = 2
+    run_max_per_cloud_type: int = 0
+    transfer_enabled: bool = False
+    transfer_max_bytes: int = 1 << 30
+    transfer_bandwidth: int = 0
+    transfer_chunk_size: int = 1 << 20
+    transfer_unit: int = 1
+    transfer_dir: Optional[Path] = None
+    transfer_report_interval: float = 1.0
+    profile: bool = False
+    profile_token: str = ""
+    profile_dir: Optional[Path] = None
+    profile_keep: int = 50
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            storage_backend=os.environ.get("CLOUDSHIFT_STORAGE", cls.storage_backend).lower(),
+            data_dir=Path(os.environ.get("CLOUDSHIFT_DATA_DIR", "./data")),
+            sqlite_file=os.environ.get("CLOUDSHIFT_SQLITE_FILE", cls.sqlite_file),
+            codec=os.environ.get("CLOUDSHIFT_CODEC", cls.codec).lower(),
+            shard_levels=_env_int("CLOUDSHIFT_SHARD_LEVELS", cls.shard_levels),
+            cache_size=_env_int("CLOUDSHIFT_CACHE_SIZE", cls.cache_size),
+            migration_references=_env_bool("CLOUDSHIFT_MIGRATION_REFERENCES", cls.migration_references),
+            list_cache_bytes=_env_int("CLOUDSHIFT_LIST_CACHE_BYTES", cls.list_cache_bytes),
+            redact_credentials=_env_bool("CLOUDSHIFT_REDACT_CREDENTIALS", cls.redact_credentials),
+            change_log=_env_bool("CLOUDSHIFT_CHANGE_LOG", cls.change_log),
+            max_staleness=_env_float("CLOUDSHIFT_MAX_STALENESS", cls.max_staleness),
+            run_workers=_env_int("CLOUDSHIFT_RUN_WORKERS", cls.run_workers),
+            run_queue_size=_env_int("CLOUDSHIFT_RUN_QUEUE_SIZE", cls.run_queue_size),
+            run_min_to_sleep=_env_int("CLOUDSHIFT_RUN_MIN_TO_SLEEP", cls.run_min_to_sleep),
+            run_max_per_target=_env_int("CLOUDSHIFT_RUN_MAX_PER_TARGET", cls.run_max_per_target),
+            run_max_per_cloud_type=_env_int("CLOUDSHIFT_RUN_MAX_PER_CLOUD_TYPE", cls.run_max_per_cloud_type),
+            transfer_enabled=_env_bool("CLOUDSHIFT_TRANSFER", cls.transfer_enabled),
+            transfer_max_bytes=_env_int("CLOUDSHIFT_TRANSFER_MAX_BYTES", cls.transfer_max_bytes),
+            transfer_bandwidth=_env_int("CLOUDSHIFT_TRANSFER_BANDWIDTH", cls.transfer_bandwidth),
+            transfer_chunk_size=_env_int("CLOUDSHIFT_TRANSFER_CHUNK_SIZE", cls.transfer_chunk_size),
+            transfer_unit=_env_int("CLOUDSHIFT_TRANSFER_UNIT", cls.transfer_unit),
+            transfer_dir=_env_path("CLOUDSHIFT_TRANSFER_DIR"),
+            transfer_report_interval=_env_float("CLOUDSHIFT_TRANSFER_REPORT_INTERVAL", cls.transfer_report_interval),
+            profile=_env_bool("CLOUDSHIFT_PROFILE", cls.profile),
+            profile_token=os.environ.get("CLOUDSHIFT_PROFILE_TOKEN", cls.profile_token),
+            profile_dir=_env_path("CLOUDSHIFT_PROFILE_DIR"),
+            profile_keep=_env_int("CLOUDSHIFT_PROFILE_KEEP", cls.profile_keep),
+        )
+
+    @property
+    def sqlite_path(self) -> Path:
+        return self.data_dir / self.sqlite_file
+
+    @property
+    def transfer_path(self) -> Path:
+        return self.transfer_dir if self.transfer_dir is not None else self.data_dir / "transfers"
+
+    @property
+    def profile_path(self) -> Path:
+        return self.profile_dir if self.profile_dir is not None else self.data_dir / "profiles"
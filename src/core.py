@@ -1,13 +1,42 @@
 import time
 from uuid import uuid4
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Any
+from typing import List, Any, Optional
 
 from .exceptions import BusinessRuleError
 
+# Trusted loads (data written by our own repositories) build objects without __init__/__post_init__
+_new = object.__new__
+_set = object.__setattr__
 
-@dataclass(frozen=True)
+# Interned Credentials and MountPoint values, shared by all objects loaded with from_dict
+_INTERN_LIMIT = 65536
+_interned_credentials: dict[tuple, "Credentials"] = {}
+_interned_mount_points: dict[tuple, "MountPoint"] = {}
+
+
+def _intern(table: dict, cls, data: dict[str, Any], fields: tuple) -> Any:
+    """
+    Shared object of `cls` with the values of `fields` in `data`.
+    The types are part of the key: equal values of other types (1, 1.0, True) are other objects.
+
+    :raises BusinessRuleError: If `data` has other keys than `fields`
+    """
+    values = tuple(data[name] for name in fields)
+    if len(data) != len(fields):
+        raise BusinessRuleError(f"Unknown fields: {', '.join(sorted(set(data) - set(fields)))}")
+    key = values + tuple(map(type, values))
+    value = table.get(key)
+    if value is None:
+        value = cls(*values)
+        if len(table) >= _INTERN_LIMIT:
+            table.clear()
+        table[key] = value
+    return value
+
+
+@dataclass(frozen=True, slots=True)
 class Credentials:
     """
     Authentication data for a workload and cloud target
@@ -28,8 +57,26 @@ class Credentials:
         if not self.username or not self.password:
             raise BusinessRuleError("username, password are required")
 
+    def __deepcopy__(self, memo):
+        # Immutable, safe to share between copies
+        return self
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"username": self.username, "password": self.password, "domain": self.domain}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any], trusted: bool = False) -> "Credentials":
+        """
+        Equal credentials are interned: one shared (immutable) object, validated once
+
+        :raises BusinessRuleError: If the credentials are invalid or have unknown fields
+
+        :param trusted: Kept for symmetry with the other models, interned values are always validated
+        """
+        return _intern(_interned_credentials, cls, data, ("username", "password", "domain"))
+
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class MountPoint:
     """
     Represents of VM
@@ -50,8 +97,26 @@ class MountPoint:
         if self.total_size < 0:
             raise BusinessRuleError("total_size cannot be negative")
 
+    def __deepcopy__(self, memo):
+        # Immutable, safe to share between copies
+        return self
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"name": self.name, "total_size": self.total_size}
 
-@dataclass
+    @classmethod
+    def from_dict(cls, data: dict[str, Any], trusted: bool = False) -> "MountPoint":
+        """
+        Equal mount points are interned: one shared (immutable) object, validated once
+
+        :raises BusinessRuleError: If the mount point is invalid or has unknown fields
+
+        :param trusted: Kept for symmetry with the other models, interned values are always validated
+        """
+        return _intern(_interned_mount_points, cls, data, ("name", "total_size"))
+
+
+@dataclass(slots=True)
 class Workload:
     """
     Represents source of VM
@@ -61,11 +126,13 @@ class Workload:
         credentials (Credentials): Authentication data
         storage (List(MountPoint)): List of disk
         id (str): Workload ID
+        version (int): Stored version, None if unknown (see Repository.update)
     """
     ip: str
     credentials: Credentials
     storage: List[MountPoint]
     id: str = field(default_factory=lambda: str(uuid4()))
+    version: Optional[int] = None
 
     def __post_init__(self):
         """
@@ -79,19 +146,34 @@ class Workload:
     def to_dict(self) -> dict[str, Any]:
         return {
             "ip": self.ip,
-            "credentials": asdict(self.credentials),
-            "storage": [asdict(mp) for mp in self.storage],
-            "id": self.id
+            "credentials": self.credentials.to_dict(),
+            "storage": [{"name": mp.name, "total_size": mp.total_size} for mp in self.storage],
+            "id": self.id,
+            "version": self.version,
         }
 
     @classmethod
-    def from_dict(cls, data: dict[str, Any]) -> "Workload":
-        credentials_data = Credentials(**data["credentials"])
-        storage_data = [MountPoint(**mp) for mp in data["storage"]]
-        if "id" in data and data["id"] is not None:
-            return cls(ip=data["ip"], credentials=credentials_data, storage=storage_data, id=data["id"])
-        else:
-            return cls(ip=data["ip"], credentials=credentials_data, storage=storage_data)
+    def from_dict(cls, data: dict[str, Any], trusted: bool = False) -> "Workload":
+        """
+        :param trusted: Skip validation, only for data written by the repositories
+        """
+        mount_point_from_dict = MountPoint.from_dict
+        credentials_data = Credentials.from_dict(data["credentials"], trusted)
+        storage_data = [mount_point_from_dict(mp, trusted) for mp in data["storage"]]
+        id_obj = data.get("id")
+        if id_obj is None:
+            id_obj = str(uuid4())
+        if not trusted:
+            return cls(ip=data["ip"], credentials=credentials_data, storage=storage_data, id=id_obj,
+                       version=data.get("version"))
+
+        workload = _new(cls)
+        _set(workload, "ip", data["ip"])
+        _set(workload, "credentials", credentials_data)
+        _set(workload, "storage", storage_data)
+        _set(workload, "id", id_obj)
+        _set(workload, "version", data.get("version", 0))
+        return workload
 
 
 class CloudType(Enum):
@@ -101,7 +183,10 @@ class CloudType(Enum):
     VCLOUD = "VCLOUD"
 
 
-@dataclass
+_CLOUD_TYPES = {cloud_type.value: cloud_type for cloud_type in CloudType}
+
+
+@dataclass(slots=True)
 class MigrationTarget:
     """
     Represents of a place for migration
@@ -111,11 +196,13 @@ class MigrationTarget:
         cloud_credentials (Credentials): Authentication data
         target_vm (Workload): The vm that will become the migration target
         id (str): MigrationTarget ID
+        version (int): Stored version, None if unknown (see Repository.update)
     """
     cloud_type: CloudType
     cloud_credentials: Credentials
     target_vm: Workload
     id: str = field(default_factory=lambda: str(uuid4()))
+    version: Optional[int] = None
 
     def __post_init__(self):
         """
@@ -131,20 +218,33 @@ class MigrationTarget:
     def to_dict(self) -> dict[str, Any]:
         return {
             "cloud_type": self.cloud_type.value,
-            "cloud_credentials": asdict(self.cloud_credentials),
+            "cloud_credentials": self.cloud_credentials.to_dict(),
             "target_vm": self.target_vm.to_dict(),
             "id": self.id,
+            "version": self.version,
         }
 
     @classmethod
-    def from_dict(cls, data: dict[str, Any]) -> "MigrationTarget":
-        credentials_data = Credentials(**data["cloud_credentials"])
-        if "id" in data and data["id"] is not None:
-            return cls(cloud_type=CloudType(data["cloud_type"]), cloud_credentials=credentials_data,
-                       target_vm=Workload.from_dict(data["target_vm"]), id=data["id"])
-        else:
+    def from_dict(cls, data: dict[str, Any], trusted: bool = False) -> "MigrationTarget":
+        """
+        :param trusted: Skip validation, only for data written by the repositories
+        """
+        credentials_data = Credentials.from_dict(data["cloud_credentials"], trusted)
+        target_vm = Workload.from_dict(data["target_vm"], trusted)
+        id_obj = data.get("id")
+        if id_obj is None:
+            id_obj = str(uuid4())
+        if not trusted:
             return cls(cloud_type=CloudType(data["cloud_type"]), cloud_credentials=credentials_data,
-                       target_vm=Workload.from_dict(data["target_vm"]))
+                       target_vm=target_vm, id=id_obj, version=data.get("version"))
+
+        target = _new(cls)
+        _set(target, "cloud_type", _CLOUD_TYPES[data["cloud_type"]])
+        _set(target, "cloud_credentials", credentials_data)
+        _set(target, "target_vm", target_vm)
+        _set(target, "id", id_obj)
+        _set(target, "version", data.get("version", 0))
+        return target
 
 
 class MigrationState(str, Enum):
@@ -154,7 +254,10 @@ class MigrationState(str, Enum):
     SUCCESS = "SUCCESS"
 
 
-@dataclass
+_MIGRATION_STATES = {state.value: state for state in MigrationState}
+
+
+@dataclass(slots=True)
 class Migration:
     """
     Represents a migration process
@@ -165,12 +268,14 @@ class Migration:
         migration_target (MigrationTarget): Migration target
         state (MigrationState): Current state of migration
         id (str): Migration ID
+        version (int): Stored version, None if unknown (see Repository.update)
     """
     selected_mount_points: list[MountPoint]
     source: Workload
     migration_target: MigrationTarget
     state: MigrationState = field(default=MigrationState.NOT_STARTED)
-    id: str = field(default=str(uuid4()))
+    id: str = field(default_factory=lambda: str(uuid4()))
+    version: Optional[int] = None
 
     def __post_init__(self):
         if not isinstance(self.source, Workload):
@@ -191,6 +296,15 @@ class Migration:
         :param min_to_sleep: Number of minutes to sleep before executing migration
         :return: None
 
+        :raises BusinessRuleError: IF wrong state or migrations is running when volume 'C:\\'
+        """
+        self.start()
+        self.execute(min_to_sleep)
+
+    def start(self) -> None:
+        """
+        Check that the migration can be run and switch it to RUNNING
+
         :raises BusinessRuleError: IF wrong state or migrations is running when volume 'C:\\'
         """
         if self.state not in (MigrationState.NOT_STARTED, MigrationState.ERROR):
@@ -205,6 +319,16 @@ class Migration:
 
         self.state = MigrationState.RUNNING
 
+    def execute(self, min_to_sleep: int = 1) -> None:
+        """
+        Do the work of a started migration
+
+        :param min_to_sleep: Number of minutes to sleep before executing migration
+        :raises BusinessRuleError: If the migration is not RUNNING
+        """
+        if self.state != MigrationState.RUNNING:
+            raise BusinessRuleError("Migration is not running")
+
         # Simulate running migration
         time.sleep(60 * min_to_sleep)
 
@@ -221,23 +345,70 @@ class Migration:
 
     def to_dict(self) -> dict[str, Any]:
         return {
-            "selected_mount_points": [asdict(mp) for mp in self.selected_mount_points],
+            "selected_mount_points": [{"name": mp.name, "total_size": mp.total_size}
+                                      for mp in self.selected_mount_points],
             "source": self.source.to_dict(),
             "migration_target": self.migration_target.to_dict(),
             "state": self.state.value,
             "id": self.id,
+            "version": self.version,
         }
 
+    def to_ref_dict(self) -> dict[str, Any]:
+        """
+        Like to_dict, but the source and the migration target are stored by id
+        """
+        return {
+            "selected_mount_points": [{"name": mp.name, "total_size": mp.total_size}
+                                      for mp in self.selected_mount_points],
+            "source_id": self.source.id,
+            "migration_target_id": self.migration_target.id,
+            "state": self.state.value,
+            "id": self.id,
+            "version": self.version,
+        }
+
+    @classmethod
+    def _build(cls, data: dict[str, Any], source: Workload, migration_target: MigrationTarget,
+               trusted: bool) -> "Migration":
+        mount_point_from_dict = MountPoint.from_dict
+        storage_data = [mount_point_from_dict(mp, trusted) for mp in data["selected_mount_points"]]
+        state = data.get("state", MigrationState.NOT_STARTED.value)
+        id_obj = data.get("id")
+        if id_obj is None:
+            id_obj = str(uuid4())
+        if not trusted:
+            return cls(selected_mount_points=storage_data, source=source, migration_target=migration_target,
+                       state=MigrationState(state), id=id_obj, version=data.get("version"))
+
+        migration = _new(cls)
+        _set(migration, "selected_mount_points", storage_data)
+        _set(migration, "source", source)
+        _set(migration, "migration_target", migration_target)
+        _set(migration, "state", _MIGRATION_STATES[state])
+        _set(migration, "id", id_obj)
+        _set(migration, "version", data.get("version", 0))
+        return migration
+
     @classmethod
-    def from_dict(cls, data: dict[str, Any]) -> "Migration":
-        storage_data = [MountPoint(**mp) for mp in data["selected_mount_points"]]
-        if "id" in data and data["id"] is not None:
-            return cls(selected_mount_points=storage_data,
-                       source=Workload.from_dict(data["source"]),
-                       migration_target=MigrationTarget.from_dict(data["migration_target"]),
-                       state=MigrationState(data.get("state", MigrationState.NOT_STARTED.value)), id=data["id"])
-        else:
-            return cls(selected_mount_points=storage_data,
-                       source=Workload.from_dict(data["source"]),
-                       migration_target=MigrationTarget.from_dict(data["migration_target"]),
-                       state=MigrationState(data.get("state", MigrationState.NOT_STARTED.value)))
+    def from_ref_dict(cls, data: dict[str, Any], source: Workload,
+                      migration_target: MigrationTarget, trusted: bool = False) -> "Migration":
+        """
+        Build a migration from to_ref_dict() data and the resolved source and migration target
+
+        :param trusted: Skip validation, only for data written by the repositories
+        """
+        if source.id != data["source_id"] or migration_target.id != data["migration_target_id"]:
+            raise BusinessRuleError("source and migration_target do not match the references")
+
+        return cls._build(data, source, migration_target, trusted)
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any], trusted: bool = False) -> "Migration":
+        """
+        :param trusted: Skip validation, only for data written by the repositories
+        """
+        return cls._build(data,
+                          Workload.from_dict(data["source"], trusted),
+                          MigrationTarget.from_dict(data["migration_target"], trusted),
+                          trusted)
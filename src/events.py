@@ -0,0 +1,137 @@
+"""In-process event bus: migration changes pushed to the subscribers of the status streams"""
+
+import asyncio
+import threading
+from itertools import count
+from typing import Any, Dict, List, Optional, Set
+
+from .core import Migration
+
+STATE = "state"
+PHASE = "phase"
+PROGRESS = "progress"
+DELETED = "deleted"
+
+
+def migration_event(kind: str, migration: Migration, **data: Any) -> Dict[str, Any]:
+    """
+    Event about a migration, with the fields the subscribers can filter on
+    """
+    return {
+        "type": kind,
+        "id": migration.id,
+        "state": migration.state.value,
+        "source_id": migration.source.id,
+        "migration_target_id": migration.migration_target.id,
+        "cloud_type": migration.migration_target.cloud_type.value,
+        **data,
+    }
+
+
+class Subscription:
+    """
+    Events of one subscriber, delivered into its event loop
+
+    Attributes:
+        ids (Set[str]): Only events of these migrations, all migrations if empty
+        filters (Dict[str, Any]): Only events whose fields have these values
+        overflowed (bool): The subscriber did not keep up, events were dropped and the subscription ended
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, ids: Set[str], filters: Dict[str, Any], max_pending: int):
+        self.loop = loop
+        self.ids = ids
+        self.filters = filters
+        self.overflowed = False
+        self._queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(max_pending)
+
+    def matches(self, event: Dict[str, Any]) -> bool:
+        return all(event.get(name) == value for name, value in self.filters.items())
+
+    def _put(self, event: Dict[str, Any]) -> None:
+        if self.overflowed:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        :return: The next event, None on overflow
+        :raises asyncio.TimeoutError: If no event arrives within `timeout` seconds
+        """
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+
+class EventBus:
+    """
+    Publish/subscribe of events (dicts with an "id"), thread safe
+
+    Subscribers are indexed by the migration ids they watch, so a change only visits the subscribers
+    interested in it. The matching subscribers are handed over to each event loop with one callback,
+    not one wake-up per subscriber.
+    """
+
+    def __init__(self, max_pending: int = 1000):
+        self.max_pending = max_pending
+        self._seq = count(1)
+        self._lock = threading.Lock()
+        # migration id -> subscribers of it, None -> subscribers of all migrations
+        self._subscribers: Dict[Optional[str], Set[Subscription]] = {}
+
+    def subscribe(self, ids: Set[str] = frozenset(), **filters: Any) -> Subscription:
+        """
+        Subscribe the running event loop, filters set to None are ignored
+        """
+        subscription = Subscription(asyncio.get_running_loop(), set(ids),
+                                    {name: value for name, value in filters.items() if value is not None},
+                                    self.max_pending)
+        with self._lock:
+            for key in subscription.ids or {None}:
+                self._subscribers.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for key in subscription.ids or {None}:
+                subscribers = self._subscribers.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[key]
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len({s for subscribers in self._subscribers.values() for s in subscribers})
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        if not self._subscribers:
+            return
+
+        event["seq"] = next(self._seq)
+        with self._lock:
+            candidates = self._subscribers.get(event["id"], set()) | self._subscribers.get(None, set())
+        by_loop: Dict[asyncio.AbstractEventLoop, List[Subscription]] = {}
+        for subscription in candidates:
+            if subscription.matches(event):
+                by_loop.setdefault(subscription.loop, []).append(subscription)
+
+        for loop, subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_deliver, subscriptions, event)
+            except RuntimeError:
+                # The event loop is closed
+                for subscription in subscriptions:
+                    self.unsubscribe(subscription)
+
+
+def _deliver(subscriptions: List[Subscription], event: Dict[str, Any]) -> None:
+    for subscription in subscriptions:
+        subscription._put(event)
+
+
+EVENTS = EventBus()
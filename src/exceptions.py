@@ -14,3 +14,13 @@ class NotFoundError(Exception):
 class DuplicateError(Exception):
     """Error for duplicate object(for example, duplicate IP)"""
     pass
+
+
+class CapacityError(Exception):
+    """Error for exhausted capacity (for example, full run queue)"""
+    pass
+
+
+class ConflictError(Exception):
+    """Error for concurrent modification (the stored version has changed)"""
+    pass
@@ -0,0 +1,68 @@
+"""
+One-shot import of the file-per-entity JSON store into SQLite
+
+    python -m src.import_json --data-dir ./data
+    CLOUDSHIFT_STORAGE=sqlite uvicorn src.rest_api.main:app
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Dict
+
+from .persistence import WorkloadRepository, MigrationTargetRepository, MigrationRepository
+from .storage import FileStorage, SqliteStorage
+
+COLLECTIONS = {
+    "workloads": WorkloadRepository,
+    "migration_targets": MigrationTargetRepository,
+    "migrations": MigrationRepository,
+}
+
+
+def import_json_tree(data_dir: Path, db_path: Path, batch_size: int = 500) -> Dict[str, int]:
+    """
+    Copy every document of the JSON tree into the SQLite database (existing ids are overwritten)
+
+    :return: Number of imported documents per collection
+    """
+    counts: Dict[str, int] = {}
+    for name, repository_cls in COLLECTIONS.items():
+        source = FileStorage(data_dir / name)
+        target = SqliteStorage(db_path, name, repository_cls.index_specs)
+
+        batch = []
+        counts[name] = 0
+        for id_obj in source.ids():
+            doc = source.read(id_obj)
+            if doc is None:
+                continue
+            batch.append((id_obj, doc))
+            if len(batch) >= batch_size:
+                target.write_many(batch)
+                counts[name] += len(batch)
+                batch = []
+        if batch:
+            target.write_many(batch)
+            counts[name] += len(batch)
+        target.close()
+
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Import the JSON data tree into SQLite")
+    parser.add_argument("--data-dir", type=Path, default=Path("./data"))
+    parser.add_argument("--db", type=Path, default=None, help="default: <data-dir>/cloudshift.db")
+    args = parser.parse_args(argv)
+
+    db_path = args.db if args.db is not None else args.data_dir / "cloudshift.db"
+    counts = import_json_tree(args.data_dir, db_path)
+    print(json.dumps({"db": str(db_path), "imported": counts}))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,36 +1,829 @@
+import copy
+import dataclasses
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import List
+from bisect import bisect_right
+from typing import List, Dict, Optional, Any, Callable, Tuple, Iterator, Sequence, Set
 
-from .exceptions import DuplicateError, NotFoundError, BusinessRuleError
-from .utils import read_json, write_json
+from .changelog import ChangeLog
+from .config import Settings
+from .events import EVENTS, DELETED, STATE, migration_event
+from .metrics import STORAGE_OPERATIONS, STORAGE_DURATION, STORAGE_BYTES_READ, STORAGE_BYTES_WRITTEN
+from .exceptions import DuplicateError, NotFoundError, BusinessRuleError, ConflictError
+from .snapshot import IndexSnapshot
+from .storage import Storage, FileStorage, SqliteStorage, IndexSpec, Signature
+from .utils import JsonCodec, detect_codec, dumps_json, get_codec
 from .core import Workload, MigrationTarget, Migration
 
 
+def _format_etag(*signatures: Optional[Signature]) -> str:
+    return '"' + "-".join("x" if sig is None else ".".join(f"{part:x}" for part in sig) for sig in signatures) + '"'
+
+
+def storage_from_settings(settings: Settings, name: str, index_specs: Sequence[IndexSpec] = ()) -> Storage:
+    """
+    Storage backend selected in the settings
+
+    :param name: Collection name: directory in the data dir or SQLite table
+    """
+    if settings.storage_backend == "sqlite":
+        return SqliteStorage(settings.sqlite_path, name, index_specs)
+    if settings.storage_backend == "json":
+        return FileStorage(settings.data_dir / name, get_codec(settings.codec), settings.shard_levels)
+    raise ValueError(f"Unknown storage backend {settings.storage_backend}")
+
+
+# Value of the secret fields in redacted raw reads
+REDACTED = "***"
+
+# Requested fields of a document: field name -> requested fields of its value, None for the whole value
+Projection = Dict[str, Optional["Projection"]]
+
+
+def parse_fields(fields: str) -> Projection:
+    """
+    Parse a list of (nested) fields like "id,state,source.ip"
+
+    :raises BusinessRuleError: If a field is empty
+    """
+    projection: Projection = {}
+    for path in fields.split(","):
+        keys = path.strip().split(".")
+        if not all(keys):
+            raise BusinessRuleError(f"Invalid field {path.strip()!r}")
+        node: Optional[Projection] = projection
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+            if node is None:
+                # The whole value is already requested
+                break
+        else:
+            node[keys[-1]] = None
+    return projection
+
+
+def project(doc: Dict[str, Any], projection: Projection) -> Dict[str, Any]:
+    """
+    Only the requested fields of a document, in the requested order (fields of list items for lists)
+    """
+    result = {}
+    for key, sub in projection.items():
+        if key not in doc:
+            continue
+        value = doc[key]
+        if sub is not None:
+            if isinstance(value, dict):
+                value = project(value, sub)
+            elif isinstance(value, list):
+                value = [project(item, sub) if isinstance(item, dict) else item for item in value]
+        result[key] = value
+    return result
+
+
+class _MemoryIndex:
+    """
+    Secondary index (value -> ids) kept in memory for backends which do not index documents themselves
+
+    Documents whose indexed value is None are not indexed.
+    """
+
+    def __init__(self, spec: IndexSpec):
+        self.spec = spec
+        self.ids_by_value: Dict[Any, Set[str]] = {}
+        self.value_by_id: Dict[str, Any] = {}
+
+    def add(self, id_obj: str, doc: dict) -> None:
+        self.set(id_obj, self.spec.extractor(doc))
+
+    def set(self, id_obj: str, value: Any) -> None:
+        old_value = self.value_by_id.get(id_obj)
+        if old_value == value and id_obj in self.value_by_id:
+            return
+        self.remove(id_obj)
+        if value is None:
+            return
+        self.ids_by_value.setdefault(value, set()).add(id_obj)
+        self.value_by_id[id_obj] = value
+
+    def remove(self, id_obj: str) -> None:
+        if id_obj not in self.value_by_id:
+            return
+        value = self.value_by_id.pop(id_obj)
+        ids = self.ids_by_value.get(value)
+        if ids is not None:
+            ids.discard(id_obj)
+            if not ids:
+                del self.ids_by_value[value]
+
+    def find(self, value: Any) -> List[str]:
+        return sorted(self.ids_by_value.get(value, ()))
+
+
 class Repository:
     """
-    Base repository class: storing each entity in a separate one .json file.
+    Base repository class: storing each entity as a document in a storage backend.
+    By default each entity is stored in a separate one .json file (FileStorage).
+
+    Deserialized entities are kept in a bounded LRU cache keyed by id.
+    A cached entity is only used while the storage signature (file mtime, size and inode) is unchanged,
+    so changes made by other processes are still seen.
+    Callers always get their own copy of the cached entity.
+
+    Every index from `index_specs` can be queried with find_ids()/query().
+    If the storage backend maintains an index itself (SQLite), it is used for lookups.
+    Otherwise the index is kept in memory and updated on create/update/delete;
+    it is built on startup and brought up to date whenever the storage was changed outside this repository.
+    Only documents whose signature changed since they were indexed are read again for that.
+    With FileStorage the in-memory indexes are persisted in the collection directory
+    (IndexSnapshot: a snapshot plus a journal of the changes since), so a restart only reads
+    the documents changed while the service was down instead of the whole collection.
+
+    With a `change_log` shared by all processes using the store, cached entities are used without
+    checking their signature: every write is appended to the log, and the log is read at most every
+    `change_log.max_staleness` seconds to forget entities changed by other processes. A read thus sees
+    the writes of other processes at most `max_staleness` seconds late. Files edited outside the service
+    are only seen by the cache after they are written through a repository or evicted.
+
+    Every write increments the `version` of the entity. update() is a compare-and-swap:
+    it only writes if the stored version is still `entity.version` (the version the caller read),
+    otherwise ConflictError is raised. Entities with `version` None are written unconditionally.
     """
+    # Stored model class
+    model: Any = None
+    # Fields which a storage backend may index (see SqliteStorage)
+    index_specs: Tuple[IndexSpec, ...] = ()
+    # Paths of the secret fields in the documents, replaced by REDACTED in redacted raw reads
+    redacted_paths: Tuple[Tuple[str, ...], ...] = ()
+
+    def __init__(self, dir: Optional[Path] = None, cache_size: int = 1024, storage: Optional[Storage] = None,
+                 change_log: Optional[ChangeLog] = None):
+        if storage is None:
+            if dir is None:
+                raise ValueError("dir or storage is required")
+            storage = FileStorage(dir)
+        self.storage = storage
+        self.dir = getattr(storage, "dir", dir)
 
-    def __init__(self, dir: Path):
-        self.dir = dir
-        self.dir.mkdir(parents=True, exist_ok=True)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Tuple[Signature, tuple, Any]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._write_seq = 0
+        self._changes = change_log
+        if self._changes is not None:
+            # Start tailing at the current end of the log
+            self._changes.poll(force=True)
 
-    def _path(self, id_obj: str):
-        return self.dir / f"{id_obj}.json"
+        self._indexes: Dict[str, _MemoryIndex] = {
+            spec.name: _MemoryIndex(spec) for spec in self.index_specs if not self.storage.has_index(spec.name)
+        }
+        self._index_lock = threading.RLock()
+        self._index_token: Any = None
+        # Signature of every indexed document when it was indexed
+        self._indexed: Dict[str, Optional[Signature]] = {}
+        self._snapshot: Optional[IndexSnapshot] = None
+        if self._indexes and isinstance(self.storage, FileStorage):
+            self._snapshot = IndexSnapshot(self.storage.dir, list(self._indexes))
+        if self._indexes:
+            self._load_indexes()
+
+    @classmethod
+    def from_settings(cls, settings: Settings, name: str, **kwargs):
+        """
+        Create a repository with the storage backend selected in the settings
+
+        :param name: Collection name: directory in the data dir or SQLite table
+        :param kwargs: Extra arguments of the repository class
+        """
+        storage = storage_from_settings(settings, name, cls.index_specs)
+        if settings.change_log:
+            kwargs.setdefault("change_log", ChangeLog(settings.data_dir / f".{name}.changes", settings.max_staleness))
+        return cls(cache_size=settings.cache_size, storage=storage, **kwargs)
 
     def delete(self, id_obj: str):
-        path = self._path(id_obj)
-        if not path.exists():
+        token = self._token_before_write()
+        start = time.perf_counter()
+        deleted = self.storage.delete(id_obj)
+        STORAGE_DURATION.observe(time.perf_counter() - start, collection=self.storage.name, op="delete")
+        STORAGE_OPERATIONS.inc(collection=self.storage.name, op="delete")
+        if not deleted:
             raise NotFoundError(f"Object {id_obj} not found")
-        path.unlink()
+        self._cache_invalidate(id_obj)
+        self._unindex(id_obj, token)
+        self._written([id_obj])
+
+    def get(self, id_obj: str) -> Any:
+        raise NotImplementedError
+
+    def _not_found(self, id_obj: str) -> NotFoundError:
+        return NotFoundError(f"Object {id_obj} not found")
+
+    # Raw documents
+    def get_raw(self, id_obj: str, redact: bool = False, single_line: bool = False,
+                projection: Optional[Projection] = None) -> bytes:
+        """
+        An entity as JSON (the content of entity.to_dict()) without building the entity:
+        stored JSON documents are returned as they are stored
+
+        :param redact: Replace the secret fields (redacted_paths) with REDACTED
+        :param single_line: The JSON has no line breaks (for NDJSON)
+        :param projection: Only these fields (see parse_fields())
+        :raises NotFoundError: If the entity does not exist
+        """
+        raw = self._read_raw(id_obj, redact, single_line, projection)
+        if raw is None:
+            raise self._not_found(id_obj)
+        return raw
+
+    def _read_raw(self, id_obj: str, redact: bool, single_line: bool,
+                  projection: Optional[Projection] = None) -> Optional[bytes]:
+        data = self._read_bytes(id_obj)
+        if data is None:
+            return None
+        if (not redact and projection is None and isinstance(detect_codec(data), JsonCodec)
+                and not (single_line and b"\n" in data) and self._is_api_document(data)):
+            return data
+
+        doc = self._api_document(self._decode(data), projection)
+        if projection is not None:
+            doc = project(doc, projection)
+        if redact:
+            self.redact(doc)
+        return dumps_json(doc)
+
+    def projection(self, fields: Optional[str]) -> Optional[Projection]:
+        """
+        Parse the `fields` of a request (see parse_fields()), None if all fields are requested
+
+        :raises BusinessRuleError: If a field is invalid or the entities have no such top-level field
+        """
+        if fields is None:
+            return None
+        projection = parse_fields(fields)
+        known = [f.name for f in dataclasses.fields(self.model)]
+        unknown = [key for key in projection if key not in known]
+        if unknown:
+            raise BusinessRuleError(f"Unknown fields {', '.join(unknown)}, expected some of {', '.join(known)}")
+        return projection
+
+    def redact(self, doc: dict) -> dict:
+        """
+        Replace the secret fields (redacted_paths) of a document in the form of entity.to_dict() with REDACTED
+        """
+        for path in self.redacted_paths:
+            parent = doc
+            for key in path[:-1]:
+                parent = parent.get(key) if isinstance(parent, dict) else None
+            if isinstance(parent, dict) and path[-1] in parent:
+                parent[path[-1]] = REDACTED
+        return doc
+
+    def _is_api_document(self, data: bytes) -> bool:
+        """
+        :return: True if the stored document is already in the form of entity.to_dict()
+        """
+        return True
+
+    def _api_document(self, doc: dict, projection: Optional[Projection] = None) -> dict:
+        """
+        Convert a stored document into the form of entity.to_dict()
+
+        :param projection: Only these fields will be used, the others may be missing
+        """
+        return doc
+
+    def iter_raw(self, after: Optional[str] = None, ids: Optional[Sequence[str]] = None,
+                 redact: bool = False, single_line: bool = False,
+                 projection: Optional[Projection] = None) -> Iterator[Tuple[str, bytes]]:
+        """
+        Like iter_all(), but the entities as JSON (see get_raw())
+        """
+        if ids is None:
+            ids = self.iter_ids(after)
+        elif after is not None:
+            ids = ids[bisect_right(ids, after):]
+
+        for id_obj in ids:
+            try:
+                raw = self._read_raw(id_obj, redact, single_line, projection)
+            except NotFoundError:
+                # A migration whose references were deleted
+                continue
+            if raw is not None:
+                yield id_obj, raw
+
+    def list_raw_page(self, limit: int, after: Optional[str] = None, ids: Optional[Sequence[str]] = None,
+                      redact: bool = False,
+                      projection: Optional[Projection] = None) -> Tuple[List[bytes], Optional[str]]:
+        """
+        Like list_page(), but the entities as JSON (see get_raw())
+        """
+        page: List[bytes] = []
+        last_id = None
+        for id_obj, raw in self.iter_raw(after, ids, redact, projection=projection):
+            if len(page) == limit:
+                return page, last_id
+            page.append(raw)
+            last_id = id_obj
+
+        return page, None
+
+    def exists(self, id_obj: str) -> bool:
+        return self.storage.exists(id_obj)
+
+    # Listing
+    def iter_ids(self, after: Optional[str] = None) -> Iterator[str]:
+        """
+        Ids of all stored entities in sorted order
+
+        :param after: Cursor, only ids greater than it are returned
+        """
+        yield from self.storage.ids(after)
+
+    def iter_all(self, after: Optional[str] = None, ids: Optional[Sequence[str]] = None) -> Iterator[Any]:
+        """
+        Lazily load entities one by one in id order (objects deleted meanwhile are skipped)
+
+        :param ids: Only load these ids (sorted), e.g. the result of query()
+        """
+        if ids is None:
+            ids = self.iter_ids(after)
+        elif after is not None:
+            ids = ids[bisect_right(ids, after):]
+
+        for id_obj in ids:
+            try:
+                yield self.get(id_obj)
+            except NotFoundError:
+                pass
+
+    def list_page(self, limit: int, after: Optional[str] = None,
+                  predicate: Optional[Callable[[Any], bool]] = None,
+                  ids: Optional[Sequence[str]] = None) -> Tuple[List[Any], Optional[str]]:
+        """
+        One page of entities for cursor-based pagination
+
+        :return: Entities and the cursor for the next page (None if it was the last page)
+        """
+        page: List[Any] = []
+        for entity in self.iter_all(after, ids):
+            if predicate is not None and not predicate(entity):
+                continue
+            if len(page) == limit:
+                return page, page[-1].id
+            page.append(entity)
+
+        return page, None
+
+    # Entity tags
+    def etag(self, id_obj: str) -> Optional[str]:
+        """
+        Entity tag of a stored entity, computed from storage signatures without reading the entity
+
+        :return: None if the entity does not exist
+        """
+        signature = self.storage.signature(id_obj)
+        if signature is None:
+            return None
+        return _format_etag(signature, *self._etag_dependencies(id_obj, signature))
+
+    def _etag_dependencies(self, id_obj: str, signature: Signature) -> tuple:
+        """
+        Signatures of other stored objects the entity is built from
+        """
+        return ()
+
+    def change_token(self) -> Any:
+        """
+        Value that changes whenever an entity is created, updated or deleted (the version of list responses)
+        """
+        if self._changes is not None:
+            return self.storage.change_token(), self._write_seq, self._changes.sequence()
+        return self.storage.change_token(), self._write_seq
+
+    def _written(self, ids: Sequence[str]) -> None:
+        with self._cache_lock:
+            self._write_seq += 1
+        if self._changes is not None:
+            self._changes.append(ids)
+
+    def _poll_changes(self, force: bool = False) -> None:
+        """
+        Forget the cached entities and index entries changed by other processes (see ChangeLog)
+        """
+        if self._changes is None:
+            return
+        changed = self._changes.poll(force)
+        if changed is None:
+            # Changes were missed
+            self.cache_clear()
+            if self._indexes:
+                self._rebuild_indexes()
+            return
+
+        for id_obj in changed:
+            self._cache_invalidate(id_obj)
+        if changed and self._indexes:
+            with self._index_lock:
+                for id_obj in changed:
+                    self._reindex(id_obj, self.storage.signature(id_obj))
+
+    # Secondary indexes
+    def _set_indexed(self, id_obj: str, signature: Optional[Signature], values: Sequence[Any]) -> None:
+        for index, value in zip(self._indexes.values(), values):
+            index.set(id_obj, value)
+        self._indexed[id_obj] = signature
+
+    def _remove_indexed(self, id_obj: str) -> None:
+        for index in self._indexes.values():
+            index.remove(id_obj)
+        self._indexed.pop(id_obj, None)
+
+    def _load_indexes(self) -> None:
+        """
+        Start from the persisted snapshot, then read only the documents changed since it was written
+        """
+        with self._index_lock:
+            if self._snapshot is not None:
+                for id_obj, (signature, values) in self._snapshot.load().items():
+                    self._set_indexed(id_obj, signature, values)
+            changed = self._rebuild_indexes()
+            if self._snapshot is not None and (changed or self._snapshot.journal_entries):
+                self._compact_indexes()
+
+    def _rebuild_indexes(self) -> int:
+        """
+        Bring the indexes up to date with the storage: documents which were added or whose signature changed
+        are read again, removed documents are unindexed
+
+        :return: Number of documents read
+        """
+        with self._index_lock:
+            token = self.storage.change_token()
+            current = self.storage.signatures()
+            for id_obj in [id_obj for id_obj in self._indexed if id_obj not in current]:
+                self._remove_indexed(id_obj)
+
+            changed = 0
+            for id_obj, signature in current.items():
+                if self._reindex(id_obj, signature):
+                    changed += 1
+            self._index_token = token
+            return changed
+
+    def _reindex(self, id_obj: str, signature: Optional[Signature]) -> bool:
+        """
+        Read a document again if its current signature differs from the indexed one
+
+        :return: True if the document was read
+        """
+        if signature is None:
+            self._remove_indexed(id_obj)
+            return False
+        if self._indexed.get(id_obj) == signature:
+            return False
+
+        doc = self._read_json(id_obj)
+        if doc is None:
+            self._remove_indexed(id_obj)
+        else:
+            # If the document changed again after the signature was taken, it differs on the next check
+            self._set_indexed(id_obj, signature, [index.spec.extractor(doc) for index in self._indexes.values()])
+        return True
+
+    def _compact_indexes(self) -> None:
+        """
+        Persist the current indexes as a new snapshot
+        """
+        with self._index_lock:
+            entries = {id_obj: (signature, [index.value_by_id.get(id_obj) for index in self._indexes.values()])
+                       for id_obj, signature in self._indexed.items() if signature is not None}
+            up_to_date = self.storage.change_token() == self._index_token
+            self._snapshot.compact(entries)
+            if up_to_date:
+                # Replacing the snapshot file changes the directory, not the documents
+                self._index_token = self.storage.change_token()
+
+    def _sync_indexes(self) -> None:
+        """
+        Update the indexes if another process (or a manual edit) changed the storage
+        """
+        if self.storage.change_token() != self._index_token:
+            self._rebuild_indexes()
+
+    def _token_before_write(self) -> Any:
+        """
+        Change token of the storage before a write, see _advance_index_token()
+        """
+        return self.storage.change_token() if self._indexes else None
+
+    def _advance_index_token(self, before: Any) -> None:
+        """
+        After this process indexed its own write: the indexes are still up to date with the storage
+        if nothing else changed it before the write (`before`), otherwise the change token is kept
+        so that the next lookup reads the changes of other processes
+        """
+        if before == self._index_token:
+            self._index_token = self.storage.change_token()
+
+    def _index(self, items: Sequence[Tuple[str, dict, Optional[Signature]]], token_before: Any) -> None:
+        if not self._indexes:
+            return
+        with self._index_lock:
+            journal = []
+            for id_obj, doc, signature in items:
+                values = [index.spec.extractor(doc) for index in self._indexes.values()]
+                self._set_indexed(id_obj, signature, values)
+                if signature is not None:
+                    journal.append((id_obj, signature, values))
+            self._advance_index_token(token_before)
+            if self._snapshot is not None:
+                self._snapshot.record_writes(journal)
+                if self._snapshot.needs_compaction():
+                    self._sync_indexes()
+                    self._compact_indexes()
+
+    def _unindex(self, id_obj: str, token_before: Any) -> None:
+        if not self._indexes:
+            return
+        with self._index_lock:
+            self._remove_indexed(id_obj)
+            self._advance_index_token(token_before)
+            if self._snapshot is not None:
+                self._snapshot.record_delete(id_obj)
+
+    def find_ids(self, index: str, value: Any) -> List[str]:
+        """
+        Sorted ids of the entities with the given value of an index, without reading other entities
+
+        :raises ValueError: If the repository has no such index
+        """
+        ids = self.storage.find(index, value)
+        if ids is not None:
+            return ids
+        if index not in self._indexes:
+            raise ValueError(f"Unknown index {index}")
+
+        self._poll_changes()
+        with self._index_lock:
+            self._sync_indexes()
+            return self._indexes[index].find(value)
+
+    def query(self, **filters: Any) -> Optional[List[str]]:
+        """
+        Sorted ids of the entities matching all filters (index name -> value), filters set to None are ignored
+
+        :return: None if no filter is set
+        """
+        result: Optional[Set[str]] = None
+        for index, value in filters.items():
+            if value is None:
+                continue
+            ids = set(self.find_ids(index, value))
+            result = ids if result is None else result & ids
+            if not result:
+                break
+
+        return sorted(result) if result is not None else None
+
+    # Cache
+    def _dependencies(self, entity: Any) -> tuple:
+        """
+        Signatures of other stored objects the cached entity was built from.
+        The cached entity is only used while they are unchanged.
+        """
+        return ()
 
-    @staticmethod
-    def _read_json(path: Path) -> dict:
-        return read_json(path)
+    def _cache_put(self, id_obj: str, signature: Signature, entity: Any) -> None:
+        if self.cache_size <= 0:
+            return
+        dependencies = self._dependencies(entity)
+        with self._cache_lock:
+            self._cache[id_obj] = (signature, dependencies, entity)
+            self._cache.move_to_end(id_obj)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
 
-    @staticmethod
-    def _write_json(path: Path, obj: dict) -> None:
-        return write_json(path, obj)
+    def _cache_get(self, id_obj: str, signature: Optional[Signature]) -> Optional[Any]:
+        """
+        :param signature: Current signature of the document, None to use the cached entity without checking it
+        """
+        with self._cache_lock:
+            cached = self._cache.get(id_obj)
+        if (cached is None or (signature is not None and cached[0] != signature)
+                or (cached[1] and self._dependencies(cached[2]) != cached[1])):
+            self.cache_misses += 1
+            return None
+
+        with self._cache_lock:
+            self.cache_hits += 1
+            if id_obj in self._cache:
+                self._cache.move_to_end(id_obj)
+        return cached[2]
+
+    def _cache_invalidate(self, id_obj: str) -> None:
+        with self._cache_lock:
+            self._cache.pop(id_obj, None)
+
+    def cache_clear(self) -> None:
+        with self._cache_lock:
+            self._cache.clear()
+
+    def cache_stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self._cache),
+            "max_size": self.cache_size,
+        }
+
+    def _load(self, id_obj: str, from_dict: Callable[[dict], Any]) -> Optional[Any]:
+        """
+        Read an entity through the cache
+
+        :return: A copy of the entity or None if it does not exist
+        """
+        if self._changes is not None:
+            # Changes of other processes are applied from the log, the cached entity is up to date
+            self._poll_changes()
+            entity = self._cache_get(id_obj, None)
+            if entity is not None:
+                return copy.deepcopy(entity)
+
+        signature = self.storage.signature(id_obj)
+        if signature is None:
+            self._cache_invalidate(id_obj)
+            return None
+
+        if self._changes is None:
+            entity = self._cache_get(id_obj, signature)
+            if entity is not None:
+                return copy.deepcopy(entity)
+
+        obj = self._read_json(id_obj)
+        if obj is None:
+            self._cache_invalidate(id_obj)
+            return None
+        entity = from_dict(obj)
+        self._cache_put(id_obj, signature, entity)
+
+        return copy.deepcopy(entity)
+
+    def _store(self, entity: Any, expected_version: Optional[int] = None) -> None:
+        """
+        Write an entity and put a copy of it into the cache (write-through)
+
+        :param expected_version: Only write if the stored version is still this one (None: always write)
+        :raises ConflictError: If the stored version differs, the entity is not written
+        """
+        doc = self._to_document(entity)
+        token = self._token_before_write()
+        try:
+            signature = self._write_json(entity.id, doc, expected_version)
+        except ConflictError:
+            # The cached entity may be the outdated one
+            self._cache_invalidate(entity.id)
+            raise
+        entity.version = doc["version"]
+        self._index([(entity.id, doc, signature)], token)
+        self._written([entity.id])
+        if signature is not None:
+            self._cache_put(entity.id, signature, copy.deepcopy(entity))
+
+    def _store_many(self, entities: Sequence[Any], check_versions: bool = False) -> List[Optional[ConflictError]]:
+        """
+        Write a batch of entities with one storage call (one transaction for SQLite)
+
+        :param check_versions: Only write the entities whose stored version is still `entity.version`
+        :return: For every entity, None or the ConflictError which rejected it
+        """
+        if not entities:
+            return []
+        items = [(entity.id, self._to_document(entity), entity.version if check_versions else None)
+                 for entity in entities]
+        token = self._token_before_write()
+        results = self._write_documents(items)
+
+        errors: List[Optional[ConflictError]] = []
+        written = []
+        for entity, (id_obj, doc, _), result in zip(entities, items, results):
+            if isinstance(result, ConflictError):
+                errors.append(result)
+                self._cache_invalidate(id_obj)
+                continue
+            errors.append(None)
+            entity.version = doc["version"]
+            written.append((id_obj, doc, result))
+            self._cache_put(id_obj, result, copy.deepcopy(entity))
+        self._index(written, token)
+        self._written([id_obj for id_obj, _, _ in written])
+
+        return errors
+
+    # Bulk
+    def _check_create(self, entity: Any, batch: Dict[str, Any]) -> None:
+        """
+        Validate an entity before it is created
+
+        :param batch: Scratch space shared by the entities of one batch
+        """
+        pass
+
+    def _check_update(self, entity: Any) -> None:
+        """
+        Validate an entity before it is updated
+        """
+        if not self.exists(entity.id):
+            raise NotFoundError(f"Object {entity.id} not found")
+
+    def create_many(self, entities: Sequence[Any]) -> List[Any]:
+        """
+        Create a batch of entities: every entity is validated, the valid ones are written together
+
+        :return: For every entity, the created entity or the error which rejected it
+        """
+        return self._write_batch(entities, self._check_create, check_versions=False)
+
+    def update_many(self, entities: Sequence[Any]) -> List[Any]:
+        """
+        Update a batch of entities: every entity is validated, the valid ones are written together.
+        Versions are checked like in update().
+
+        :return: For every entity, the updated entity or the error which rejected it
+        """
+        return self._write_batch(entities, lambda entity, _: self._check_update(entity), check_versions=True)
+
+    def _write_batch(self, entities: Sequence[Any], check: Callable[[Any, Dict[str, Any]], None],
+                     check_versions: bool) -> List[Any]:
+        results: List[Any] = []
+        accepted: List[int] = []
+        batch: Dict[str, Any] = {}
+        seen_ids = set()
+        for entity in entities:
+            try:
+                if entity.id in seen_ids:
+                    raise DuplicateError(f"Object {entity.id} is repeated in the batch")
+                check(entity, batch)
+            except (DuplicateError, BusinessRuleError, NotFoundError) as e:
+                results.append(e)
+                continue
+            seen_ids.add(entity.id)
+            accepted.append(len(results))
+            results.append(entity)
+
+        errors = self._store_many([results[i] for i in accepted], check_versions)
+        for i, error in zip(accepted, errors):
+            if error is not None:
+                results[i] = error
+
+        return results
+
+    def _to_document(self, entity: Any) -> dict:
+        return entity.to_dict()
+
+    def _from_document(self, data: dict) -> Any:
+        # Documents are written by the repositories, validation is skipped
+        return self.model.from_dict(data, trusted=True)
+
+    # Storage I/O, instrumented for /metrics
+    def _read_json(self, id_obj: str) -> Optional[dict]:
+        data = self._read_bytes(id_obj)
+        return self._decode(data) if data is not None else None
+
+    def _read_bytes(self, id_obj: str) -> Optional[bytes]:
+        collection = self.storage.name
+        start = time.perf_counter()
+        data = self.storage.read_bytes(id_obj)
+        STORAGE_DURATION.observe(time.perf_counter() - start, collection=collection, op="read")
+        STORAGE_OPERATIONS.inc(collection=collection, op="read")
+        if data is not None:
+            STORAGE_BYTES_READ.inc(len(data), collection=collection)
+        return data
+
+    def _decode(self, data: bytes) -> dict:
+        start = time.perf_counter()
+        doc = self.storage.decode(data)
+        STORAGE_DURATION.observe(time.perf_counter() - start, collection=self.storage.name, op="decode")
+        return doc
+
+    def _write_json(self, id_obj: str, obj: dict, expected_version: Optional[int] = None) -> Optional[Signature]:
+        result = self._write_documents([(id_obj, obj, expected_version)])[0]
+        if isinstance(result, ConflictError):
+            raise result
+        return result
+
+    def _write_documents(self, items: Sequence[Tuple[str, dict, Optional[int]]]) -> List[Any]:
+        collection = self.storage.name
+        start = time.perf_counter()
+        results = self.storage.compare_and_write(items)
+        STORAGE_DURATION.observe(time.perf_counter() - start, collection=collection, op="write")
+        STORAGE_OPERATIONS.inc(len(items), collection=collection, op="write")
+        STORAGE_BYTES_WRITTEN.inc(sum(result[1] for result in results if isinstance(result, tuple)),
+                                  collection=collection)
+        return results
 
 
 class WorkloadRepository(Repository):
@@ -38,45 +831,70 @@ class WorkloadRepository(Repository):
     CRUD for Workload
     Unique index of IP and the prohibition of changing the IP during the update
     """
+    model = Workload
+    index_specs = (IndexSpec("ip", lambda doc: doc["ip"], unique=True),)
+    redacted_paths = (("credentials", "password"),)
+
+    def _not_found(self, id_obj: str) -> NotFoundError:
+        return NotFoundError(f"File {id_obj} not found")
+
+    def _lookup_ip(self, ip: str) -> Optional[str]:
+        ids = self.find_ids("ip", ip)
+        id_obj = ids[0] if ids else None
+        if id_obj is not None and not self.storage.exists(id_obj):
+            # Drift: the indexed file is gone
+            self._rebuild_indexes()
+            ids = self.find_ids("ip", ip)
+            id_obj = ids[0] if ids else None
+
+        return id_obj
+
+    def find_by_ip(self, ip: str) -> Workload:
+        id_obj = self._lookup_ip(ip)
+        if id_obj is None:
+            raise NotFoundError(f"Workload with ip {ip} not found")
+
+        workload = self.get(id_obj)
+        if workload.ip != ip:
+            # Drift: the file was rewritten with another IP
+            self._rebuild_indexes()
+            return self.find_by_ip(ip)
+
+        return workload
 
     def list_all(self) -> List[Workload]:
-        result: List[Workload] = []
-        for filename in self.dir.iterdir():
-            if filename.is_file() and filename.suffix == ".json":
-                try:
-                    result.append(self.get(filename.stem))
-                except NotFoundError:
-                    pass
+        return list(self.iter_all())
 
-        return result
+    def _check_create(self, workload: Workload, batch: Dict[str, Any]) -> None:
+        batch_ips = batch.setdefault("ips", set())
+        if workload.ip in batch_ips or self._lookup_ip(workload.ip) is not None:
+            raise DuplicateError(f"Workload {workload.ip} {workload.id} already exists")
+        batch_ips.add(workload.ip)
+
+    def _check_update(self, workload: Workload) -> None:
+        curr = self.get(workload.id)
+        if workload.ip != curr.ip:
+            raise BusinessRuleError("Ip cannot be changed for existing workload")
 
     # CRUD
     def create(self, workload: Workload) -> Workload:
-        for existing in self.list_all():
-            if existing.ip == workload.ip:
-                raise DuplicateError(f"Workload {workload.ip} {workload.id} already exists")
+        self._check_create(workload, {})
 
-        path = self._path(workload.id)
-        self._write_json(path, workload.to_dict())
+        self._store(workload)
 
         return workload
 
     def get(self, id_obj) -> Workload:
-        path = self._path(id_obj)
-        if not path.exists():
-            raise NotFoundError(f"File {id_obj} not found")
-
-        obj = self._read_json(path)
+        workload = self._load(id_obj, self._from_document)
+        if workload is None:
+            raise self._not_found(id_obj)
 
-        return Workload.from_dict(obj)
+        return workload
 
     def update(self, workload: Workload) -> Workload:
-        curr = self.get(workload.id)
-        if workload.ip != curr.ip:
-            raise BusinessRuleError("Ip cannot be changed for existing workload")
+        self._check_update(workload)
 
-        path = self._path(workload.id)
-        self._write_json(path, workload.to_dict())
+        self._store(workload, workload.version)
 
         return workload
 
@@ -85,81 +903,244 @@ class MigrationTargetRepository(Repository):
     """
     CRUD for Migration Targets
     """
+    model = MigrationTarget
+    index_specs = (IndexSpec("cloud_type", lambda doc: doc["cloud_type"]),)
+    redacted_paths = (("cloud_credentials", "password"), ("target_vm", "credentials", "password"))
 
-    def list_all(self) -> List[MigrationTarget]:
-        result: List[MigrationTarget] = []
-
-        for filename in self.dir.iterdir():
-            if filename.is_file() and filename.suffix == ".json":
-                try:
-                    result.append(self.get(filename.stem))
-                except NotFoundError:
-                    pass
+    def _not_found(self, id_obj: str) -> NotFoundError:
+        return NotFoundError(f"MigrationTarget {id_obj} not found")
 
-        return result
+    def list_all(self) -> List[MigrationTarget]:
+        return list(self.iter_all())
 
     # CRUD
     def create(self, target: MigrationTarget) -> MigrationTarget:
-        path = self._path(target.id)
-        self._write_json(path, target.to_dict())
+        self._store(target)
 
         return target
 
     def get(self, id_obj: str) -> MigrationTarget:
-        path = self._path(id_obj)
-        if not path.exists():
-            raise NotFoundError(f"MigrationTarget {id_obj} not found")
+        target = self._load(id_obj, self._from_document)
+        if target is None:
+            raise self._not_found(id_obj)
 
-        obj = self._read_json(path)
+        return target
 
-        return MigrationTarget.from_dict(obj)
+    def _check_update(self, target: MigrationTarget) -> None:
+        if not self.exists(target.id):
+            raise NotFoundError(f"MigrationTarget {target.id} not found")
 
     def update(self, target: MigrationTarget) -> MigrationTarget:
-        path = self._path(target.id)
-        if not path.exists():
-            raise NotFoundError(f"MigrationTarget {target.id} not found")
+        self._check_update(target)
+
+        self._store(target, target.version)
 
-        return self.create(target)
+        return target
 
 
 class MigrationRepository(Repository):
     """
     CRUD for Migration Repository
+
+    By default a migration is stored with full copies of its source and migration target.
+    If a workload and a migration target repository are given, migrations are stored with
+    `source_id`/`migration_target_id` references instead, resolved through those repositories on load,
+    so updates of the workload or target are seen by the migration.
+    Migrations stored with full copies are still read in this mode.
+
+    Every stored migration is published to the event bus (EVENTS) for the status streams.
+
+    Migrations are indexed by state, source workload, migration target and cloud type.
+    Migrations stored by reference carry no cloud type, for them the cloud type
+    is resolved through the cloud type index of the migration target repository.
     """
+    model = Migration
+    index_specs = (
+        IndexSpec("state", lambda doc: doc["state"]),
+        IndexSpec("source_id", lambda doc: doc["source_id"] if "source_id" in doc else doc["source"]["id"]),
+        IndexSpec("migration_target_id", lambda doc: doc["migration_target_id"] if "migration_target_id" in doc
+                  else doc["migration_target"]["id"]),
+        IndexSpec("cloud_type", lambda doc: doc["migration_target"]["cloud_type"] if "migration_target" in doc
+                  else None),
+    )
+    redacted_paths = (
+        ("source", "credentials", "password"),
+        ("migration_target", "cloud_credentials", "password"),
+        ("migration_target", "target_vm", "credentials", "password"),
+    )
 
-    def list_all(self) -> List[Migration]:
-        result: List[Migration] = []
+    def __init__(self, dir: Optional[Path] = None, cache_size: int = 1024, storage: Optional[Storage] = None,
+                 workload_repository: Optional[WorkloadRepository] = None,
+                 migration_target_repository: Optional[MigrationTargetRepository] = None,
+                 change_log: Optional[ChangeLog] = None):
+        super().__init__(dir, cache_size, storage, change_log)
+        if (workload_repository is None) != (migration_target_repository is None):
+            raise ValueError("workload_repository and migration_target_repository should be given together")
+        self.workload_repository = workload_repository
+        self.migration_target_repository = migration_target_repository
+
+    @property
+    def stores_references(self) -> bool:
+        return self.workload_repository is not None
+
+    # References
+    def _to_document(self, migration: Migration) -> dict:
+        if self.stores_references:
+            return migration.to_ref_dict()
+        return migration.to_dict()
+
+    def _from_document(self, data: dict) -> Migration:
+        if "source_id" not in data:
+            return Migration.from_dict(data, trusted=True)
+        if not self.stores_references:
+            raise BusinessRuleError(f"Migration {data.get('id')} is stored by reference, "
+                                    f"repositories to resolve it are not configured")
 
-        for filename in self.dir.iterdir():
-            if filename.is_file() and filename.suffix == ".json":
-                try:
-                    result.append(self.get(filename.stem))
-                except NotFoundError:
-                    pass
+        try:
+            source = self.workload_repository.get(data["source_id"])
+            migration_target = self.migration_target_repository.get(data["migration_target_id"])
+        except NotFoundError as e:
+            raise NotFoundError(f"Migration {data.get('id')} references a missing object: {e}")
 
+        return Migration.from_ref_dict(data, source, migration_target, trusted=True)
+
+    def _not_found(self, id_obj: str) -> NotFoundError:
+        return NotFoundError(f"Migration {id_obj} not found")
+
+    def _is_api_document(self, data: bytes) -> bool:
+        # Migrations stored by reference are returned with full copies
+        return b'"source_id"' not in data
+
+    def _api_document(self, doc: dict, projection: Optional[Projection] = None) -> dict:
+        if "source_id" not in doc:
+            return doc
+        if (projection is None or not self.stores_references
+                or ("source" in projection and "migration_target" in projection)):
+            return self._from_document(doc).to_dict()
+
+        # Only the requested references are read
+        result = {key: value for key, value in doc.items() if key not in ("source_id", "migration_target_id")}
+        try:
+            if "source" in projection:
+                result["source"] = self.workload_repository.get(doc["source_id"]).to_dict()
+            if "migration_target" in projection:
+                result["migration_target"] = self.migration_target_repository.get(doc["migration_target_id"]).to_dict()
+        except NotFoundError as e:
+            raise NotFoundError(f"Migration {doc.get('id')} references a missing object: {e}")
         return result
 
+    def _dependencies(self, migration: Migration) -> tuple:
+        if not self.stores_references:
+            return ()
+        return (self.workload_repository.storage.signature(migration.source.id),
+                self.migration_target_repository.storage.signature(migration.migration_target.id))
+
+    def _etag_dependencies(self, id_obj: str, signature: Signature) -> tuple:
+        if not self.stores_references:
+            return ()
+        migration = self._cache_get(id_obj, signature)
+        if migration is None:
+            try:
+                migration = self.get(id_obj)
+            except NotFoundError:
+                return ()
+        return self._dependencies(migration)
+
+    def change_token(self) -> Any:
+        token = super().change_token()
+        if self.stores_references:
+            token += (self.workload_repository.change_token(), self.migration_target_repository.change_token())
+        return token
+
+    def _check_references(self, migration: Migration) -> None:
+        if not self.stores_references:
+            return
+        if not self.workload_repository.exists(migration.source.id):
+            raise NotFoundError(f"Workload {migration.source.id} not found")
+        if not self.migration_target_repository.exists(migration.migration_target.id):
+            raise NotFoundError(f"MigrationTarget {migration.migration_target.id} not found")
+
+    def save_target_vm(self, migration: Migration) -> None:
+        """
+        Running a migration changes its target VM: in reference mode it is saved to the stored
+        MigrationTarget (only the target VM, the rest of the target is kept), with full copies
+        it was already saved with the migration. Creating or updating a migration never writes its target.
+        """
+        if not self.stores_references:
+            return
+        target_vm = migration.migration_target.target_vm
+        while True:
+            try:
+                target = self.migration_target_repository.get(migration.migration_target.id)
+            except NotFoundError:
+                # Deleted meanwhile
+                return
+            if target.target_vm.to_dict() == target_vm.to_dict():
+                return
+            target.target_vm = target_vm
+            try:
+                self.migration_target_repository.update(target)
+                return
+            except ConflictError:
+                # Changed meanwhile: apply the target VM to the stored version
+                continue
+
+    def _store(self, migration: Migration, expected_version: Optional[int] = None) -> None:
+        super()._store(migration, expected_version)
+        EVENTS.publish(migration_event(STATE, migration, version=migration.version))
+
+    def _store_many(self, migrations: Sequence[Migration],
+                    check_versions: bool = False) -> List[Optional[ConflictError]]:
+        errors = super()._store_many(migrations, check_versions)
+        for migration, error in zip(migrations, errors):
+            if error is None:
+                EVENTS.publish(migration_event(STATE, migration, version=migration.version))
+        return errors
+
+    def delete(self, id_obj: str):
+        super().delete(id_obj)
+        EVENTS.publish({"type": DELETED, "id": id_obj})
+
+    def list_all(self) -> List[Migration]:
+        return list(self.iter_all())
+
+    def find_ids(self, index: str, value: Any) -> List[str]:
+        ids = super().find_ids(index, value)
+        if index == "cloud_type" and self.stores_references:
+            by_target = [id_obj
+                         for target_id in self.migration_target_repository.find_ids("cloud_type", value)
+                         for id_obj in Repository.find_ids(self, "migration_target_id", target_id)]
+            if by_target:
+                ids = sorted(set(ids).union(by_target))
+
+        return ids
+
     # CRUD
+    def _check_create(self, migration: Migration, batch: Dict[str, Any]) -> None:
+        self._check_references(migration)
+
     def create(self, migration: Migration) -> Migration:
-        path = self._path(migration.id)
-        self._write_json(path, migration.to_dict())
+        self._check_create(migration, {})
+
+        self._store(migration)
 
         return migration
 
     def get(self, id_obj: str) -> Migration:
-        path = self._path(id_obj)
-        if not path.exists():
-            raise NotFoundError(f"Migration {id_obj} not found")
+        migration = self._load(id_obj, self._from_document)
+        if migration is None:
+            raise self._not_found(id_obj)
 
-        obj = self._read_json(path)
+        return migration
 
-        return Migration.from_dict(obj)
+    def _check_update(self, migration: Migration) -> None:
+        if not self.exists(migration.id):
+            raise NotFoundError(f"Migration {migration.id} not found")
+        self._check_references(migration)
 
     def update(self, migration: Migration) -> Migration:
-        path = self._path(migration.id)
-        if not path.exists():
-            raise NotFoundError(f"Migration {migration.id} not found")
+        self._check_update(migration)
 
-        self._write_json(path, migration.to_dict())
+        self._store(migration, migration.version)
 
         return migration
@@ -0,0 +1,45 @@
+"""
+Move the JSON store to another directory layout while the service is running
+
+    python -m src.reshard --data-dir ./data --levels 2
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Dict, Sequence
+
+from .storage import FileStorage
+
+COLLECTIONS = ("workloads", "migration_targets", "migrations", "migration_progress")
+
+
+def reshard_tree(data_dir: Path, levels: int, collections: Sequence[str] = COLLECTIONS) -> Dict[str, int]:
+    """
+    Move the documents of every existing collection into `levels` levels of shard directories (0: flat)
+
+    :return: Number of moved documents per collection
+    """
+    counts: Dict[str, int] = {}
+    for name in collections:
+        if (data_dir / name).is_dir():
+            counts[name] = FileStorage(data_dir / name).reshard(levels)
+
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Move the JSON data tree to another directory layout")
+    parser.add_argument("--data-dir", type=Path, default=Path("./data"))
+    parser.add_argument("--levels", type=int, required=True, help="levels of id-prefix subdirectories, 0 - flat")
+    args = parser.parse_args(argv)
+
+    counts = reshard_tree(args.data_dir, args.levels)
+    print(json.dumps({"levels": args.levels, "moved": counts}))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""Shared helpers for the bulk endpoints: per-item validation and results"""
+
+from typing import Any, Callable, Dict, List
+
+from fastapi import HTTPException
+
+from src import BusinessRuleError, ConflictError, DuplicateError, NotFoundError
+from src.persistence import Repository
+
+MAX_BULK_SIZE = 10000
+
+
+def _error_status(error: Exception) -> int:
+    if isinstance(error, DuplicateError):
+        return 400
+    if isinstance(error, NotFoundError):
+        return 404
+    if isinstance(error, ConflictError):
+        return 409
+    return 422
+
+
+def bulk_write(repository: Repository, items: List[Dict[str, Any]],
+               build: Callable[[Dict[str, Any]], Any], update: bool = False) -> Dict[str, Any]:
+    """
+    Build entities from a batch of dicts and create (or update) the valid ones with one repository call
+
+    :param build: Builds the entity from one item, may raise BusinessRuleError for invalid items
+    :return: Per-item results in the order of the items and the counts of written and failed items
+    """
+    if len(items) > MAX_BULK_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_SIZE} items per request")
+
+    results: List[Dict[str, Any]] = [{} for _ in items]
+    entities: List[Any] = []
+    positions: List[int] = []
+    for index, item in enumerate(items):
+        try:
+            entity = build(item)
+        except BusinessRuleError as e:
+            results[index] = {"index": index, "status": 422, "error": str(e)}
+            continue
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results[index] = {"index": index, "status": 422, "error": f"Invalid item: {e!r}"}
+            continue
+        entities.append(entity)
+        positions.append(index)
+
+    written = repository.update_many(entities) if update else repository.create_many(entities)
+    for index, result in zip(positions, written):
+        if isinstance(result, Exception):
+            results[index] = {"index": index, "status": _error_status(result), "error": str(result)}
+        else:
+            results[index] = {"index": index, "status": 200 if update else 201, "id": result.id}
+
+    failed = sum(1 for result in results if "error" in result)
+    return {"written": len(results) - failed, "failed": failed, "results": results}
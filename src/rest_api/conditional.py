@@ -0,0 +1,115 @@
+"""Conditional requests: ETag, If-None-Match (304 Not Modified) and If-Match (412 Precondition Failed)"""
+
+from hashlib import blake2b
+from typing import List, Optional
+
+from fastapi import HTTPException, Request, Response
+
+from src import BusinessRuleError, NotFoundError
+from src.persistence import Projection, Repository
+
+
+def _parse(header: str) -> List[str]:
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def _opaque(tag: str) -> str:
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def etag_matches(header: Optional[str], etag: Optional[str], weak: bool = True) -> bool:
+    """
+    :param header: Value of If-None-Match (weak comparison) or If-Match (strong comparison)
+    """
+    if not header or etag is None:
+        return False
+
+    tags = _parse(header)
+    if "*" in tags:
+        return True
+    if weak:
+        return _opaque(etag) in {_opaque(tag) for tag in tags}
+    return not etag.startswith("W/") and etag in tags
+
+
+def not_modified(etag: Optional[str], if_none_match: Optional[str]) -> Optional[Response]:
+    """
+    :return: 304 response if the client already has this version, otherwise None
+    """
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def _precondition_failed() -> HTTPException:
+    return HTTPException(status_code=412, detail="Object was changed, fetch it again")
+
+
+def expected_version(repository: Repository, id_obj: str, if_match: Optional[str]) -> Optional[int]:
+    """
+    Translate If-Match into the entity version the update is based on,
+    so that the check is done by the compare-and-swap of the repository
+
+    :return: None if If-Match is not sent
+    :raises HTTPException: 412 if If-Match does not match the current version
+    """
+    if if_match is None:
+        return None
+
+    etag = repository.etag(id_obj)
+    if not etag_matches(if_match, etag, weak=False):
+        raise _precondition_failed()
+    try:
+        version = repository.get(id_obj).version
+    except NotFoundError:
+        raise _precondition_failed()
+    if repository.etag(id_obj) != etag:
+        # Changed between the check and the read
+        raise _precondition_failed()
+
+    return version
+
+
+def list_etag(repository: Repository, request: Request) -> str:
+    """
+    Version of a list response: the store-wide change token and the query
+    """
+    key = f"{request.url.path}?{request.url.query}|{repository.change_token()!r}"
+    return '"' + blake2b(key.encode("utf-8"), digest_size=16).hexdigest() + '"'
+
+
+def request_projection(repository: Repository, fields: Optional[str]) -> Optional[Projection]:
+    """
+    Parse the `fields` query parameter, None if all fields are requested
+
+    :raises HTTPException: 422 if a field is invalid
+    """
+    try:
+        return repository.projection(fields)
+    except BusinessRuleError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def document_response(repository: Repository, id_obj: str, if_none_match: Optional[str],
+                      redact: bool = False, fields: Optional[str] = None) -> Response:
+    """
+    GET of one entity: 304 if the client has the current version, otherwise the stored JSON document
+    sent as it is (see Repository.get_raw()), without building the entity
+
+    :param fields: Only these fields (see parse_fields()), each selection has its own ETag
+    :raises HTTPException: 404 if the entity does not exist, 422 if a field is invalid
+    """
+    projection = request_projection(repository, fields)
+    etag = repository.etag(id_obj)
+    if etag is not None and fields is not None:
+        etag = etag[:-1] + "." + blake2b(fields.encode("utf-8"), digest_size=8).hexdigest() + '"'
+    unchanged = not_modified(etag, if_none_match)
+    if unchanged is not None:
+        return unchanged
+
+    try:
+        data = repository.get_raw(id_obj, redact, projection=projection)
+    except NotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    return Response(data, media_type="application/json", headers={"ETag": etag})
@@ -0,0 +1,124 @@
+"""Shared helpers for the list endpoints: cursor pagination, NDJSON streaming and the response cache"""
+
+from enum import Enum
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from src import Settings
+from src.metrics import LIST_CACHE_REQUESTS
+from src.persistence import Projection, Repository, project
+from src.utils import dumps_json
+from .conditional import list_etag, not_modified, request_projection
+from .response_cache import ResponseCache, gzip_etag
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_PAGE_SIZE = 1000
+
+LIST_CACHE = ResponseCache(Settings.from_env().list_cache_bytes)
+
+
+class ListFormat(str, Enum):
+    JSON = "json"
+    NDJSON = "ndjson"
+
+
+def _iter_filtered(repository: Repository, after: Optional[str], limit: Optional[int],
+                   predicate: Optional[Callable[[Any], bool]], ids: Optional[Sequence[str]]) -> Iterator[Any]:
+    count = 0
+    for entity in repository.iter_all(after, ids):
+        if limit is not None and count >= limit:
+            return
+        if predicate is not None and not predicate(entity):
+            continue
+        count += 1
+        yield entity
+
+
+def list_response(repository: Repository, request: Request,
+                  limit: Optional[int], after: Optional[str],
+                  output_format: ListFormat, predicate: Optional[Callable[[Any], bool]] = None,
+                  filters: Optional[Dict[str, Any]] = None, redact: bool = False, fields: Optional[str] = None):
+    """
+    Build the body of a list endpoint
+
+    Without `limit` the whole (filtered) collection is returned as before.
+    With `limit` one page is returned and the cursor of the next page is sent in the X-Next-Cursor header.
+    `filters` (index name -> value) are looked up with Repository.query(), so only the matching entities are read.
+    In NDJSON mode entities are streamed one per line while they are read from the repository.
+    Without `predicate` the stored JSON documents are joined into the body (see Repository.get_raw()),
+    the entities are only built to be tested by `predicate`.
+    The ETag changes with every write to the collection, If-None-Match is answered
+    with 304 before any entity is read.
+    JSON bodies are kept in LIST_CACHE until the ETag changes and sent gzip-compressed
+    to the clients accepting it.
+
+    :param redact: Replace the secret fields with REDACTED
+    :param fields: Only these fields of every entity (see parse_fields())
+    """
+    projection = request_projection(repository, fields)
+    etag = list_etag(repository, request)
+    if_none_match = request.headers.get("if-none-match")
+    # Either representation of this version (uncompressed or gzip-compressed)
+    unchanged = not_modified(etag, if_none_match) or not_modified(gzip_etag(etag), if_none_match)
+    if unchanged is not None:
+        return unchanged
+
+    if output_format == ListFormat.NDJSON:
+        ids = repository.query(**filters) if filters else None
+        return StreamingResponse(_ndjson_lines(repository, limit, after, predicate, ids, redact, projection),
+                                 media_type="application/x-ndjson", headers={"ETag": etag})
+
+    key = (id(repository), request.url.path, request.url.query)
+    entry = LIST_CACHE.get(key, etag)
+    LIST_CACHE_REQUESTS.inc(result="hit" if entry is not None else "miss")
+    if entry is None:
+        ids = repository.query(**filters) if filters else None
+        if predicate is None:
+            page, next_cursor = _raw_page(repository, limit, after, ids, redact, projection)
+        else:
+            page, next_cursor = _entity_page(repository, limit, after, predicate, ids, redact, projection)
+        headers = {"ETag": etag}
+        if next_cursor is not None:
+            headers[NEXT_CURSOR_HEADER] = next_cursor
+        entry = LIST_CACHE.put(key, etag, b"[" + b",".join(page) + b"]", headers)
+
+    return LIST_CACHE.response(key, entry, request.headers.get("accept-encoding"))
+
+
+def _entity_dict(repository: Repository, entity: Any, redact: bool, projection: Optional[Projection]) -> dict:
+    doc = entity.to_dict()
+    if projection is not None:
+        doc = project(doc, projection)
+    return repository.redact(doc) if redact else doc
+
+
+def _ndjson_lines(repository: Repository, limit: Optional[int], after: Optional[str],
+                  predicate: Optional[Callable[[Any], bool]], ids: Optional[Sequence[str]], redact: bool,
+                  projection: Optional[Projection]) -> Iterator[bytes]:
+    if predicate is None:
+        for _, raw in islice(repository.iter_raw(after, ids, redact, True, projection), limit):
+            yield raw + b"\n"
+        return
+
+    for entity in _iter_filtered(repository, after, limit, predicate, ids):
+        yield dumps_json(_entity_dict(repository, entity, redact, projection)) + b"\n"
+
+
+def _raw_page(repository: Repository, limit: Optional[int], after: Optional[str], ids: Optional[Sequence[str]],
+              redact: bool, projection: Optional[Projection]) -> Tuple[List[bytes], Optional[str]]:
+    if limit is None:
+        return [raw for _, raw in repository.iter_raw(after, ids, redact, projection=projection)], None
+    return repository.list_raw_page(limit, after, ids, redact, projection)
+
+
+def _entity_page(repository: Repository, limit: Optional[int], after: Optional[str],
+                 predicate: Callable[[Any], bool], ids: Optional[Sequence[str]], redact: bool,
+                 projection: Optional[Projection]) -> Tuple[List[bytes], Optional[str]]:
+    if limit is None:
+        page, next_cursor = list(_iter_filtered(repository, after, None, predicate, ids)), None
+    else:
+        page, next_cursor = repository.list_page(limit, after, predicate, ids)
+    return [dumps_json(_entity_dict(repository, entity, redact, projection)) for entity in page], next_cursor
@@ -1,8 +1,25 @@
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
 
-from .routers import workloads, migrations, migration_targets
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 
-app = FastAPI(title="Migration API")
+from src import MigrationState
+from src.metrics import REGISTRY, HTTP_REQUEST_DURATION
+from .listing import LIST_CACHE
+from .routers import workloads, migrations, migration_targets, admin
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # Migrations left RUNNING by a previous process (crash, reload) are queued again
+    migrations.migration_runner.recover()
+    yield
+    # Let executing migrations persist their final state, the waiting ones are put back to NOT_STARTED
+    migrations.migration_runner.shutdown(wait=True, cancel_pending=True)
+
+
+app = FastAPI(title="Migration API", lifespan=lifespan)
 
 # uvicorn src.rest_api.main:app --reload
 # http://127.0.0.1:8000/docs
@@ -10,3 +27,68 @@ app = FastAPI(title="Migration API")
 app.include_router(workloads.router, prefix="/workloads", tags=["workloads"])
 app.include_router(migration_targets.router, prefix="/migration_targets", tags=["migration_targets"])
 app.include_router(migrations.router, prefix="/migrations", tags=["migrations"])
+app.include_router(admin.router, prefix="/admin", tags=["admin"])
+
+
+# Metrics
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Route template, so that ids do not create a time series each
+        route = request.scope.get("route")
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start,
+                                      method=request.method,
+                                      route=route.path if route is not None else "unmatched",
+                                      status=str(status))
+
+
+# Profiling: every request with CLOUDSHIFT_PROFILE, or requests with the X-Profile-Token header
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    return await admin.request_profiler(request, call_next)
+
+
+def collect_service_metrics():
+    """
+    Values read on every scrape: caches of the repositories and the migrations
+    """
+    repositories = {
+        "workloads": workloads.workload_repository,
+        "migration_targets": migration_targets.migration_target_repository,
+        "migrations": migrations.migration_repository,
+    }
+    hits = [({"collection": name}, r.cache_hits) for name, r in repositories.items()]
+    misses = [({"collection": name}, r.cache_misses) for name, r in repositories.items()]
+    ratio = [({"collection": name}, r.cache_hits / (r.cache_hits + r.cache_misses))
+             for name, r in repositories.items() if r.cache_hits + r.cache_misses]
+    entries = [({"collection": name}, r.cache_stats()["size"]) for name, r in repositories.items()]
+    states = [({"state": state.value}, len(migrations.migration_repository.find_ids("state", state.value)))
+              for state in MigrationState]
+    runner = migrations.migration_runner
+    list_cache = LIST_CACHE.stats()
+
+    return [
+        ("cloudshift_cache_hits_total", "counter", "Entities served from the repository cache", hits),
+        ("cloudshift_cache_misses_total", "counter", "Entities read from the storage", misses),
+        ("cloudshift_cache_hit_ratio", "gauge", "Share of reads served from the repository cache", ratio),
+        ("cloudshift_cache_entries", "gauge", "Entities in the repository cache", entries),
+        ("cloudshift_list_cache_bytes", "gauge", "Bytes of cached list responses", [({}, list_cache["bytes"])]),
+        ("cloudshift_migration_queue_depth", "gauge", "Migrations waiting for a worker",
+         [({}, runner.queue_depth())]),
+        ("cloudshift_migrations_executing", "gauge", "Migrations being executed", [({}, runner.running_count())]),
+        ("cloudshift_migrations", "gauge", "Stored migrations by state", states),
+    ]
+
+
+REGISTRY.add_collector(collect_service_metrics)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,223 @@
+"""On-demand request profiling: cProfile around the endpoints, stored in a bounded on-disk ring"""
+
+import cProfile
+import functools
+import hmac
+import inspect
+import io
+import json
+import pstats
+import re
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from uuid import uuid4
+
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+
+from src import Settings
+
+PROFILE_HEADER = "X-Profile-Token"
+PROFILE_ID_HEADER = "X-Profile-Id"
+# Reading the profiles should not replace them in the ring
+NOT_PROFILED_PREFIXES = ("/admin/", "/metrics")
+
+
+
+class _RequestProfile:
+    """
+    Profile of one request
+
+    Attributes:
+        profiler (cProfile.Profile): Enabled while the endpoint runs
+        complete (bool): False if the profile misses the cost of the request: the endpoint returned a
+            streaming response (its body is produced after the endpoint returned, without the profiler)
+            or another profiling tool was active. Such profiles are not stored.
+    """
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.complete = True
+
+
+# Profile of the current request, if it is profiled
+_current_profile: ContextVar[Optional[_RequestProfile]] = ContextVar("current_profile", default=None)
+# One request is profiled at a time: from Python 3.12 only one profiler can be active in the process
+_PROFILE_LOCK = threading.Lock()
+
+_PROFILE_ID = re.compile(r"^[0-9]{13}-[0-9a-f]{8}$")
+
+
+def profiled(endpoint: Callable) -> Callable:
+    """
+    Run the endpoint under the profiler of the request (the endpoints run in a worker thread,
+    cProfile only sees the thread it is enabled in)
+
+    Idempotent: include_router() builds the routes of a router again with the same route class
+    """
+    if inspect.iscoroutinefunction(endpoint) or getattr(endpoint, "__profiled__", False):
+        # Coroutines run in the event loop thread together with other requests, not profiled
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = _current_profile.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        try:
+            profile.profiler.enable()
+        except ValueError:
+            # Another profiling tool is active in the process (Python 3.12+)
+            profile.complete = False
+            return endpoint(*args, **kwargs)
+        try:
+            result = endpoint(*args, **kwargs)
+        finally:
+            profile.profiler.disable()
+        if isinstance(result, StreamingResponse):
+            profile.complete = False
+        return result
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Route class of the routers: endpoints can be profiled per request
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs: Any):
+        super().__init__(path, profiled(endpoint), **kwargs)
+
+
+class ProfileStore:
+    """
+    Profiles stored as <id>.prof (pstats format) with <id>.json metadata, only the `keep` newest are kept
+    """
+
+    def __init__(self, dir: Path, keep: int = 50):
+        self.dir = dir
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def save(self, profiler: cProfile.Profile, meta: Dict[str, Any]) -> str:
+        id_obj = f"{int(time.time() * 1000):013d}-{uuid4().hex[:8]}"
+        with self._lock:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(self.dir / f"{id_obj}.prof"))
+            (self.dir / f"{id_obj}.json").write_text(json.dumps({"id": id_obj, **meta}), encoding="utf-8")
+            self._prune()
+        return id_obj
+
+    def _prune(self) -> None:
+        ids = self.ids()
+        for id_obj in ids[:max(0, len(ids) - self.keep)]:
+            for suffix in (".prof", ".json"):
+                (self.dir / f"{id_obj}{suffix}").unlink(missing_ok=True)
+
+    def ids(self) -> List[str]:
+        if not self.dir.exists():
+            return []
+        return sorted(path.stem for path in self.dir.glob("*.prof"))
+
+    def list(self) -> List[Dict[str, Any]]:
+        """
+        Metadata of the stored profiles, newest first
+        """
+        result = []
+        for id_obj in reversed(self.ids()):
+            try:
+                result.append(json.loads((self.dir / f"{id_obj}.json").read_text(encoding="utf-8")))
+            except FileNotFoundError:
+                pass
+        return result
+
+    def path(self, id_obj: str) -> Optional[Path]:
+        if not _PROFILE_ID.match(id_obj):
+            return None
+        path = self.dir / f"{id_obj}.prof"
+        return path if path.exists() else None
+
+    def report(self, id_obj: str, sort: str = "cumulative", limit: int = 50) -> Optional[str]:
+        """
+        :return: pstats text report of a stored profile, None if it does not exist
+        """
+        path = self.path(id_obj)
+        if path is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(str(path), stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class RequestProfiler:
+    """
+    Decides which requests are profiled: all of them (`enabled`) or the ones sent with
+    the X-Profile-Token header equal to `token` (trusted clients)
+    """
+
+    def __init__(self, store: ProfileStore, enabled: bool = False, token: str = ""):
+        self.store = store
+        self.enabled = enabled
+        self.token = token
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "RequestProfiler":
+        return cls(ProfileStore(settings.profile_path, settings.profile_keep), settings.profile, settings.profile_token)
+
+    def is_trusted(self, token: Optional[str]) -> bool:
+        return bool(self.token) and token is not None and hmac.compare_digest(token, self.token)
+
+    def should_profile(self, token: Optional[str]) -> bool:
+        return self.enabled or self.is_trusted(token)
+
+    def admin_allowed(self, token: Optional[str]) -> bool:
+        """
+        The stored profiles are readable with the token, or by anyone if profiling is enabled without a token
+        """
+        return self.is_trusted(token) or (self.enabled and not self.token)
+
+    async def __call__(self, request, call_next):
+        """
+        HTTP middleware
+        """
+        if (not self.should_profile(request.headers.get(PROFILE_HEADER))
+                or request.url.path.startswith(NOT_PROFILED_PREFIXES)):
+            return await call_next(request)
+        if not _PROFILE_LOCK.acquire(blocking=False):
+            # Another request is being profiled, this one is served without profile
+            return await call_next(request)
+        try:
+            return await self._profile(request, call_next)
+        finally:
+            _PROFILE_LOCK.release()
+
+    async def _profile(self, request, call_next):
+        profile = _RequestProfile()
+        context_token = _current_profile.set(profile)
+        start = time.perf_counter()
+        status = 500
+        id_obj = None
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            _current_profile.reset(context_token)
+            duration = time.perf_counter() - start
+            route = request.scope.get("route")
+            if profile.complete:
+                id_obj = self.store.save(profile.profiler, {
+                    "method": request.method,
+                    "path": request.url.path,
+                    "route": route.path if route is not None else None,
+                    "status": status,
+                    "duration_s": round(duration, 6),
+                    "created": time.time(),
+                })
+        if id_obj is not None:
+            response.headers[PROFILE_ID_HEADER] = id_obj
+        return response
@@ -0,0 +1,145 @@
+"""Cache of list response bodies, sent gzip-compressed to the clients accepting it"""
+
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from fastapi import Response
+
+# Smaller bodies are sent uncompressed, gzip would not save a packet
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+def gzip_etag(etag: str) -> str:
+    """
+    ETag of the gzip-compressed body: the representation differs from the uncompressed one,
+    so it cannot share its strong ETag
+    """
+    return etag[:-1] + '-gz"'
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    :param accept_encoding: Value of the Accept-Encoding header
+    """
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        return quality > 0
+    return False
+
+
+class CachedBody:
+    """
+    Response body of one version of a list
+
+    Attributes:
+        etag (str): Version of the list the body was built for
+        body (bytes): Uncompressed body
+        headers (Dict[str, str]): Headers sent with the body (ETag, X-Next-Cursor)
+        gzipped (bytes): Compressed body, None until a client accepting gzip asked for it
+    """
+
+    def __init__(self, etag: str, body: bytes, headers: Dict[str, str]):
+        self.etag = etag
+        self.body = body
+        self.headers = headers
+        self.gzipped: Optional[bytes] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + (len(self.gzipped) if self.gzipped is not None else 0)
+
+
+class ResponseCache:
+    """
+    LRU cache of response bodies, at most `max_bytes` (compressed copies included, 0 disables it)
+
+    There is one entry per key (the query of a list), valid as long as the ETag of the list
+    does not change: the ETag contains the change token of the repository, so any create, update
+    or delete makes the entry stale and it is replaced by the next request.
+    """
+
+    def __init__(self, max_bytes: int = 32 << 20):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, CachedBody]" = OrderedDict()
+        self._size = 0
+
+    def get(self, key: Hashable, etag: str) -> Optional[CachedBody]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.etag != etag:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, etag: str, body: bytes, headers: Dict[str, str]) -> CachedBody:
+        entry = CachedBody(etag, body, headers)
+        if entry.size > self.max_bytes // 4:
+            # Would evict most of the cache
+            return entry
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+        return entry
+
+    def _remove(self, key: Hashable) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old.size
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+
+    def gzipped(self, key: Hashable, entry: CachedBody) -> bytes:
+        """
+        Compressed body of an entry, compressed once
+        """
+        if entry.gzipped is None:
+            data = gzip.compress(entry.body, GZIP_LEVEL, mtime=0)
+            with self._lock:
+                if entry.gzipped is None:
+                    entry.gzipped = data
+                    if self._entries.get(key) is entry:
+                        self._size += len(data)
+                        self._evict()
+        return entry.gzipped
+
+    def response(self, key: Hashable, entry: CachedBody, accept_encoding: Optional[str],
+                 media_type: str = "application/json") -> Response:
+        """
+        Response with the body of an entry, gzip-compressed if the client accepts it (see gzip_etag())
+        """
+        headers = {**entry.headers, "Vary": "Accept-Encoding"}
+        if len(entry.body) >= GZIP_MIN_SIZE and accepts_gzip(accept_encoding):
+            headers["Content-Encoding"] = "gzip"
+            headers["ETag"] = gzip_etag(entry.etag)
+            return Response(self.gzipped(key, entry), media_type=media_type, headers=headers)
+        return Response(entry.body, media_type=media_type, headers=headers)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size}
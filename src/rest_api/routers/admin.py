@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
+from typing import Optional
+
+from src import Settings
+from ..profiling import RequestProfiler
+
+router = APIRouter()
+
+settings = Settings.from_env()
+request_profiler = RequestProfiler.from_settings(settings)
+
+
+def _check_access(token: Optional[str]) -> None:
+    if not request_profiler.admin_allowed(token):
+        raise HTTPException(status_code=403, detail="X-Profile-Token header is required")
+
+
+@router.get("/profiles")
+def list_profiles(x_profile_token: Optional[str] = Header(None)):
+    _check_access(x_profile_token)
+    return request_profiler.store.list()
+
+
+@router.get("/profiles/{profile_id}")
+def read_profile(profile_id: str, sort: str = "cumulative", limit: int = 50,
+                 x_profile_token: Optional[str] = Header(None)):
+    _check_access(x_profile_token)
+    try:
+        report = request_profiler.store.report(profile_id, sort, limit)
+    except KeyError:
+        raise HTTPException(status_code=422, detail=f"Unknown sort key {sort}")
+    if report is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return PlainTextResponse(report)
+
+
+@router.get("/profiles/{profile_id}/raw")
+def download_profile(profile_id: str, x_profile_token: Optional[str] = Header(None)):
+    """
+    The profile in the pstats format, e.g. for snakeviz
+    """
+    _check_access(x_profile_token)
+    path = request_profiler.store.path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=path.name)
@@ -1,11 +1,16 @@
-from fastapi import APIRouter, HTTPException
-from pathlib import Path
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from typing import List, Optional
 
-from src import MigrationTarget, MigrationTargetRepository, NotFoundError
+from src import MigrationTarget, MigrationTargetRepository, NotFoundError, ConflictError, CloudType, Settings
+from ..bulk import bulk_write
+from ..conditional import document_response, expected_version
+from ..listing import ListFormat, list_response, MAX_PAGE_SIZE
+from ..profiling import ProfiledRoute
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
-migration_target_repository = MigrationTargetRepository(Path("./data/migration_targets"))
+settings = Settings.from_env()
+migration_target_repository = MigrationTargetRepository.from_settings(settings, "migration_targets")
 
 
 @router.post("/")
@@ -14,27 +19,52 @@ def create_migration_target(obj: dict):
     return migration_target_repository.create(migration_target).to_dict()
 
 
+@router.post("/bulk")
+def create_migration_targets_bulk(items: List[dict]):
+    return bulk_write(migration_target_repository, items, MigrationTarget.from_dict)
+
+
+@router.put("/bulk")
+def update_migration_targets_bulk(items: List[dict]):
+    return bulk_write(migration_target_repository, items, MigrationTarget.from_dict, update=True)
+
+
 @router.get("/{migration_target_id}")
-def read_migration_target(id_obj: str):
-    try:
-        return migration_target_repository.get(id_obj).to_dict()
-    except NotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
+def read_migration_target(migration_target_id: str, fields: Optional[str] = None,
+                          if_none_match: Optional[str] = Header(None)):
+    return document_response(migration_target_repository, migration_target_id, if_none_match,
+                             settings.redact_credentials, fields)
 
 
 @router.get("/")
-def list_migration_targets():
-    return [mt.to_dict() for mt in migration_target_repository.list_all()]
+def list_migration_targets(request: Request,
+                           cloud_type: Optional[CloudType] = None,
+                           limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                           after: Optional[str] = None,
+                           format: ListFormat = ListFormat.JSON,
+                           fields: Optional[str] = None):
+    filters = {"cloud_type": cloud_type.value if cloud_type is not None else None}
+
+    return list_response(migration_target_repository, request, limit, after, format, filters=filters,
+                         redact=settings.redact_credentials, fields=fields)
 
 
 @router.put("/{migration_target_id}")
-def update_migration_target(migration_target_id: str, obj: dict):
+def update_migration_target(migration_target_id: str, obj: dict, response: Response,
+                            if_match: Optional[str] = Header(None)):
+    version = expected_version(migration_target_repository, migration_target_id, if_match)
     try:
         migration_target = MigrationTarget.from_dict(obj)
         migration_target.id = migration_target_id
-        return migration_target_repository.update(migration_target).to_dict()
+        if version is not None:
+            migration_target.version = version
+        migration_target_repository.update(migration_target)
+        response.headers["ETag"] = migration_target_repository.etag(migration_target_id)
+        return migration_target.to_dict()
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except ConflictError as e:
+        raise HTTPException(status_code=412 if if_match is not None else 409, detail=str(e))
 
 
 @router.delete("/{migration_target_id}")
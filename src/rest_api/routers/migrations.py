@@ -1,67 +1,216 @@
-from fastapi import APIRouter, HTTPException
-from pathlib import Path
-
-from src import MigrationRepository, Migration, NotFoundError, BusinessRuleError
-
-router = APIRouter()
-
-migration_repository = MigrationRepository(Path("./data/migrations"))
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from starlette.concurrency import run_in_threadpool
+from typing import Any, Dict, List, Optional
+
+from src import (MigrationRepository, Migration, NotFoundError, BusinessRuleError, MigrationState,
+                 MigrationRunner, CapacityError, ConflictError, Settings, CloudType)
+from src.events import EVENTS, DELETED
+from src.persistence import storage_from_settings
+from src.transfer import DataTransfer
+from . import workloads, migration_targets
+from ..bulk import bulk_write
+from ..conditional import document_response, expected_version, not_modified
+from ..listing import ListFormat, list_response, MAX_PAGE_SIZE
+from ..profiling import ProfiledRoute
+from ..streaming import event_stream
+
+router = APIRouter(route_class=ProfiledRoute)
+
+settings = Settings.from_env()
+if settings.migration_references:
+    migration_repository = MigrationRepository.from_settings(
+        settings, "migrations",
+        workload_repository=workloads.workload_repository,
+        migration_target_repository=migration_targets.migration_target_repository,
+    )
+else:
+    migration_repository = MigrationRepository.from_settings(settings, "migrations")
+# Real data transfer is opt-in, by default a run only takes the simulated duration
+migration_transfer = (DataTransfer.from_settings(settings, storage_from_settings(settings, "migration_progress"))
+                      if settings.transfer_enabled else None)
+migration_runner = MigrationRunner(migration_repository,
+                                   max_workers=settings.run_workers,
+                                   max_queue=settings.run_queue_size,
+                                   min_to_sleep=settings.run_min_to_sleep,
+                                   max_per_target=settings.run_max_per_target,
+                                   max_per_cloud_type=settings.run_max_per_cloud_type,
+                                   transfer=migration_transfer)
 
 
 @router.post("/")
 def create_migration(migration_dict: dict):
     migration = Migration.from_dict(migration_dict)
-    return migration_repository.create(migration).to_dict()
-
-
-@router.get("/{migration_id}")
-def get_migration(migration_id: str):
     try:
-        return migration_repository.get(migration_id)
+        return migration_repository.create(migration).to_dict()
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
+@router.post("/bulk")
+def create_migrations_bulk(items: List[dict]):
+    return bulk_write(migration_repository, items, Migration.from_dict)
+
+
+@router.put("/bulk")
+def update_migrations_bulk(items: List[dict]):
+    return bulk_write(migration_repository, items, Migration.from_dict, update=True)
+
+
+@router.get("/events")
+async def migration_events(request: Request,
+                           ids: List[str] = Query([], alias="id"),
+                           state: Optional[MigrationState] = None,
+                           source_id: Optional[str] = None,
+                           migration_target_id: Optional[str] = None,
+                           cloud_type: Optional[CloudType] = None):
+    """
+    Server-sent events of the changes of all migrations (or the given ids) matching the filters
+    """
+    subscription = EVENTS.subscribe(set(ids),
+                                    state=state.value if state is not None else None,
+                                    source_id=source_id,
+                                    migration_target_id=migration_target_id,
+                                    cloud_type=cloud_type.value if cloud_type is not None else None)
+    return event_stream(request, subscription)
+
+
+@router.get("/{migration_id}")
+def get_migration(migration_id: str, fields: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    return document_response(migration_repository, migration_id, if_none_match, settings.redact_credentials, fields)
+
+
 @router.get("/")
-def list_migrations():
-    return [m.to_dict() for m in migration_repository.list_all()]
+def list_migrations(request: Request,
+                    state: Optional[MigrationState] = None,
+                    source_id: Optional[str] = None,
+                    migration_target_id: Optional[str] = None,
+                    cloud_type: Optional[CloudType] = None,
+                    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                    after: Optional[str] = None,
+                    format: ListFormat = ListFormat.JSON,
+                    fields: Optional[str] = None):
+    filters = {
+        "state": state.value if state is not None else None,
+        "source_id": source_id,
+        "migration_target_id": migration_target_id,
+        "cloud_type": cloud_type.value if cloud_type is not None else None,
+    }
+
+    return list_response(migration_repository, request, limit, after, format, filters=filters,
+                         redact=settings.redact_credentials, fields=fields)
 
 
 @router.put("/{migration_id}")
-def update_migration(migration_id: str, migration_dict: dict):
+def update_migration(migration_id: str, migration_dict: dict, response: Response,
+                     if_match: Optional[str] = Header(None)):
+    version = expected_version(migration_repository, migration_id, if_match)
     try:
         migration = Migration.from_dict(migration_dict)
         migration.id = migration_id
-        return migration_repository.update(migration).to_dict()
+        if version is not None:
+            migration.version = version
+        migration_repository.update(migration)
+        response.headers["ETag"] = migration_repository.etag(migration_id)
+        return migration.to_dict()
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except ConflictError as e:
+        raise HTTPException(status_code=412 if if_match is not None else 409, detail=str(e))
 
 
 @router.delete("/{migration_id}")
 def delete_migration(migration_id: str):
     try:
         migration_repository.delete(migration_id)
+        if migration_runner.transfer is not None:
+            migration_runner.transfer.forget(migration_id)
         return {"message": f"Migration {migration_id} deleted"}
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
-@router.post("/{migration_id}/run")
-def run_migration(migration_id: str):
+@router.post("/{migration_id}/run", status_code=202)
+def run_migration(migration_id: str, priority: int = 0):
     try:
-        migration = migration_repository.get(migration_id)
-        migration.run(min_to_sleep=0)
-        migration_repository.update(migration)
+        migration = migration_runner.submit(migration_id, priority)
         return {"status": migration.state.value}
     except BusinessRuleError as e:
         raise HTTPException(status_code=422, detail=str(e))
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except CapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+FINAL_STATES = {MigrationState.SUCCESS.value, MigrationState.ERROR.value}
+
+
+@router.get("/{migration_id}/events")
+async def migration_status_events(migration_id: str, request: Request):
+    """
+    Server-sent events of one migration: its current status, then every change (state, phase, progress).
+    The stream ends when the migration is finished (SUCCESS or ERROR and no longer handled by the runner)
+    or deleted.
+    """
+    subscription = EVENTS.subscribe({migration_id})
+    try:
+        status = await run_in_threadpool(_status, migration_id)
+    except NotFoundError as e:
+        EVENTS.unsubscribe(subscription)
+        raise HTTPException(status_code=404, detail=str(e))
+    watched = {"state": status["status"], "phase": status["phase"]}
+
+    def finished(event: Dict[str, Any]) -> bool:
+        if event["type"] == DELETED:
+            return True
+        for name in ("state", "phase"):
+            if name in event:
+                watched[name] = event[name]
+        return watched["state"] in FINAL_STATES and watched["phase"] is None
+
+    initial = {"type": "status", "id": migration_id, "state": status.pop("status"), **status}
+    return event_stream(request, subscription, [initial], finished)
+
+
+def _status(migration_id: str) -> Dict[str, Any]:
+    """
+    :raises NotFoundError: If the migration does not exist
+    """
+    transfer = migration_runner.transfer
+    return {
+        "status": migration_repository.get(migration_id).state.value,
+        "phase": migration_runner.phase(migration_id),
+        "queue_position": migration_runner.queue_position(migration_id),
+        "progress": transfer.progress(migration_id) if transfer is not None else None,
+    }
 
 
 @router.get("/{migration_id}/status")
-def migration_status(migration_id: str):
+def migration_status(migration_id: str, response: Response, if_none_match: Optional[str] = Header(None)):
+    # The runner state and the transfer progress are part of the version of the status
+    phase = migration_runner.phase(migration_id)
+    queue_position = migration_runner.queue_position(migration_id)
+    transfer = migration_runner.transfer
+    progress_signature = transfer.progress_signature(migration_id) if transfer is not None else None
+    etag = migration_repository.etag(migration_id)
+    if etag is not None:
+        progress_tag = ".".join(f"{part:x}" for part in progress_signature) if progress_signature else ""
+        etag = f'{etag[:-1]}-{phase or ""}-{queue_position or ""}-{progress_tag}"'
+    unchanged = not_modified(etag, if_none_match)
+    if unchanged is not None:
+        return unchanged
+
     try:
-        return {"status": migration_repository.get(migration_id).state.value}
+        state = migration_repository.get(migration_id).state.value
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+
+    response.headers["ETag"] = etag
+    return {
+        "status": state,
+        "phase": phase,
+        "queue_position": queue_position,
+        "progress": transfer.progress(migration_id) if transfer is not None else None,
+    }
@@ -1,11 +1,17 @@
-from fastapi import HTTPException, APIRouter
-from pathlib import Path
+from fastapi import HTTPException, APIRouter, Header, Query, Request, Response
+from typing import List, Optional
 
-from src import Workload, WorkloadRepository, DuplicateError, BusinessRuleError, NotFoundError
+from src import Workload, WorkloadRepository, DuplicateError, BusinessRuleError, NotFoundError, ConflictError, Settings
+from src.persistence import project
+from ..bulk import bulk_write
+from ..conditional import document_response, expected_version, list_etag, not_modified, request_projection
+from ..listing import ListFormat, list_response, MAX_PAGE_SIZE
+from ..profiling import ProfiledRoute
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
-workload_repository = WorkloadRepository(Path("./data/workloads"))
+settings = Settings.from_env()
+workload_repository = WorkloadRepository.from_settings(settings, "workloads")
 
 
 @router.post("/")
@@ -19,31 +25,70 @@ def create_workload(workload_dict: dict):
         raise HTTPException(status_code=422, detail=str(e))
 
 
+@router.post("/bulk")
+def create_workloads_bulk(items: List[dict]):
+    return bulk_write(workload_repository, items, Workload.from_dict)
+
+
+@router.put("/bulk")
+def update_workloads_bulk(items: List[dict]):
+    return bulk_write(workload_repository, items, Workload.from_dict, update=True)
+
+
 @router.get("/{workload_id}")
-def get_workload(workload_id: str):
-    try:
-        return workload_repository.get(workload_id).to_dict()
-    except NotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
+def get_workload(workload_id: str, fields: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    return document_response(workload_repository, workload_id, if_none_match, settings.redact_credentials, fields)
 
 
 @router.get("/")
-def list_workload():
-    return [workload.to_dict() for workload in workload_repository.list_all()]
+def list_workload(request: Request,
+                  response: Response,
+                  ip: Optional[str] = None,
+                  ip_prefix: Optional[str] = None,
+                  limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                  after: Optional[str] = None,
+                  format: ListFormat = ListFormat.JSON,
+                  fields: Optional[str] = None):
+    if ip is not None:
+        projection = request_projection(workload_repository, fields)
+        etag = list_etag(workload_repository, request)
+        unchanged = not_modified(etag, request.headers.get("if-none-match"))
+        if unchanged is not None:
+            return unchanged
+        response.headers["ETag"] = etag
+        try:
+            workload = workload_repository.find_by_ip(ip).to_dict()
+            if projection is not None:
+                workload = project(workload, projection)
+            return [workload_repository.redact(workload) if settings.redact_credentials else workload]
+        except NotFoundError:
+            return []
+
+    predicate = (lambda workload: workload.ip.startswith(ip_prefix)) if ip_prefix is not None else None
+
+    return list_response(workload_repository, request, limit, after, format, predicate,
+                         redact=settings.redact_credentials, fields=fields)
 
 
 @router.put("/{workload_id}")
-def update_workload(workload_id: str, obj: dict):
+def update_workload(workload_id: str, obj: dict, response: Response, if_match: Optional[str] = Header(None)):
+    version = expected_version(workload_repository, workload_id, if_match)
     try:
         workload = Workload.from_dict(obj)
         workload.id = workload_id
-        return workload_repository.update(workload).to_dict()
+        if version is not None:
+            workload.version = version
+        workload_repository.update(workload)
+        response.headers["ETag"] = workload_repository.etag(workload_id)
+        return workload.to_dict()
     except BusinessRuleError as e:
         raise HTTPException(status_code=422, detail=str(e))
     except DuplicateError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except ConflictError as e:
+        raise HTTPException(status_code=412 if if_match is not None else 409, detail=str(e))
 
 
 @router.delete("/{workload_id}")
@@ -0,0 +1,64 @@
+"""Server-sent events: status streams fed by the event bus"""
+
+import asyncio
+import json
+from typing import Any, AsyncIterator, Callable, Dict, Iterable
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from src.events import EVENTS, Subscription
+
+# A comment line is sent when nothing happened for this long, so proxies keep the connection open
+HEARTBEAT_SECONDS = 15.0
+
+OVERFLOW = "overflow"
+
+
+def format_event(event: Dict[str, Any]) -> bytes:
+    lines = []
+    if "seq" in event:
+        lines.append(f"id: {event['seq']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event, separators=(',', ':'))}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+async def _stream(request: Request, subscription: Subscription, initial: Iterable[Dict[str, Any]],
+                  until: Callable[[Dict[str, Any]], bool]) -> AsyncIterator[bytes]:
+    try:
+        for event in initial:
+            yield format_event(event)
+            if until(event):
+                return
+
+        while True:
+            try:
+                event = await subscription.get(HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    return
+                yield b": keepalive\n\n"
+                continue
+
+            if event is None:
+                # Too slow: the client has to fetch the current status and subscribe again
+                yield format_event({"type": OVERFLOW})
+                return
+            yield format_event(event)
+            if until(event):
+                return
+    finally:
+        EVENTS.unsubscribe(subscription)
+
+
+def event_stream(request: Request, subscription: Subscription, initial: Iterable[Dict[str, Any]] = (),
+                 until: Callable[[Dict[str, Any]], bool] = lambda event: False) -> StreamingResponse:
+    """
+    Stream the `initial` events, then the events of the subscription, until `until` returns True for one
+
+    :param subscription: Taken before the initial events are built, so no change is missed in between
+    """
+    return StreamingResponse(_stream(request, subscription, initial, until),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
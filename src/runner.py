@@ -0,0 +1,350 @@
+import logging
+import threading
+from bisect import insort
+from collections import Counter
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Dict, List, Optional
+
+from .core import Migration, MigrationState
+from .events import EVENTS, PHASE, migration_event
+from .exceptions import BusinessRuleError, CapacityError, ConflictError, NotFoundError
+from .persistence import MigrationRepository
+from .transfer import DataTransfer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(order=True)
+class _Job:
+    """
+    Migration waiting for a worker, ordered by priority (higher first), then FIFO
+    """
+    sort_key: tuple
+    migration_id: str = field(compare=False)
+    target_id: str = field(compare=False)
+    cloud_type: str = field(compare=False)
+    done: threading.Event = field(compare=False, default_factory=threading.Event)
+
+
+class MigrationRunner:
+    """
+    Schedules and executes migrations in background threads
+
+    submit() validates the migration, persists the RUNNING state and returns immediately.
+    The migration waits in the queue until a worker is free and the concurrency limits allow it:
+    at most `max_workers` migrations in total, `max_per_target` against one MigrationTarget and
+    `max_per_cloud_type` against one CloudType (0 means no limit).
+    Waiting migrations are taken by priority (higher first), then in submission order,
+    skipping the ones whose target or cloud type is busy.
+    At most `max_queue` migrations wait at the same time.
+
+    With a `transfer`, executing a migration first copies the data of its selected mount points
+    (see DataTransfer), so the duration depends on the selected sizes and the bandwidth.
+
+    Phase changes (QUEUED, EXECUTING, None when done) are published to the event bus (EVENTS).
+    A migration whose execution fails unexpectedly is logged and marked ERROR, the worker keeps running.
+    Migrations left RUNNING by a previous process are queued again by recover().
+    """
+    QUEUED = "QUEUED"
+    EXECUTING = "EXECUTING"
+
+    def __init__(self, repository: MigrationRepository, max_workers: int = 4, max_queue: int = 100,
+                 min_to_sleep: int = 0, max_per_target: int = 0, max_per_cloud_type: int = 0,
+                 transfer: Optional[DataTransfer] = None):
+        if max_workers < 1:
+            raise ValueError("max_workers should be at least 1")
+
+        self.repository = repository
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.min_to_sleep = min_to_sleep
+        self.max_per_target = max_per_target
+        self.max_per_cloud_type = max_per_cloud_type
+        self.transfer = transfer
+
+        self._cond = threading.Condition()
+        self._seq = count()
+        self._pending: List[_Job] = []
+        self._running: Dict[str, _Job] = {}
+        self._reserved: set = set()
+        self._running_by_target: Counter = Counter()
+        self._running_by_cloud_type: Counter = Counter()
+        self._closed = False
+        self._workers: List[threading.Thread] = []
+
+    # Scheduling
+    def submit(self, migration_id: str, priority: int = 0) -> Migration:
+        """
+        Queue a migration for background execution
+
+        :param priority: Migrations with a higher priority are started first
+        :return: The migration in RUNNING state
+        :raises NotFoundError: If the migration does not exist
+        :raises BusinessRuleError: If the migration cannot be run
+        :raises CapacityError: If the queue is full or the runner is shut down
+        :raises ConflictError: If the migration was changed while it was started
+        """
+        with self._cond:
+            if self._closed:
+                raise CapacityError("Migration runner is shut down")
+            if self._is_known(migration_id):
+                raise BusinessRuleError("Migration already started or completed")
+            if len(self._pending) + len(self._reserved) >= self.max_queue:
+                raise CapacityError("Too many migrations are waiting to run, try again later")
+            # Reserve the slot while the migration is validated
+            self._reserved.add(migration_id)
+
+        try:
+            migration = self.repository.get(migration_id)
+            migration.start()
+            self.repository.update(migration)
+        finally:
+            with self._cond:
+                self._reserved.discard(migration_id)
+
+        try:
+            self._enqueue(migration, priority)
+        except CapacityError:
+            # Shut down while the migration was started: it would never be executed
+            self._reset(migration_id)
+            raise
+        return migration
+
+    def recover(self) -> List[str]:
+        """
+        Queue again the migrations left RUNNING by a previous process (crash, reload):
+        they were started but are not handled by this runner.
+        The ones that do not fit in the queue (or come after shutdown()) are put back to NOT_STARTED.
+
+        :return: Ids of the queued migrations
+        """
+        queued = []
+        for migration_id in self.repository.find_ids("state", MigrationState.RUNNING.value):
+            with self._cond:
+                if self._is_known(migration_id):
+                    continue
+                full = self._closed or len(self._pending) >= self.max_queue
+            if full:
+                self._reset(migration_id)
+                continue
+            try:
+                migration = self.repository.get(migration_id)
+            except NotFoundError:
+                continue
+            if migration.state == MigrationState.RUNNING:
+                try:
+                    self._enqueue(migration, 0)
+                except CapacityError:
+                    # Shut down meanwhile
+                    self._reset(migration_id)
+                    continue
+                queued.append(migration_id)
+        return queued
+
+    def _enqueue(self, migration: Migration, priority: int) -> None:
+        """
+        :raises CapacityError: If the runner is shut down, no worker would take the migration
+        """
+        job = _Job(sort_key=(-priority, next(self._seq)),
+                   migration_id=migration.id,
+                   target_id=migration.migration_target.id,
+                   cloud_type=migration.migration_target.cloud_type.value)
+        with self._cond:
+            if self._closed:
+                raise CapacityError("Migration runner is shut down")
+            insort(self._pending, job)
+            self._ensure_workers()
+            self._cond.notify_all()
+        EVENTS.publish(migration_event(PHASE, migration, phase=self.QUEUED))
+
+    def _reset(self, migration_id: str) -> Optional[Migration]:
+        """
+        Put a RUNNING migration which will not be executed back to NOT_STARTED
+
+        :return: The migration, None if it was deleted or is no longer RUNNING
+        """
+        while True:
+            try:
+                migration = self.repository.get(migration_id)
+                if migration.state != MigrationState.RUNNING:
+                    return None
+                migration.state = MigrationState.NOT_STARTED
+                return self.repository.update(migration)
+            except NotFoundError:
+                return None
+            except ConflictError:
+                continue
+
+    def _is_known(self, migration_id: str) -> bool:
+        return (migration_id in self._reserved or migration_id in self._running
+                or any(job.migration_id == migration_id for job in self._pending))
+
+    def _ensure_workers(self) -> None:
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name=f"migration-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _can_start(self, job: _Job) -> bool:
+        if self.max_per_target and self._running_by_target[job.target_id] >= self.max_per_target:
+            return False
+        if self.max_per_cloud_type and self._running_by_cloud_type[job.cloud_type] >= self.max_per_cloud_type:
+            return False
+        return True
+
+    def _next_job(self) -> Optional[_Job]:
+        """
+        Wait for a job which is allowed to start, None when the runner is shut down and drained
+        """
+        with self._cond:
+            while True:
+                for i, job in enumerate(self._pending):
+                    if self._can_start(job):
+                        del self._pending[i]
+                        self._running[job.migration_id] = job
+                        self._running_by_target[job.target_id] += 1
+                        self._running_by_cloud_type[job.cloud_type] += 1
+                        return job
+                if self._closed and not self._pending:
+                    return None
+                self._cond.wait()
+
+    def _finish_job(self, job: _Job) -> None:
+        with self._cond:
+            del self._running[job.migration_id]
+            self._running_by_target[job.target_id] -= 1
+            if not self._running_by_target[job.target_id]:
+                del self._running_by_target[job.target_id]
+            self._running_by_cloud_type[job.cloud_type] -= 1
+            if not self._running_by_cloud_type[job.cloud_type]:
+                del self._running_by_cloud_type[job.cloud_type]
+            self._cond.notify_all()
+        job.done.set()
+
+    def _work(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            migration = None
+            try:
+                migration = self._execute(job.migration_id)
+            except Exception:
+                # The worker is kept: a failure of one migration (e.g. of the storage) must not stop the others
+                logger.exception("Migration %s failed", job.migration_id)
+                migration = self._mark_error(job.migration_id)
+            finally:
+                self._finish_job(job)
+                if migration is not None:
+                    EVENTS.publish(migration_event(PHASE, migration, phase=None))
+
+    def _execute(self, migration_id: str) -> Optional[Migration]:
+        """
+        :return: The executed migration, None if it was deleted
+        """
+        try:
+            migration = self.repository.get(migration_id)
+            EVENTS.publish(migration_event(PHASE, migration, phase=self.EXECUTING))
+            try:
+                if self.transfer is not None:
+                    self.transfer.run(migration)
+                migration.execute(self.min_to_sleep)
+            except Exception:
+                migration.state = MigrationState.ERROR
+            return self._save_result(migration)
+        except NotFoundError:
+            # Deleted while it was running
+            return None
+
+    def _mark_error(self, migration_id: str) -> Optional[Migration]:
+        """
+        Best effort to persist the ERROR state of a migration whose execution failed
+
+        :return: The migration, None if it could not be saved
+        """
+        try:
+            migration = self.repository.get(migration_id)
+            migration.state = MigrationState.ERROR
+            return self._save_result(migration)
+        except Exception:
+            logger.exception("Cannot save the failure of migration %s", migration_id)
+            return None
+
+    def _save_result(self, migration: Migration) -> Migration:
+        """
+        Persist the outcome of a run. If the migration was changed meanwhile (e.g. by a PUT),
+        the outcome is applied to the stored version instead of overwriting it.
+        """
+        while True:
+            try:
+                migration = self.repository.update(migration)
+                self.repository.save_target_vm(migration)
+                return migration
+            except ConflictError:
+                current = self.repository.get(migration.id)
+                current.state = migration.state
+                current.migration_target.target_vm = migration.migration_target.target_vm
+                migration = current
+
+    # Introspection
+    def phase(self, migration_id: str) -> Optional[str]:
+        """
+        :return: QUEUED or EXECUTING for migrations handled by the runner, otherwise None
+        """
+        with self._cond:
+            if migration_id in self._running:
+                return self.EXECUTING
+            if migration_id in self._reserved or self.queue_position(migration_id) is not None:
+                return self.QUEUED
+            return None
+
+    def queue_position(self, migration_id: str) -> Optional[int]:
+        """
+        :return: 1-based position of a waiting migration in the queue, otherwise None
+        """
+        with self._cond:
+            for position, job in enumerate(self._pending, start=1):
+                if job.migration_id == migration_id:
+                    return position
+            return None
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def running_count(self) -> int:
+        with self._cond:
+            return len(self._running)
+
+    def wait(self, migration_id: str, timeout: Optional[float] = None) -> None:
+        """
+        Block until the migration is executed (if it is handled by the runner)
+        """
+        with self._cond:
+            job = self._running.get(migration_id)
+            if job is None:
+                job = next((j for j in self._pending if j.migration_id == migration_id), None)
+        if job is not None and not job.done.wait(timeout):
+            raise TimeoutError(f"Migration {migration_id} is still running")
+
+    def shutdown(self, wait: bool = True, cancel_pending: bool = False) -> None:
+        """
+        Stop accepting migrations. The waiting ones are still executed, unless `cancel_pending`:
+        then they are put back to NOT_STARTED. The executing ones are always finished.
+        """
+        with self._cond:
+            self._closed = True
+            cancelled = self._pending if cancel_pending else []
+            if cancel_pending:
+                self._pending = []
+            self._cond.notify_all()
+            workers = list(self._workers)
+        for job in cancelled:
+            migration = self._reset(job.migration_id)
+            job.done.set()
+            if migration is not None:
+                EVENTS.publish(migration_event(PHASE, migration, phase=None))
+        if wait:
+            for worker in workers:
+                worker.join()
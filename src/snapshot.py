@@ -0,0 +1,111 @@
+"""Persisted state of the in-memory secondary indexes: a snapshot plus an append-only change journal"""
+
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+from uuid import uuid4
+
+from .storage import Signature
+from .utils import dumps_json, loads_json
+
+SNAPSHOT_FORMAT = 2
+
+# id -> (signature of the indexed document, indexed values in the order of the index names)
+IndexEntries = Dict[str, Tuple[Signature, List[Any]]]
+
+
+class IndexSnapshot:
+    """
+    Indexed values of every document of a collection with the signature they were read at
+
+    The snapshot file is rewritten from time to time (compact()), every change in between is appended
+    to the journal, one JSON line per change. Several processes may append to the same journal.
+    Both are only a hint: documents whose current signature differs are read again.
+    """
+
+    def __init__(self, dir: Path, index_names: Sequence[str], compact_after: int = 10000):
+        self.snapshot_path = dir / ".index.snapshot"
+        self.journal_path = dir / ".index.journal"
+        self.index_names = list(index_names)
+        self.compact_after = compact_after
+        self.journal_entries = 0
+        self._journal = None
+        self._lock = threading.Lock()
+
+    def load(self) -> IndexEntries:
+        """
+        Entries of the snapshot with the journal applied, empty if there is no usable snapshot
+        """
+        entries: IndexEntries = {}
+        try:
+            data = loads_json(self.snapshot_path.read_bytes())
+            if data.get("format") == SNAPSHOT_FORMAT and data.get("indexes") == self.index_names:
+                entries = {id_obj: (tuple(entry[:-1]), entry[-1]) for id_obj, entry in data["entries"].items()}
+        except (FileNotFoundError, ValueError, KeyError, IndexError, TypeError):
+            entries = {}
+
+        self.journal_entries = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    self.journal_entries += 1
+                    try:
+                        change = loads_json(line)
+                    except ValueError:
+                        # Torn last line of a crashed writer
+                        continue
+                    if change.get("indexes", self.index_names) != self.index_names:
+                        continue
+                    if change["op"] == "d":
+                        entries.pop(change["id"], None)
+                    else:
+                        entries[change["id"]] = (tuple(change["sig"]), change["values"])
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    def _append(self, lines: List[bytes]) -> None:
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, "ab", buffering=0)
+            self._journal.write(b"".join(lines))
+            self.journal_entries += len(lines)
+
+    def record_writes(self, items: Sequence[Tuple[str, Signature, List[Any]]]) -> None:
+        self._append([dumps_json({"op": "w", "id": id_obj, "sig": list(signature), "values": values}) + b"\n"
+                      for id_obj, signature, values in items])
+
+    def record_delete(self, id_obj: str) -> None:
+        self._append([dumps_json({"op": "d", "id": id_obj}) + b"\n"])
+
+    def needs_compaction(self) -> bool:
+        return self.journal_entries >= self.compact_after
+
+    def compact(self, entries: IndexEntries) -> None:
+        """
+        Write a new snapshot and empty the journal
+        """
+        data = {
+            "format": SNAPSHOT_FORMAT,
+            "indexes": self.index_names,
+            "entries": {id_obj: [*signature, values] for id_obj, (signature, values) in entries.items()},
+        }
+        # Processes starting together compact at the same time
+        tmp_path = self.snapshot_path.with_name(f"{self.snapshot_path.name}.{uuid4().hex[:8]}.tmp")
+        with self._lock:
+            with open(tmp_path, "wb") as f:
+                f.write(dumps_json(data))
+            os.replace(tmp_path, self.snapshot_path)
+            # Changes appended meanwhile by other processes are lost from the journal,
+            # their documents are read again because the signature in the snapshot differs
+            with open(self.journal_path, "wb"):
+                pass
+            self.journal_entries = 0
+
+    def close(self) -> None:
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,720 @@
+"""Storage backends for the repositories: file-per-entity JSON and SQLite"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows: only threads of one process are coordinated
+    fcntl = None
+
+from .exceptions import ConflictError, DuplicateError
+from .utils import Codec, detect_codec, write_json, dumps_json, loads_json
+
+# Cheap value that changes whenever a stored document changes
+# (files: mtime, size and inode, a rewrite within the mtime granularity still has a new inode)
+Signature = Tuple[int, ...]
+# Document to write if its stored version is still the expected one (None: write unconditionally)
+VersionedItem = Tuple[str, Dict[str, Any], Optional[int]]
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """
+    Field of a stored document which a backend may index
+
+    Attributes:
+        name (str): Index name, used in Storage.find()
+        extractor (Callable): Returns the indexed value from a document
+        unique (bool): Only one document may have a given value
+    """
+    name: str
+    extractor: Callable[[Dict[str, Any]], Any]
+    unique: bool = False
+
+
+class Storage:
+    """
+    Interface of a storage backend: documents (dicts) addressed by id
+
+    Attributes:
+        name (str): Collection name, used in metrics
+    """
+    name = ""
+
+    def signature(self, id_obj: str) -> Optional[Signature]:
+        """
+        :return: Signature of the stored document or None if it does not exist
+        """
+        raise NotImplementedError
+
+    def read(self, id_obj: str) -> Optional[Dict[str, Any]]:
+        """
+        :return: The stored document or None if it does not exist
+        """
+        data = self.read_bytes(id_obj)
+        return self.decode(data) if data is not None else None
+
+    def read_bytes(self, id_obj: str) -> Optional[bytes]:
+        """
+        :return: The stored document as stored, without decoding, or None if it does not exist
+        """
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        """
+        Decode a document returned by read_bytes()
+        """
+        raise NotImplementedError
+
+    def write(self, id_obj: str, doc: Dict[str, Any]) -> Optional[Signature]:
+        """
+        Insert or replace a document
+
+        :return: Signature of the written document
+        """
+        raise NotImplementedError
+
+    def write_many(self, items: Sequence[Tuple[str, Dict[str, Any]]]) -> List[Optional[Signature]]:
+        """
+        Insert or replace several documents
+
+        :return: Signatures of the written documents
+        """
+        return [self.write(id_obj, doc) for id_obj, doc in items]
+
+    def compare_and_write(self, items: Sequence[VersionedItem]) -> List[Union[Signature, ConflictError]]:
+        """
+        Write documents whose stored `version` is still the expected one.
+        The check and the write are atomic for every document, also against other processes.
+        The `version` of every written document is set to the stored version + 1
+        (a missing document has version 0).
+
+        :return: For every document, the signature of the written document
+            or ConflictError if the stored version differs
+        """
+        raise NotImplementedError
+
+    def delete(self, id_obj: str) -> bool:
+        """
+        :return: False if the document did not exist
+        """
+        raise NotImplementedError
+
+    def exists(self, id_obj: str) -> bool:
+        return self.signature(id_obj) is not None
+
+    def ids(self, after: Optional[str] = None) -> List[str]:
+        """
+        Ids of all documents in sorted order
+
+        :param after: Cursor, only ids greater than it are returned
+        """
+        raise NotImplementedError
+
+    def signatures(self) -> Dict[str, Signature]:
+        """
+        Signatures of all documents by id, without reading the documents
+        """
+        result: Dict[str, Signature] = {}
+        for id_obj in self.ids():
+            signature = self.signature(id_obj)
+            if signature is not None:
+                result[id_obj] = signature
+        return result
+
+    def change_token(self) -> Any:
+        """
+        :return: Value that changes when documents are created, updated or deleted
+        """
+        raise NotImplementedError
+
+    def has_index(self, index: str) -> bool:
+        """
+        :return: True if the backend maintains this index and find() can be used
+        """
+        return False
+
+    def find(self, index: str, value: Any) -> Optional[List[str]]:
+        """
+        Ids of documents with the given value of an index
+
+        :return: None if the backend does not maintain this index
+        """
+        return None
+
+
+class _LockFile:
+    """
+    Stripes of byte-range locks of one lock file, shared by all FileStorage instances of the directory
+
+    fcntl record locks belong to the process: they do not exclude the threads of the process
+    (a thread lock per stripe does) and closing any descriptor of the file releases all of them,
+    so the file is opened once and never closed.
+    """
+
+    def __init__(self, path: Path, count: int):
+        self.path = path
+        self.stripes = [threading.Lock() for _ in range(count)]
+        self._fd: Optional[int] = None
+        self._open_lock = threading.Lock()
+
+    def _descriptor(self) -> int:
+        with self._open_lock:
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                inode = None
+            if self._fd is None or os.fstat(self._fd).st_ino != inode:
+                # First use, or the directory was recreated: the old descriptor stays open,
+                # closing it would release the locks other threads hold on it
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            return self._fd
+
+    @contextmanager
+    def locked(self, stripe: int) -> Iterator[None]:
+        with self.stripes[stripe]:
+            if fcntl is None:
+                yield
+                return
+            fd = self._descriptor()
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, stripe)
+
+
+_LOCK_FILES: Dict[str, _LockFile] = {}
+_LOCK_FILES_LOCK = threading.Lock()
+
+
+def _lock_file(path: Path, count: int) -> _LockFile:
+    with _LOCK_FILES_LOCK:
+        key = os.path.realpath(path)
+        if key not in _LOCK_FILES:
+            _LOCK_FILES[key] = _LockFile(path, count)
+        return _LOCK_FILES[key]
+
+
+@dataclass(frozen=True)
+class Layout:
+    """
+    Directory layout of a FileStorage, kept in its `.layout` file
+
+    Attributes:
+        levels (int): Levels of shard directories named by the id prefix (0: all files in one directory)
+        previous (int): Levels of the layout the files are being moved from by reshard(), None if no move is running
+    """
+    levels: int = 0
+    previous: Optional[int] = None
+
+
+class FileStorage(Storage):
+    """
+    Each document is stored in a separate .json file named by its id
+
+    Documents are written with `codec` (pretty JSON by default), the format of every file
+    is detected when it is read, so files written with different codecs can be mixed.
+
+    With `shard_levels` the files are spread over subdirectories named by the id prefix
+    (SHARD_WIDTH characters per level: `ab/cd/abcd....json` with 2 levels), so directories stay small
+    (256 subdirectories per level for uuid ids). The layout belongs to the directory: it is saved
+    in `.layout` when the storage is opened on a directory without documents, `shard_levels` is ignored
+    otherwise; reshard() moves an existing store to another layout while it is in use.
+    Listing scans the shard directories with `walk_workers` threads.
+
+    Writes and deletes lock a stripe of documents: a thread lock in the process and
+    a byte range of the `.lock` file (fcntl) against other processes.
+    """
+    LOCK_STRIPES = 1024
+    SHARD_WIDTH = 2
+
+    def __init__(self, dir: Path, codec: Optional[Codec] = None, shard_levels: int = 0, walk_workers: int = 8):
+        self.dir = dir
+        self.name = dir.name
+        self.codec = codec
+        self.walk_workers = walk_workers
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._lock_file = _lock_file(self.dir / ".lock", self.LOCK_STRIPES)
+        self._layout_path = self.dir / ".layout"
+        self._layout_stat: Optional[Tuple[int, int, int]] = None
+        self._layout = Layout()
+        self._walker: Optional[ThreadPoolExecutor] = None
+        self.refresh_layout()
+        if shard_levels and self._layout_stat is None and not self._flat_ids():
+            self._save_layout(Layout(shard_levels))
+
+    # Layout
+    @property
+    def layout(self) -> Layout:
+        return self._layout
+
+    def refresh_layout(self) -> Layout:
+        """
+        Read `.layout` again if it was replaced, e.g. by reshard() in another process
+        """
+        try:
+            st = os.stat(self._layout_path)
+        except FileNotFoundError:
+            self._layout_stat, self._layout = None, Layout()
+            return self._layout
+
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if key != self._layout_stat:
+            try:
+                doc = json.loads(self._layout_path.read_bytes())
+            except FileNotFoundError:
+                # Replaced meanwhile
+                return self.refresh_layout()
+            self._layout_stat, self._layout = key, Layout(doc["levels"], doc.get("previous"))
+        return self._layout
+
+    def _save_layout(self, layout: Layout) -> None:
+        tmp_path = self.dir / f".layout.{uuid4().hex}.tmp"
+        tmp_path.write_text(json.dumps({"levels": layout.levels, "previous": layout.previous}), encoding="utf-8")
+        os.replace(tmp_path, self._layout_path)
+        self.refresh_layout()
+
+    def _shard_path(self, id_obj: str, levels: int) -> Path:
+        width = self.SHARD_WIDTH
+        shards = [id_obj[level * width:(level + 1) * width] or "_" for level in range(levels)]
+        return self.dir.joinpath(*shards, f"{id_obj}.json")
+
+    def path(self, id_obj: str) -> Path:
+        """
+        Path of a document in the current layout
+        """
+        return self._shard_path(id_obj, self._layout.levels)
+
+    def _candidates(self, id_obj: str) -> Iterator[Path]:
+        """
+        Paths where a document may be: the current layout, then (once the current layout missed
+        and `.layout` was read again) the new current layout and the layout of a running reshard()
+        """
+        first = self.path(id_obj)
+        yield first
+        layout = self.refresh_layout()
+        path = self._shard_path(id_obj, layout.levels)
+        if path != first:
+            yield path
+        if layout.previous is not None:
+            yield self._shard_path(id_obj, layout.previous)
+            # Moved to the new layout between the two lookups
+            yield path
+
+    def signature(self, id_obj: str) -> Optional[Signature]:
+        for path in self._candidates(id_obj):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        return None
+
+    def read_bytes(self, id_obj: str) -> Optional[bytes]:
+        for path in self._candidates(id_obj):
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                continue
+        return None
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return detect_codec(data).decode(data)
+
+    def write(self, id_obj: str, doc: Dict[str, Any]) -> Optional[Signature]:
+        with self._locked(id_obj):
+            return self._write(id_obj, doc)
+
+    def _write(self, id_obj: str, doc: Dict[str, Any]) -> Optional[Signature]:
+        """
+        Write in the current layout, the caller holds the lock of the document
+        """
+        layout = self.refresh_layout()
+        path = self.path(id_obj)
+        try:
+            write_json(path, doc, self.codec)
+        except FileNotFoundError:
+            # First document of a shard
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_json(path, doc, self.codec)
+        if layout.levels:
+            # The file was replaced in a shard directory: the mtime of the root directory (change_token)
+            # changes with every write, like in the flat layout
+            os.utime(self.dir)
+        return self.signature(id_obj)
+
+    @contextmanager
+    def _locked(self, id_obj: str) -> Iterator[None]:
+        with self._lock_file.locked(zlib.crc32(id_obj.encode("utf-8")) % self.LOCK_STRIPES):
+            yield
+
+    def compare_and_write(self, items: Sequence[VersionedItem]) -> List[Union[Signature, ConflictError]]:
+        results: List[Union[Signature, ConflictError]] = []
+        for id_obj, doc, expected in items:
+            with self._locked(id_obj):
+                current = self.read(id_obj)
+                version = (current.get("version") or 0) if current is not None else 0
+                if expected is not None and expected != version:
+                    results.append(ConflictError(f"Object {id_obj} was changed: version {version}, "
+                                                 f"expected {expected}"))
+                    continue
+                doc["version"] = version + 1
+                results.append(self._write(id_obj, doc))
+
+        return results
+
+    def delete(self, id_obj: str) -> bool:
+        with self._locked(id_obj):
+            deleted = False
+            for path in self._candidates(id_obj):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                deleted = True
+            if deleted and self._layout.levels:
+                os.utime(self.dir)
+            return deleted
+
+    # Listing
+    def _flat_ids(self) -> List[str]:
+        with os.scandir(self.dir) as entries:
+            return [entry.name[:-5] for entry in entries if entry.name.endswith(".json") and entry.is_file()]
+
+    def _shard_tree(self, levels: int) -> List[List[str]]:
+        """
+        :return: Shard directories of every level, from the root directory down
+        """
+        tree = [[str(self.dir)]]
+        for _ in range(levels):
+            tree.append([path for paths in self._map(_subdirs, tree[-1]) for path in paths])
+        return tree
+
+    def _shard_dirs(self, levels: int) -> List[str]:
+        return self._shard_tree(levels)[-1]
+
+    def _map(self, fn: Callable[[str], Any], dirs: List[str]) -> Iterable[Any]:
+        """
+        fn() of every directory, the directories are split into a few batches per walker thread
+        """
+        if len(dirs) < 2 or self.walk_workers < 2:
+            return map(fn, dirs)
+        if self._walker is None:
+            self._walker = ThreadPoolExecutor(self.walk_workers, thread_name_prefix=f"walk-{self.name}")
+        size = -(-len(dirs) // (self.walk_workers * 4))
+        batches = [dirs[i:i + size] for i in range(0, len(dirs), size)]
+        return (result for results in self._walker.map(lambda batch: [fn(path) for path in batch], batches)
+                for result in results)
+
+    def _walk(self, scan: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Scan the directories of the current layout (and of the previous one during reshard()) in parallel
+        """
+        layout = self.refresh_layout()
+        result: Dict[str, Any] = {}
+        if layout.previous is not None:
+            for found in self._map(scan, self._shard_dirs(layout.previous)):
+                result.update(found)
+        for found in self._map(scan, self._shard_dirs(layout.levels)):
+            result.update(found)
+        return result
+
+    def ids(self, after: Optional[str] = None) -> List[str]:
+        if self.refresh_layout() == Layout():
+            ids = sorted(self._flat_ids())
+        else:
+            ids = sorted(self._walk(_scan_ids))
+
+        if after is not None:
+            return ids[bisect_right(ids, after):]
+        return ids
+
+    def signatures(self) -> Dict[str, Signature]:
+        return self._walk(_scan_signatures)
+
+    def change_token(self) -> Any:
+        return self.dir.stat().st_mtime_ns
+
+    def reshard(self, levels: int) -> int:
+        """
+        Move every document into a layout with `levels` levels of shard directories, while
+        the store is used: the documents are found in both layouts until all were moved.
+        An interrupted run is continued by calling it again with the same `levels`.
+
+        :return: Number of moved documents
+        :raises ValueError: If another reshard() to a different layout was interrupted
+        """
+        layout = self.refresh_layout()
+        if layout.previous is not None and layout.levels != levels:
+            raise ValueError(f"Finish the running reshard to {layout.levels} levels first")
+        source = layout.previous if layout.previous is not None else layout.levels
+        if source == levels:
+            return 0
+
+        self._save_layout(Layout(levels, source))
+        moved = 0
+        old_ids = [id_obj for found in self._map(_scan_ids, self._shard_dirs(source)) for id_obj in found]
+        for id_obj in sorted(old_ids):
+            with self._locked(id_obj):
+                old_path, new_path = self._shard_path(id_obj, source), self._shard_path(id_obj, levels)
+                if new_path.exists():
+                    # Written in the new layout meanwhile
+                    old_path.unlink(missing_ok=True)
+                    continue
+                new_path.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.replace(old_path, new_path)
+                except FileNotFoundError:
+                    # Deleted meanwhile
+                    continue
+                moved += 1
+
+        self._save_layout(Layout(levels))
+        # Empty shard directories of the old layout, deepest first (the ones still used are not empty)
+        for level_dirs in reversed(self._shard_tree(source)[1:]):
+            for path in level_dirs:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+        return moved
+
+
+def _subdirs(directory: str) -> List[str]:
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries if not entry.name.startswith(".") and entry.is_dir()]
+
+
+def _scan_ids(directory: str) -> Dict[str, None]:
+    with os.scandir(directory) as entries:
+        return {entry.name[:-5]: None for entry in entries if entry.name.endswith(".json") and entry.is_file()}
+
+
+def _scan_signatures(directory: str) -> Dict[str, Signature]:
+    result: Dict[str, Signature] = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            result[entry.name[:-5]] = (st.st_mtime_ns, st.st_size, st.st_ino)
+    return result
+
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class SqliteStorage(Storage):
+    """
+    Documents are stored as JSON text in one SQLite table per repository
+
+    Every index from `indexes` gets its own column and SQL index, so find() does not read documents.
+    The database is opened in WAL mode, each thread uses its own connection.
+    Every write gets a new value of a database-wide sequence (`rev`), used as the signature.
+    """
+
+    def __init__(self, db_path: Path, table: str, indexes: Sequence[IndexSpec] = ()):
+        if not _IDENTIFIER.match(table):
+            raise ValueError(f"Invalid table name {table}")
+        for spec in indexes:
+            if not _IDENTIFIER.match(spec.name):
+                raise ValueError(f"Invalid index name {spec.name}")
+
+        self.db_path = db_path
+        self.table = table
+        self.name = table
+        self.indexes = {spec.name: spec for spec in indexes}
+        self._local = threading.local()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._create_schema()
+
+    # Connection
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _create_schema(self) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS cloudshift_sequence (name TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO cloudshift_sequence (name, seq) VALUES ('rev', 0)")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                         f"(id TEXT PRIMARY KEY, doc TEXT NOT NULL, rev INTEGER NOT NULL)")
+
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({self.table})")}
+            missing = [spec for spec in self.indexes.values() if f"idx_{spec.name}" not in columns]
+            for spec in missing:
+                conn.execute(f"ALTER TABLE {self.table} ADD COLUMN idx_{spec.name}")
+            if missing:
+                # Backfill indexes added after the table was created
+                rows = conn.execute(f"SELECT id, doc FROM {self.table}").fetchall()
+                for id_obj, doc in rows:
+                    values = self._index_values(loads_json(doc), missing)
+                    assignments = ", ".join(f"idx_{spec.name} = ?" for spec in missing)
+                    conn.execute(f"UPDATE {self.table} SET {assignments} WHERE id = ?", (*values, id_obj))
+
+            for spec in self.indexes.values():
+                unique = "UNIQUE " if spec.unique else ""
+                conn.execute(f"CREATE {unique}INDEX IF NOT EXISTS {self.table}_{spec.name} "
+                             f"ON {self.table} (idx_{spec.name})")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _index_values(doc: Dict[str, Any], specs: Iterable[IndexSpec]) -> List[Any]:
+        return [spec.extractor(doc) for spec in specs]
+
+    def _next_rev(self, conn: sqlite3.Connection) -> int:
+        conn.execute("UPDATE cloudshift_sequence SET seq = seq + 1 WHERE name = 'rev'")
+        return conn.execute("SELECT seq FROM cloudshift_sequence WHERE name = 'rev'").fetchone()[0]
+
+    # Storage
+    def signature(self, id_obj: str) -> Optional[Signature]:
+        row = self._conn().execute(f"SELECT rev, length(doc) FROM {self.table} WHERE id = ?", (id_obj,)).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def read(self, id_obj: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(f"SELECT doc FROM {self.table} WHERE id = ?", (id_obj,)).fetchone()
+        return loads_json(row[0]) if row is not None else None
+
+    def read_bytes(self, id_obj: str) -> Optional[bytes]:
+        row = self._conn().execute(f"SELECT CAST(doc AS BLOB) FROM {self.table} WHERE id = ?",
+                                   (id_obj,)).fetchone()
+        return row[0] if row is not None else None
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return loads_json(data)
+
+    def write(self, id_obj: str, doc: Dict[str, Any]) -> Optional[Signature]:
+        return self.write_many([(id_obj, doc)])[0]
+
+    def _upsert(self, conn: sqlite3.Connection, specs: List[IndexSpec], id_obj: str,
+                doc: Dict[str, Any]) -> Signature:
+        columns = "".join(f", idx_{spec.name}" for spec in specs)
+        placeholders = ", ?" * len(specs)
+        updates = "".join(f", idx_{spec.name} = excluded.idx_{spec.name}" for spec in specs)
+        sql = (f"INSERT INTO {self.table} (id, doc, rev{columns}) VALUES (?, ?, ?{placeholders}) "
+               f"ON CONFLICT(id) DO UPDATE SET doc = excluded.doc, rev = excluded.rev{updates}")
+
+        text = dumps_json(doc).decode("utf-8")
+        rev = self._next_rev(conn)
+        conn.execute(sql, (id_obj, text, rev, *self._index_values(doc, specs)))
+        return rev, len(text)
+
+    def write_many(self, items: Sequence[Tuple[str, Dict[str, Any]]]) -> List[Signature]:
+        """
+        Write several documents in one transaction
+        """
+        specs = list(self.indexes.values())
+        conn = self._conn()
+        signatures: List[Signature] = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for id_obj, doc in items:
+                signatures.append(self._upsert(conn, specs, id_obj, doc))
+            conn.execute("COMMIT")
+        except sqlite3.IntegrityError as e:
+            conn.execute("ROLLBACK")
+            raise DuplicateError(f"Unique index violated: {e}") from e
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return signatures
+
+    def compare_and_write(self, items: Sequence[VersionedItem]) -> List[Union[Signature, ConflictError]]:
+        """
+        Check and write several documents in one transaction
+        """
+        specs = list(self.indexes.values())
+        conn = self._conn()
+        results: List[Union[Signature, ConflictError]] = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for id_obj, doc, expected in items:
+                row = conn.execute(f"SELECT json_extract(doc, '$.version') FROM {self.table} WHERE id = ?",
+                                   (id_obj,)).fetchone()
+                version = (row[0] or 0) if row is not None else 0
+                if expected is not None and expected != version:
+                    results.append(ConflictError(f"Object {id_obj} was changed: version {version}, "
+                                                 f"expected {expected}"))
+                    continue
+                doc["version"] = version + 1
+                results.append(self._upsert(conn, specs, id_obj, doc))
+            conn.execute("COMMIT")
+        except sqlite3.IntegrityError as e:
+            conn.execute("ROLLBACK")
+            raise DuplicateError(f"Unique index violated: {e}") from e
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return results
+
+    def delete(self, id_obj: str) -> bool:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = conn.execute(f"DELETE FROM {self.table} WHERE id = ?", (id_obj,)).rowcount
+            if deleted:
+                self._next_rev(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return bool(deleted)
+
+    def ids(self, after: Optional[str] = None) -> List[str]:
+        if after is None:
+            rows = self._conn().execute(f"SELECT id FROM {self.table} ORDER BY id")
+        else:
+            rows = self._conn().execute(f"SELECT id FROM {self.table} WHERE id > ? ORDER BY id", (after,))
+        return [row[0] for row in rows]
+
+    def signatures(self) -> Dict[str, Signature]:
+        rows = self._conn().execute(f"SELECT id, rev, length(doc) FROM {self.table}")
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def change_token(self) -> Any:
+        return self._conn().execute("SELECT seq FROM cloudshift_sequence WHERE name = 'rev'").fetchone()[0]
+
+    def has_index(self, index: str) -> bool:
+        return index in self.indexes
+
+    def find(self, index: str, value: Any) -> Optional[List[str]]:
+        if index not in self.indexes:
+            return None
+        rows = self._conn().execute(f"SELECT id FROM {self.table} WHERE idx_{index} = ? ORDER BY id", (value,))
+        return [row[0] for row in rows]
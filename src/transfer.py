@@ -0,0 +1,178 @@
+"""Data transfer of a running migration: the selected mount points are copied to a local file sink"""
+
+import errno
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .config import Settings
+from .core import Migration
+from .events import EVENTS, PROGRESS, migration_event
+from .storage import Signature, Storage
+
+TRANSFERRING = "TRANSFERRING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+
+@dataclass
+class MountPointProgress:
+    """
+    Transfer progress of one selected mount point
+
+    Attributes:
+        name (str): Mount point name
+        total_bytes (int): Bytes to transfer
+        bytes_done (int): Bytes transferred
+        bytes_per_second (float): Average rate of this mount point
+        eta_seconds (float): Estimated seconds until this mount point is transferred, None if unknown
+    """
+    name: str
+    total_bytes: int
+    bytes_done: int = 0
+    bytes_per_second: float = 0.0
+    eta_seconds: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "total_bytes": self.total_bytes,
+            "bytes_done": self.bytes_done,
+            "bytes_per_second": round(self.bytes_per_second, 1),
+            "eta_seconds": round(self.eta_seconds, 3) if self.eta_seconds is not None else None,
+        }
+
+
+class DataTransfer:
+    """
+    Writes `MountPoint.total_size * unit` bytes per selected mount point into files under `sink_dir`,
+    in chunks of `chunk_size` and at most `bandwidth` bytes per second (0: as fast as the disk allows).
+    The mount points are transferred one after another.
+    A migration selecting more than `max_bytes` (0: no limit) fails before anything is written.
+
+    The progress is written to `progress_storage` (one document per migration) at most every
+    `report_interval` seconds and when the transfer ends, so it can be read by any process.
+    The transferred files are removed afterwards unless `keep_data` is set.
+    Every progress report is also published to the event bus (EVENTS).
+    """
+
+    def __init__(self, sink_dir: Path, progress_storage: Storage, bandwidth: int = 0, chunk_size: int = 1 << 20,
+                 unit: int = 1, report_interval: float = 1.0, keep_data: bool = False, max_bytes: int = 0):
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be at least 1")
+
+        self.sink_dir = sink_dir
+        self.progress_storage = progress_storage
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.unit = unit
+        self.report_interval = report_interval
+        self.keep_data = keep_data
+        self.max_bytes = max_bytes
+        self._chunk = memoryview(bytes(chunk_size))
+
+    @classmethod
+    def from_settings(cls, settings: Settings, progress_storage: Storage) -> "DataTransfer":
+        return cls(settings.transfer_path, progress_storage,
+                   bandwidth=settings.transfer_bandwidth,
+                   chunk_size=settings.transfer_chunk_size,
+                   unit=settings.transfer_unit,
+                   report_interval=settings.transfer_report_interval,
+                   max_bytes=settings.transfer_max_bytes)
+
+    def run(self, migration: Migration) -> None:
+        """
+        Transfer the selected mount points of a started migration
+
+        :raises OSError: If the sink cannot be written or the migration selects more than `max_bytes`,
+            the progress is reported as FAILED
+        """
+        mount_points = [MountPointProgress(mp.name, mp.total_size * self.unit)
+                        for mp in migration.selected_mount_points]
+        start = time.monotonic()
+        total = sum(progress.total_bytes for progress in mount_points)
+        if self.max_bytes and total > self.max_bytes:
+            self._report(migration, mount_points, start, FAILED)
+            raise OSError(errno.EFBIG, f"Migration selects {total} bytes, at most {self.max_bytes} can be transferred")
+        self._report(migration, mount_points, start, TRANSFERRING)
+        last_report = start
+        done = 0
+
+        migration_dir = self.sink_dir / migration.id
+        migration_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            for number, progress in enumerate(mount_points):
+                mount_point_start = time.monotonic()
+                with open(migration_dir / f"{number}.img", "wb") as sink:
+                    while progress.bytes_done < progress.total_bytes:
+                        size = min(self.chunk_size, progress.total_bytes - progress.bytes_done)
+                        sink.write(self._chunk[:size])
+                        progress.bytes_done += size
+                        done += size
+
+                        now = time.monotonic()
+                        if self.bandwidth:
+                            delay = done / self.bandwidth - (now - start)
+                            if delay > 0:
+                                time.sleep(delay)
+                                now = time.monotonic()
+                        progress.bytes_per_second = progress.bytes_done / max(now - mount_point_start, 1e-9)
+                        if now - last_report >= self.report_interval:
+                            self._report(migration, mount_points, start, TRANSFERRING)
+                            last_report = now
+        except OSError:
+            self._report(migration, mount_points, start, FAILED)
+            raise
+        finally:
+            if not self.keep_data:
+                shutil.rmtree(migration_dir, ignore_errors=True)
+
+        self._report(migration, mount_points, start, DONE)
+
+    def _report(self, migration: Migration, mount_points: List[MountPointProgress], start: float, state: str) -> None:
+        elapsed = time.monotonic() - start
+        total = sum(mount_point.total_bytes for mount_point in mount_points)
+        done = sum(mount_point.bytes_done for mount_point in mount_points)
+        rate = done / elapsed if elapsed > 0 else 0.0
+        estimable = state == TRANSFERRING and rate > 0
+
+        # The mount points are transferred in order: each one is ready when all before it are
+        remaining = 0
+        for mount_point in mount_points:
+            remaining += mount_point.total_bytes - mount_point.bytes_done
+            if mount_point.bytes_done == mount_point.total_bytes:
+                mount_point.eta_seconds = 0.0
+            else:
+                mount_point.eta_seconds = remaining / rate if estimable else None
+
+        if remaining == 0:
+            eta = 0.0
+        else:
+            eta = round(remaining / rate, 3) if estimable else None
+        progress = {
+            "state": state,
+            "total_bytes": total,
+            "bytes_done": done,
+            "bytes_per_second": round(rate, 1),
+            "eta_seconds": eta,
+            "elapsed_seconds": round(elapsed, 3),
+            "updated": time.time(),
+            "mount_points": [mount_point.to_dict() for mount_point in mount_points],
+        }
+        self.progress_storage.write(migration.id, progress)
+        EVENTS.publish(migration_event(PROGRESS, migration, progress=progress))
+
+    # Reading
+    def progress(self, migration_id: str) -> Optional[Dict[str, Any]]:
+        """
+        :return: Last reported progress of a migration, None if it was never run
+        """
+        return self.progress_storage.read(migration_id)
+
+    def progress_signature(self, migration_id: str) -> Optional[Signature]:
+        return self.progress_storage.signature(migration_id)
+
+    def forget(self, migration_id: str) -> None:
+        self.progress_storage.delete(migration_id)
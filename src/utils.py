@@ -1,19 +1,138 @@
 import json
 import os
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, Optional
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+
+class Codec:
+    """
+    Serialization format of the stored documents
+    """
+    name = ""
+
+    def encode(self, obj: dict[str, Any]) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """
+    Pretty-printed JSON (the original format)
+    """
+    name = "json"
+
+    def encode(self, obj: dict[str, Any]) -> bytes:
+        return json.dumps(obj, indent=4, ensure_ascii=False).encode("utf-8")
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        return loads_json(data)
+
+
+class CompactJsonCodec(JsonCodec):
+    """
+    JSON without whitespace
+    """
+    name = "compact"
+
+    def encode(self, obj: dict[str, Any]) -> bytes:
+        return dumps_json(obj)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Compact JSON written with orjson
+    """
+    name = "orjson"
+
+    def encode(self, obj: dict[str, Any]) -> bytes:
+        return orjson.dumps(obj)
+
+
+class MsgpackCodec(Codec):
+    """
+    Binary MessagePack
+    """
+    name = "msgpack"
+
+    def encode(self, obj: dict[str, Any]) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data: bytes) -> dict[str, Any]:
+        return msgpack.unpackb(data, raw=False)
+
+
+def dumps_json(obj: Any) -> bytes:
+    """
+    Compact JSON, with orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads_json(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (JsonCodec(), CompactJsonCodec())}
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec()
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def get_codec(name: str) -> Codec:
+    """
+    :raise ValueError: If the codec is unknown or its library is not installed
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Codec {name} is not available, available: {', '.join(CODECS)}") from None
+
+
+def detect_codec(data: bytes) -> Codec:
+    """
+    Detect the format of a stored document: a document is a JSON object or a MessagePack map
+    """
+    first = data[:1]
+    if first and (0x80 <= first[0] <= 0x8f or first[0] in (0xde, 0xdf)):
+        if msgpack is None:
+            raise ValueError("Document is stored as msgpack, but msgpack is not installed")
+        return CODECS[MsgpackCodec.name]
+    return CODECS[JsonCodec.name]
 
 
 # Safe write(os.replace)
-def write_json(path: Path, obj: dict[str, Any]) -> None:
+def write_json(path: Path, obj: dict[str, Any], codec: Optional[Codec] = None) -> None:
+    data = (codec or CODECS[JsonCodec.name]).encode(obj)
     tmp_path = path.with_suffix(path.suffix + ".tmp")
 
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=4, ensure_ascii=False)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
 
     os.replace(tmp_path, path)
 
 
 def read_json(path: Path) -> dict[str, Any]:
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    """
+    Read a document in any of the supported formats
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    return detect_codec(data).decode(data)
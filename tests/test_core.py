@@ -1,4 +1,10 @@
+import gc
+import json
+import os
 import pytest
+import tracemalloc
+from dataclasses import dataclass
+from typing import List
 
 from src import (
     Credentials,
@@ -177,3 +183,98 @@ def test_migration_run():
     # Test: re-run
     with pytest.raises(BusinessRuleError):
         migration.run(min_to_sleep=0)
+
+
+# Test trusted (not validated) loads
+def test_trusted_from_dict():
+    src = constructor_workload()
+    src.storage.extend(MountPoint(f"/mnt/{i}", i) for i in range(30))
+    migration = Migration(
+        selected_mount_points=src.storage[:3],
+        source=src,
+        migration_target=constructor_migration_target(),
+    )
+
+    data = migration.to_dict()
+    trusted = Migration.from_dict(data, trusted=True)
+    assert trusted == Migration.from_dict(data)
+    assert trusted.to_dict() == data
+    assert trusted.migration_target.cloud_type == CloudType.AWS
+
+    # validation is only skipped for trusted loads
+    data["source"]["ip"] = ""
+    assert Migration.from_dict(data, trusted=True).source.ip == ""
+    with pytest.raises(BusinessRuleError):
+        Migration.from_dict(data)
+
+
+# Test memory footprint: 100k workloads loaded with from_dict, compared to dict-backed, not interned models
+@dataclass(frozen=True)
+class LegacyCredentials:
+    username: str
+    password: str
+    domain: str
+
+
+@dataclass(frozen=True)
+class LegacyMountPoint:
+    name: str
+    total_size: int
+
+
+@dataclass
+class LegacyWorkload:
+    ip: str
+    credentials: LegacyCredentials
+    storage: List[LegacyMountPoint]
+    id: str
+
+
+def legacy_workload_from_dict(data):
+    return LegacyWorkload(ip=data["ip"], credentials=LegacyCredentials(**data["credentials"]),
+                          storage=[LegacyMountPoint(**mp) for mp in data["storage"]], id=data["id"])
+
+
+def bytes_per_entity(build, documents):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entities = [build(doc) for doc in documents]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(entities) == len(documents)
+    return used / len(documents)
+
+
+def test_interned_values():
+    data = {"name": "C:\\", "total_size": 1}
+    assert MountPoint.from_dict(data) is MountPoint.from_dict(dict(data))
+
+    # equal values of other types are not shared
+    assert type(MountPoint.from_dict({"name": "C:\\", "total_size": 1.0}).total_size) is float
+    assert type(MountPoint.from_dict({"name": "C:\\", "total_size": True}, trusted=True).total_size) is bool
+    assert type(MountPoint.from_dict({"name": "C:\\", "total_size": 1}).total_size) is int
+
+    # unknown fields are rejected, also for trusted loads
+    for trusted in (False, True):
+        with pytest.raises(BusinessRuleError):
+            MountPoint.from_dict({"name": "C:\\", "total_size": 1, "size": 2}, trusted)
+        with pytest.raises(BusinessRuleError):
+            Credentials.from_dict({"username": "u", "password": "p", "domain": "d", "token": "t"}, trusted)
+
+
+def test_workload_memory_footprint():
+    count = int(os.environ.get("CLOUDSHIFT_MEMORY_TEST_ENTITIES", 100_000))
+    # Documents as they come from the store: every object has its own strings
+    documents = json.loads(json.dumps([{
+        "ip": f"10.{i // 65536}.{i // 256 % 256}.{i % 256}",
+        "credentials": {"username": "administrator", "password": "secret", "domain": "corp"},
+        "storage": [{"name": name, "total_size": 100 * 1024 ** 3} for name in ("C:\\", "D:\\", "E:\\")],
+        "id": f"workload-{i}",
+    } for i in range(count)]))
+
+    before = bytes_per_entity(legacy_workload_from_dict, documents)
+    after = bytes_per_entity(lambda doc: Workload.from_dict(doc, trusted=True), documents)
+    print(f"\nbytes per workload ({count} workloads): before {before:.0f}, after {after:.0f}")
+
+    assert after < before * 0.6
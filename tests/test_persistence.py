@@ -1,5 +1,12 @@
+import json
+import multiprocessing
+import os
 import pytest
+import sys
 import tempfile
+import threading
+import time
+import zlib
 from pathlib import Path
 
 from src import (
@@ -11,9 +18,21 @@ from src import (
     MigrationTargetRepository,
     MigrationRepository,
     BusinessRuleError,
+    ConflictError,
     DuplicateError,
     MigrationState, NotFoundError,
+    SqliteStorage,
+    FileStorage,
+    ChangeLog,
+    Settings,
+    get_codec,
 )
+from src.metrics import STORAGE_OPERATIONS
+from src.persistence import parse_fields
+from src.snapshot import IndexSnapshot
+from src.storage import Layout
+from src.utils import CODECS, write_json
+from src.import_json import import_json_tree
 from tests.test_core import constructor_workload
 
 
@@ -165,3 +184,659 @@ def test_migration_repository_crud(tmpdir_repo):
     migration.state = MigrationState.SUCCESS
     migration_repository.update(migration)
     assert migration_repository.get(migration.id).state == MigrationState.SUCCESS
+
+
+def test_workload_repository_ip_index(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workload_test = constructor_workload(ip="1.1.1.1")
+    workload_repository_test.create(workload_test)
+
+    assert workload_repository_test.find_by_ip("1.1.1.1").id == workload_test.id
+    with pytest.raises(NotFoundError):
+        workload_repository_test.find_by_ip("1.1.1.2")
+
+    # IP is free again after delete
+    workload_repository_test.delete(workload_test.id)
+    with pytest.raises(NotFoundError):
+        workload_repository_test.find_by_ip("1.1.1.1")
+    workload_repository_test.create(constructor_workload(ip="1.1.1.1"))
+
+
+def test_workload_repository_ip_index_drift(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workload_test = constructor_workload(ip="1.1.1.1")
+    workload_repository_test.create(workload_test)
+
+    # Changes made by another repository instance (another process) are detected
+    other = WorkloadRepository(tmpdir_repo)
+    assert other.find_by_ip("1.1.1.1").id == workload_test.id
+    other.create(constructor_workload(ip="1.1.1.2"))
+    other.delete(workload_test.id)
+
+    with pytest.raises(DuplicateError):
+        workload_repository_test.create(constructor_workload(ip="1.1.1.2"))
+    workload_repository_test.create(constructor_workload(ip="1.1.1.1"))
+
+
+def test_index_snapshot_startup(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workloads = [constructor_workload(ip=f"1.1.1.{i}") for i in range(20)]
+    workload_repository_test.create_many(workloads)
+    workload_repository_test.delete(workloads[0].id)
+    reads = lambda: STORAGE_OPERATIONS.value(collection=tmpdir_repo.name, op="read")
+
+    # Indexes are loaded from the journal, no document is read
+    before = reads()
+    restarted = WorkloadRepository(tmpdir_repo)
+    assert reads() == before
+    assert restarted.find_by_ip("1.1.1.5").id == workloads[5].id
+    assert (tmpdir_repo / ".index.snapshot").exists()
+
+    # Only the documents changed while the service was down are read
+    changed = restarted.get(workloads[1].id).to_dict()
+    changed["ip"] = "10.20.30.40"
+    write_json(tmpdir_repo / f"{workloads[1].id}.json", changed)
+    (tmpdir_repo / f"{workloads[2].id}.json").unlink()
+    before = reads()
+    restarted = WorkloadRepository(tmpdir_repo)
+    assert reads() == before + 1
+    assert restarted.find_by_ip("10.20.30.40").id == workloads[1].id
+    with pytest.raises(NotFoundError):
+        restarted.find_by_ip("1.1.1.2")
+    with pytest.raises(NotFoundError):
+        restarted.find_by_ip("1.1.1.1")
+
+    # An unreadable snapshot only costs a full rebuild
+    (tmpdir_repo / ".index.snapshot").write_bytes(b"{broken")
+    restarted = WorkloadRepository(tmpdir_repo)
+    assert restarted.find_by_ip("1.1.1.5").id == workloads[5].id
+
+
+def test_index_snapshot_concurrent_compaction(tmpdir_repo):
+    # Processes starting together compact the same snapshot at the same time
+    entries = {f"id-{i}": ((1, i), [f"1.1.1.{i}"]) for i in range(50)}
+    snapshots = [IndexSnapshot(tmpdir_repo, ["ip"]) for _ in range(2)]
+    errors = []
+
+    def compact(snapshot):
+        try:
+            for _ in range(100):
+                snapshot.compact(entries)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=compact, args=(snapshot,)) for snapshot in snapshots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert snapshots[0].load() == entries
+    assert list(tmpdir_repo.glob("*.tmp")) == []
+
+
+def test_signature_changes_within_mtime_granularity(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workload = workload_repository_test.create(constructor_workload(ip="1.1.1.1"))
+    assert workload_repository_test.get(workload.id).ip == "1.1.1.1"
+    etag = workload_repository_test.etag(workload.id)
+
+    # rewritten with the same size and within the mtime granularity of the filesystem
+    path = workload_repository_test.storage.path(workload.id)
+    st = path.stat()
+    doc = json.loads(path.read_bytes())
+    doc["ip"] = "1.1.1.2"
+    write_json(path, doc)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert path.stat().st_size == st.st_size
+
+    assert workload_repository_test.etag(workload.id) != etag
+    assert workload_repository_test.get(workload.id).ip == "1.1.1.2"
+
+
+def test_indexes_see_writes_of_other_instances_before_own_write(tmpdir_repo):
+    first = WorkloadRepository(tmpdir_repo)
+    other = WorkloadRepository(tmpdir_repo)
+    own = [first.create(constructor_workload(ip=f"1.1.1.{i}")) for i in range(2)]
+
+    # written by another process, then by this one before the next lookup
+    created = other.create(constructor_workload(ip="2.2.2.2"))
+    first.delete(own[0].id)
+    assert first.find_ids("ip", "2.2.2.2") == [created.id]
+
+    other.delete(created.id)
+    first.delete(own[1].id)
+    assert first.find_ids("ip", "2.2.2.2") == []
+
+
+def test_repository_cache(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workload_test = constructor_workload(ip="1.1.1.1")
+    workload_repository_test.create(workload_test)
+
+    # write-through: the first get is already served from the cache
+    hits = workload_repository_test.cache_hits
+    first = workload_repository_test.get(workload_test.id)
+    assert workload_repository_test.cache_hits == hits + 1
+
+    # callers get their own copy
+    first.storage.clear()
+    assert len(workload_repository_test.get(workload_test.id).storage) == 2
+
+    # a write made by another repository instance invalidates the entry
+    other = WorkloadRepository(tmpdir_repo)
+    changed = other.get(workload_test.id)
+    changed.credentials = Credentials("other", "p", "d")
+    other.update(changed)
+    misses = workload_repository_test.cache_misses
+    assert workload_repository_test.get(workload_test.id).credentials.username == "other"
+    assert workload_repository_test.cache_misses == misses + 1
+
+    # invalidated on delete
+    workload_repository_test.delete(workload_test.id)
+    assert workload_repository_test.cache_stats()["size"] == 0
+
+
+def test_repository_cache_bounded(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo, cache_size=2)
+    for i in range(5):
+        workload_repository_test.create(constructor_workload(ip=f"1.1.1.{i}"))
+
+    assert workload_repository_test.cache_stats()["size"] == 2
+
+
+def test_migration_repository_secondary_indexes(tmpdir_repo):
+    migration_repository = MigrationRepository(tmpdir_repo)
+    src = constructor_workload(ip="0.0.0.0")
+    targets = [MigrationTarget(cloud_type=cloud_type, cloud_credentials=Credentials("u", "p", "d"),
+                               target_vm=constructor_workload(ip=f"1.1.1.{i}"))
+               for i, cloud_type in enumerate((CloudType.VCLOUD, CloudType.AWS))]
+    migrations = [Migration(selected_mount_points=[], source=src, migration_target=target) for target in targets]
+    for migration in migrations:
+        migration_repository.create(migration)
+
+    assert migration_repository.find_ids("source_id", src.id) == sorted(m.id for m in migrations)
+    assert migration_repository.find_ids("migration_target_id", targets[1].id) == [migrations[1].id]
+    assert migration_repository.find_ids("cloud_type", "VCLOUD") == [migrations[0].id]
+    assert migration_repository.query(state=None) is None
+
+    # updates move the migration between index values
+    migrations[0].state = MigrationState.SUCCESS
+    migration_repository.update(migrations[0])
+    assert migration_repository.find_ids("state", "SUCCESS") == [migrations[0].id]
+    assert migration_repository.query(state="NOT_STARTED", source_id=src.id) == [migrations[1].id]
+    assert migration_repository.query(state="SUCCESS", cloud_type="AWS") == []
+
+    # changes made by another repository instance (another process) are detected
+    other = MigrationRepository(tmpdir_repo)
+    other.delete(migrations[1].id)
+    assert migration_repository.find_ids("source_id", src.id) == [migrations[0].id]
+
+    migration_repository.delete(migrations[0].id)
+    assert migration_repository.find_ids("state", "SUCCESS") == []
+    with pytest.raises(ValueError):
+        migration_repository.find_ids("ip", "0.0.0.0")
+
+
+# Test optimistic concurrency
+def test_repository_versions(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workload_test = workload_repository_test.create(constructor_workload(ip="1.1.1.1"))
+    assert workload_test.version == 1
+
+    first = workload_repository_test.get(workload_test.id)
+    second = workload_repository_test.get(workload_test.id)
+    first.credentials = Credentials("first", "p", "d")
+    assert workload_repository_test.update(first).version == 2
+
+    # the second writer read version 1 and loses
+    second.credentials = Credentials("second", "p", "d")
+    with pytest.raises(ConflictError):
+        workload_repository_test.update(second)
+    assert workload_repository_test.get(workload_test.id).credentials.username == "first"
+
+    # without a version the update is unconditional
+    second.version = None
+    assert workload_repository_test.update(second).version == 3
+
+    # bulk updates report conflicts per item
+    stale = workload_repository_test.get(workload_test.id)
+    stale.version = 1
+    assert isinstance(workload_repository_test.update_many([stale])[0], ConflictError)
+
+
+def _increment_counter(data_dir, workload_id, count):
+    repository = WorkloadRepository(data_dir)
+    done = 0
+    while done < count:
+        workload = repository.get(workload_id)
+        workload.credentials = Credentials(str(int(workload.credentials.username) + 1), "p", "d")
+        try:
+            repository.update(workload)
+        except ConflictError:
+            continue
+        done += 1
+
+
+def test_repository_versions_across_processes(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workload_test = constructor_workload(ip="1.1.1.1")
+    workload_test.credentials = Credentials("0", "p", "d")
+    workload_repository_test.create(workload_test)
+
+    processes = [multiprocessing.Process(target=_increment_counter, args=(tmpdir_repo, workload_test.id, 20))
+                 for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # no increment is lost
+    assert workload_repository_test.get(workload_test.id).credentials.username == "80"
+
+
+def _try_stripe_lock(lock_path, stripe, result):
+    import fcntl
+    with open(lock_path, "a+b") as lock_file:
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, stripe)
+        except OSError:
+            result.put(False)
+        else:
+            result.put(True)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="fcntl locks")
+def test_stripe_lock_survives_other_stripes(tmpdir_repo):
+    storage = FileStorage(tmpdir_repo)
+    stripe = zlib.crc32(b"x") % storage.LOCK_STRIPES
+    assert stripe != zlib.crc32(b"y") % storage.LOCK_STRIPES
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with storage._locked("x"):
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    try:
+        held.wait()
+        # another thread takes and releases another stripe of the same file
+        with FileStorage(tmpdir_repo)._locked("y"):
+            pass
+        result = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_try_stripe_lock, args=(tmpdir_repo / ".lock", stripe, result))
+        process.start()
+        process.join()
+        assert result.get() is False
+    finally:
+        release.set()
+        holder.join()
+
+
+# Test cross-process cache invalidation
+def _rename_workload(data_dir, log_path, workload_id, username):
+    repository = WorkloadRepository(data_dir, change_log=ChangeLog(log_path))
+    workload = repository.get(workload_id)
+    workload.credentials = Credentials(username, "p", "d")
+    repository.update(workload)
+
+
+def test_change_log_bounded_staleness(tmpdir_repo):
+    log_path = tmpdir_repo / ".workloads.changes"
+    data_dir = tmpdir_repo / "workloads"
+    writer = WorkloadRepository(data_dir, change_log=ChangeLog(log_path, max_staleness=0.2))
+    reader = WorkloadRepository(data_dir, change_log=ChangeLog(log_path, max_staleness=0.2))
+    workload_test = writer.create(constructor_workload(ip="1.1.1.1"))
+
+    # cached entities are used without checking the file
+    reader.get(workload_test.id)
+    hits = reader.cache_hits
+    reader.get(workload_test.id)
+    assert reader.cache_hits == hits + 1
+
+    # writes of other processes are seen after at most max_staleness
+    process = multiprocessing.Process(target=_rename_workload, args=(data_dir, log_path, workload_test.id, "other"))
+    process.start()
+    process.join()
+    time.sleep(0.2)
+    assert reader.get(workload_test.id).credentials.username == "other"
+    assert reader.find_by_ip("1.1.1.1").credentials.username == "other"
+
+    writer.delete(workload_test.id)
+    writer.create(constructor_workload(ip="1.1.1.2"))
+    time.sleep(0.2)
+    with pytest.raises(NotFoundError):
+        reader.get(workload_test.id)
+    assert reader.find_ids("ip", "1.1.1.1") == []
+
+    # a conflict drops the outdated cached entity
+    stale = reader.find_by_ip("1.1.1.2")
+    updated = writer.find_by_ip("1.1.1.2")
+    updated.credentials = Credentials("writer", "p", "d")
+    writer.update(updated)
+    with pytest.raises(ConflictError):
+        reader.update(stale)
+    assert reader.find_by_ip("1.1.1.2").credentials.username == "writer"
+
+
+def test_change_log_rotation(tmpdir_repo):
+    log_path = tmpdir_repo / ".workloads.changes"
+    writer = WorkloadRepository(tmpdir_repo, change_log=ChangeLog(log_path, max_staleness=0, max_size=64))
+    reader = WorkloadRepository(tmpdir_repo, change_log=ChangeLog(log_path, max_staleness=0))
+    workload_test = writer.create(constructor_workload(ip="1.1.1.1"))
+    assert reader.get(workload_test.id).version == 1
+
+    # the log is rotated: the reader has missed changes and forgets everything
+    for _ in range(5):
+        workload_test = writer.update(workload_test)
+    assert log_path.stat().st_size < 64
+    assert reader.get(workload_test.id).version == 6
+
+
+# Test SQLite storage backend
+def sqlite_repositories(tmpdir_repo):
+    db = tmpdir_repo / "test.db"
+    return (
+        WorkloadRepository(storage=SqliteStorage(db, "workloads", WorkloadRepository.index_specs)),
+        MigrationTargetRepository(storage=SqliteStorage(db, "migration_targets")),
+        MigrationRepository(storage=SqliteStorage(db, "migrations", MigrationRepository.index_specs)),
+    )
+
+
+def test_sqlite_workload_repository(tmpdir_repo):
+    workload_repository_test, _, _ = sqlite_repositories(tmpdir_repo)
+    workload_test = constructor_workload(ip="1.1.1.1")
+
+    workload_repository_test.create(workload_test)
+    with pytest.raises(DuplicateError):
+        workload_repository_test.create(constructor_workload(ip="1.1.1.1"))
+    assert workload_repository_test.find_by_ip("1.1.1.1").id == workload_test.id
+
+    workload_test.credentials = Credentials("u", "p", "d")
+    workload_repository_test.update(workload_test)
+    assert workload_repository_test.get(workload_test.id).credentials.username == "u"
+
+    workload_repository_test.delete(workload_test.id)
+    with pytest.raises(NotFoundError):
+        workload_repository_test.get(workload_test.id)
+    with pytest.raises(NotFoundError):
+        workload_repository_test.delete(workload_test.id)
+    workload_repository_test.create(constructor_workload(ip="1.1.1.1"))
+
+
+def test_sqlite_migration_repository(tmpdir_repo):
+    _, migration_target_repository, migration_repository = sqlite_repositories(tmpdir_repo)
+    src = constructor_workload(ip="0.0.0.0")
+    target = MigrationTarget(
+        cloud_type=CloudType.VCLOUD,
+        cloud_credentials=Credentials("u", "p", "d"),
+        target_vm=constructor_workload(ip="1.1.1.1"),
+    )
+    migration_target_repository.create(target)
+    migration = Migration(selected_mount_points=[src.storage[0]], source=src, migration_target=target)
+    migration_repository.create(migration)
+
+    stale = migration_repository.get(migration.id)
+    migration.state = MigrationState.SUCCESS
+    migration_repository.update(migration)
+    assert migration_repository.get(migration.id).state == MigrationState.SUCCESS
+    with pytest.raises(ConflictError):
+        migration_repository.update(stale)
+    assert migration_repository.storage.find("state", "SUCCESS") == [migration.id]
+    assert migration_repository.storage.find("source_id", src.id) == [migration.id]
+    assert migration_repository.query(migration_target_id=target.id, cloud_type="VCLOUD") == [migration.id]
+    assert [m.id for m in migration_repository.list_all()] == [migration.id]
+    assert migration_target_repository.get(target.id).cloud_type == CloudType.VCLOUD
+
+
+def test_import_json_tree(tmpdir_repo):
+    data = tmpdir_repo / "data"
+    workload_repository_test = WorkloadRepository(data / "workloads")
+    for i in range(3):
+        workload_repository_test.create(constructor_workload(ip=f"1.1.1.{i}"))
+
+    counts = import_json_tree(data, data / "cloudshift.db", batch_size=2)
+    assert counts == {"workloads": 3, "migration_targets": 0, "migrations": 0}
+
+    settings = Settings(storage_backend="sqlite", data_dir=data)
+    imported = WorkloadRepository.from_settings(settings, "workloads")
+    assert sorted(w.ip for w in imported.list_all()) == ["1.1.1.0", "1.1.1.1", "1.1.1.2"]
+    assert imported.find_by_ip("1.1.1.2").ip == "1.1.1.2"
+
+
+# Test migrations stored by reference
+def test_migration_repository_references(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo / "workloads")
+    migration_target_repository = MigrationTargetRepository(tmpdir_repo / "migration_targets")
+    migration_repository = MigrationRepository(tmpdir_repo / "migrations",
+                                               workload_repository=workload_repository_test,
+                                               migration_target_repository=migration_target_repository)
+    src = workload_repository_test.create(constructor_workload(ip="0.0.0.0"))
+    target = migration_target_repository.create(MigrationTarget(
+        cloud_type=CloudType.VCLOUD,
+        cloud_credentials=Credentials("u", "p", "d"),
+        target_vm=constructor_workload(ip="1.1.1.1"),
+    ))
+    migration = Migration(selected_mount_points=[src.storage[0]], source=src, migration_target=target)
+    migration_repository.create(migration)
+
+    stored = migration_repository.storage.read(migration.id)
+    assert stored["source_id"] == src.id and "source" not in stored
+    assert migration_repository.get(migration.id).source.credentials.username == "user"
+
+    # the workload update is seen by the cached migration
+    src.credentials = Credentials("new", "p", "d")
+    workload_repository_test.update(src)
+    assert migration_repository.get(migration.id).source.credentials.username == "new"
+
+    # saving a migration never writes its embedded target
+    migration = migration_repository.get(migration.id)
+    migration.migration_target.cloud_credentials = Credentials("stale", "p", "d")
+    migration.migration_target.target_vm = constructor_workload(ip="9.9.9.9")
+    migration = migration_repository.update(migration)
+    stored_target = migration_target_repository.get(target.id)
+    assert stored_target.cloud_credentials.username == "u"
+    assert stored_target.target_vm.ip == "1.1.1.1"
+
+    # only the target VM produced by a run is saved to the target repository
+    target.cloud_credentials = Credentials("u2", "p", "d")
+    migration_target_repository.update(target)
+    migration = migration_repository.get(migration.id)
+    migration.run(min_to_sleep=0)
+    migration_repository.update(migration)
+    migration_repository.save_target_vm(migration)
+    stored_target = migration_target_repository.get(target.id)
+    assert stored_target.target_vm.credentials.username == "new"
+    assert stored_target.cloud_credentials.username == "u2"
+
+    # the entity tag follows the referenced workload
+    etag = migration_repository.etag(migration.id)
+    src.credentials = Credentials("newer", "p", "d")
+    workload_repository_test.update(src)
+    assert migration_repository.etag(migration.id) != etag
+    assert migration_repository.etag("missing") is None
+
+    # the cloud type of migrations stored by reference is found through their target
+    assert migration_repository.find_ids("cloud_type", "VCLOUD") == [migration.id]
+    assert migration_repository.find_ids("cloud_type", "AWS") == []
+
+    # references should exist
+    orphan = Migration(selected_mount_points=[], source=constructor_workload(ip="10.20.30.40"), migration_target=target)
+    with pytest.raises(NotFoundError):
+        migration_repository.create(orphan)
+
+
+def test_field_projection(tmpdir_repo):
+    assert parse_fields("id, source.ip,source") == {"id": None, "source": None}
+    assert parse_fields("source.ip,source.storage.name") == {"source": {"ip": None, "storage": {"name": None}}}
+    with pytest.raises(BusinessRuleError):
+        parse_fields("source..ip")
+
+    workload_repository_test = WorkloadRepository(tmpdir_repo / "workloads")
+    target_repository = MigrationTargetRepository(tmpdir_repo / "migration_targets")
+    migration_repository = MigrationRepository(tmpdir_repo / "migrations", workload_repository=workload_repository_test,
+                                               migration_target_repository=target_repository)
+    source = workload_repository_test.create(constructor_workload(ip="1.1.1.1"))
+    target = target_repository.create(MigrationTarget(
+        cloud_type=CloudType.VCLOUD,
+        cloud_credentials=Credentials("u", "p", "d"),
+        target_vm=constructor_workload(ip="2.2.2.2"),
+    ))
+    migration = migration_repository.create(Migration(selected_mount_points=[], source=source,
+                                                      migration_target=target))
+    with pytest.raises(BusinessRuleError):
+        migration_repository.projection("id,source_id")
+
+    projection = migration_repository.projection("state,source.ip")
+    assert json.loads(migration_repository.get_raw(migration.id, projection=projection)) == \
+        {"state": "NOT_STARTED", "source": {"ip": "1.1.1.1"}}
+
+    # references which are not requested are not read
+    target_repository.delete(target.id)
+    projection = migration_repository.projection("id,source.credentials")
+    assert json.loads(migration_repository.get_raw(migration.id, redact=True, projection=projection)) == \
+        {"id": migration.id, "source": {"credentials": {"username": "user", "password": "***", "domain": "domain"}}}
+    with pytest.raises(NotFoundError):
+        migration_repository.get_raw(migration.id)
+
+
+# Test sharded directory layout
+def test_sharded_layout(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(storage=FileStorage(tmpdir_repo, shard_levels=2))
+    workloads = [workload_repository_test.create(constructor_workload(ip=f"1.1.1.{i}")) for i in range(20)]
+    first = workloads[0].id
+    assert (tmpdir_repo / first[:2] / first[2:4] / f"{first}.json").is_file()
+    assert not list(tmpdir_repo.glob("*.json"))
+
+    # the layout belongs to the directory
+    other = WorkloadRepository(tmpdir_repo)
+    assert other.storage.layout.levels == 2
+    assert [w.id for w in other.list_all()] == sorted(w.id for w in workloads)
+    assert other.storage.ids(after=sorted(w.id for w in workloads)[9]) == sorted(w.id for w in workloads)[10:]
+
+    # creates and deletes of another instance are seen
+    other.create(constructor_workload(ip="2.2.2.2"))
+    other.delete(first)
+    with pytest.raises(DuplicateError):
+        workload_repository_test.create(constructor_workload(ip="2.2.2.2"))
+    workload_repository_test.create(constructor_workload(ip="1.1.1.0"))
+
+
+def test_sharded_layout_updates_across_instances(tmpdir_repo):
+    migration_repository = MigrationRepository(storage=FileStorage(tmpdir_repo, shard_levels=2))
+    migration = migration_repository.create(Migration(selected_mount_points=[], source=constructor_workload(),
+                                                      migration_target=MigrationTarget(
+                                                          cloud_type=CloudType.VCLOUD,
+                                                          cloud_credentials=Credentials("u", "p", "d"),
+                                                          target_vm=constructor_workload(ip="1.1.1.1"))))
+    other = MigrationRepository(storage=FileStorage(tmpdir_repo))
+    changed = other.get(migration.id)
+    assert migration_repository.find_ids("state", "NOT_STARTED") == [migration.id]
+    token = migration_repository.storage.change_token()
+
+    # an update by another instance (another process) is seen by the indexes
+    changed.state = MigrationState.SUCCESS
+    other.update(changed)
+    assert migration_repository.storage.change_token() != token
+    assert migration_repository.find_ids("state", "NOT_STARTED") == []
+    assert migration_repository.find_ids("state", "SUCCESS") == [migration.id]
+
+
+def test_reshard_while_writing(tmpdir_repo):
+    workload_repository_test = WorkloadRepository(tmpdir_repo)
+    workloads = [workload_repository_test.create(constructor_workload(ip=f"1.1.{i // 250}.{i % 250}"))
+                 for i in range(300)]
+    stop = threading.Event()
+    written = {}
+
+    def rename():
+        n = 0
+        while not stop.is_set():
+            workload = workload_repository_test.get(workloads[n % len(workloads)].id)
+            workload.credentials = Credentials(f"user-{n}", "p", "d")
+            workload_repository_test.update(workload)
+            written[workload.id] = f"user-{n}"
+            n += 1
+
+    writer = threading.Thread(target=rename)
+    writer.start()
+    try:
+        # another instance, as the reshard tool in another process;
+        # documents updated meanwhile are already written in the new layout
+        assert 0 < FileStorage(tmpdir_repo).reshard(2) <= len(workloads)
+    finally:
+        stop.set()
+        writer.join()
+
+    assert written
+    assert not list(tmpdir_repo.glob("*.json"))
+    reader = WorkloadRepository(tmpdir_repo)
+    assert reader.storage.layout == Layout(2)
+    assert len(reader.list_all()) == len(workloads)
+    for id_obj, username in written.items():
+        assert reader.get(id_obj).credentials.username == username
+
+    # and back
+    assert FileStorage(tmpdir_repo).reshard(0) == len(workloads)
+    assert len(list(tmpdir_repo.glob("*.json"))) == len(workloads)
+    assert [p for p in tmpdir_repo.iterdir() if p.is_dir()] == []
+    assert len(WorkloadRepository(tmpdir_repo).list_all()) == len(workloads)
+
+
+# Test codecs of the JSON store
+def test_mixed_codecs(tmpdir_repo):
+    codecs = [name for name in ("json", "compact", "orjson", "msgpack") if name in CODECS]
+    workloads = []
+    for i, name in enumerate(codecs):
+        writer = WorkloadRepository(storage=FileStorage(tmpdir_repo, get_codec(name)))
+        workloads.append(writer.create(constructor_workload(ip=f"1.1.1.{i}")))
+
+    reader = WorkloadRepository(tmpdir_repo)
+    assert sorted(w.id for w in reader.list_all()) == sorted(w.id for w in workloads)
+    assert reader.get(workloads[-1].id).storage == workloads[-1].storage
+
+    with pytest.raises(ValueError):
+        get_codec("unknown")
+
+
+# Test raw reads
+def test_raw_documents(tmpdir_repo):
+    codecs = [name for name in ("json", "compact", "msgpack") if name in CODECS]
+    workloads = []
+    for i, name in enumerate(codecs):
+        writer = WorkloadRepository(storage=FileStorage(tmpdir_repo / "workloads", get_codec(name)))
+        workloads.append(writer.create(constructor_workload(ip=f"1.1.1.{i}")))
+    workload_repository_test = WorkloadRepository(tmpdir_repo / "workloads")
+
+    # every codec gives the JSON of to_dict()
+    for workload in workloads:
+        assert json.loads(workload_repository_test.get_raw(workload.id)) == workload.to_dict()
+        assert b"\n" not in workload_repository_test.get_raw(workload.id, single_line=True)
+    redacted = json.loads(workload_repository_test.get_raw(workloads[0].id, redact=True))
+    assert redacted["credentials"]["password"] == "***" and redacted["credentials"]["username"] == "user"
+    with pytest.raises(NotFoundError):
+        workload_repository_test.get_raw("missing")
+
+    ids = sorted(w.id for w in workloads)
+    page, cursor = workload_repository_test.list_raw_page(2)
+    assert [json.loads(raw)["id"] for raw in page] == ids[:2] and cursor == ids[1]
+
+    # migrations stored by reference are returned with full copies
+    target_repository = MigrationTargetRepository(tmpdir_repo / "migration_targets")
+    migration_repository = MigrationRepository(tmpdir_repo / "migrations", workload_repository=workload_repository_test,
+                                               migration_target_repository=target_repository)
+    target = target_repository.create(MigrationTarget(
+        cloud_type=CloudType.VCLOUD,
+        cloud_credentials=Credentials("u", "p", "d"),
+        target_vm=constructor_workload(ip="2.2.2.2"),
+    ))
+    migration = migration_repository.create(Migration(selected_mount_points=[], source=workloads[0],
+                                                      migration_target=target))
+    assert json.loads(migration_repository.get_raw(migration.id)) == migration.to_dict()
+    redacted = json.loads(migration_repository.get_raw(migration.id, redact=True))
+    assert redacted["source"]["credentials"]["password"] == "***"
+    assert redacted["migration_target"]["cloud_credentials"]["password"] == "***"
+    assert redacted["migration_target"]["target_vm"]["credentials"]["password"] == "***"
@@ -0,0 +1,449 @@
+"""
+Test REST API routes in-process (no running server needed)
+"""
+
+import cProfile
+import json
+import pytest
+import tempfile
+import threading
+import time
+from dataclasses import replace
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+from src import WorkloadRepository, MigrationTargetRepository, MigrationRepository, MigrationRunner, FileStorage
+from src.events import EVENTS
+from src.transfer import DataTransfer
+from src.metrics import LIST_CACHE_REQUESTS
+from src.rest_api.listing import LIST_CACHE
+from src.rest_api.main import app
+from src.rest_api.profiling import RequestProfiler, ProfileStore
+from src.rest_api.routers import workloads, migrations, migration_targets, admin
+
+
+@pytest.fixture
+def client(monkeypatch):
+    with tempfile.TemporaryDirectory() as d:
+        data = Path(d)
+        monkeypatch.setattr(workloads, "workload_repository", WorkloadRepository(data / "workloads"))
+        monkeypatch.setattr(migration_targets, "migration_target_repository",
+                            MigrationTargetRepository(data / "migration_targets"))
+        migration_repository = MigrationRepository(data / "migrations")
+        transfer = DataTransfer(data / "transfers", FileStorage(data / "migration_progress"))
+        migration_runner = MigrationRunner(migration_repository, max_workers=2, transfer=transfer)
+        monkeypatch.setattr(migrations, "migration_repository", migration_repository)
+        monkeypatch.setattr(migrations, "migration_runner", migration_runner)
+        LIST_CACHE.clear()
+        yield TestClient(app)
+        migration_runner.shutdown()
+
+
+def workload_dict(ip="10.0.0.1"):
+    return {
+        "ip": ip,
+        "credentials": {"username": "user", "password": "pass", "domain": "dom"},
+        "storage": [{"name": "D:\\", "total_size": 100}],
+    }
+
+
+def migration_target_dict(ip="10.0.1.1"):
+    return {
+        "cloud_type": "VCLOUD",
+        "cloud_credentials": {"username": "u_c", "password": "p_c", "domain": "d_c"},
+        "target_vm": workload_dict(ip) | {"storage": []},
+    }
+
+
+def create_migration(client, source, target):
+    data = {
+        "selected_mount_points": [{"name": "D:\\", "total_size": 100}],
+        "source": source,
+        "migration_target": target,
+    }
+    resp = client.post("/migrations/", json=data)
+    assert resp.status_code == 200
+    return resp.json()
+
+
+def test_list_workloads_pagination(client):
+    for i in range(5):
+        assert client.post("/workloads/", json=workload_dict(f"10.0.0.{i}")).status_code == 200
+
+    seen = []
+    after = None
+    while True:
+        params = {"limit": 2} | ({"after": after} if after else {})
+        resp = client.get("/workloads/", params=params)
+        assert resp.status_code == 200
+        assert len(resp.json()) <= 2
+        seen += [w["id"] for w in resp.json()]
+        after = resp.headers.get("X-Next-Cursor")
+        if after is None:
+            break
+
+    assert seen == sorted(seen)
+    assert len(seen) == 5
+    assert len(client.get("/workloads/").json()) == 5
+
+
+def test_list_workloads_filters(client):
+    client.post("/workloads/", json=workload_dict("10.0.0.1"))
+    client.post("/workloads/", json=workload_dict("10.0.0.2"))
+    client.post("/workloads/", json=workload_dict("192.168.0.1"))
+
+    assert [w["ip"] for w in client.get("/workloads/", params={"ip": "10.0.0.2"}).json()] == ["10.0.0.2"]
+    assert client.get("/workloads/", params={"ip": "1.1.1.1"}).json() == []
+    assert len(client.get("/workloads/", params={"ip_prefix": "10."}).json()) == 2
+
+
+def test_list_migrations_ndjson_and_state(client):
+    source = client.post("/workloads/", json=workload_dict()).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    mig = create_migration(client, source, target)
+
+    resp = client.get("/migrations/", params={"format": "ndjson"})
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [m["id"] for m in lines] == [mig["id"]]
+
+    assert len(client.get("/migrations/", params={"state": "NOT_STARTED"}).json()) == 1
+    assert client.get("/migrations/", params={"state": "RUNNING"}).json() == []
+    assert client.get("/migrations/", params={"state": "BOGUS"}).status_code == 422
+
+
+def test_list_migrations_index_filters(client):
+    source = client.post("/workloads/", json=workload_dict()).json()
+    other_source = client.post("/workloads/", json=workload_dict("10.0.0.2")).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    mig = create_migration(client, source, target)
+    other = create_migration(client, other_source, target)
+
+    def ids(**params):
+        return [m["id"] for m in client.get("/migrations/", params=params).json()]
+
+    assert ids(source_id=source["id"]) == [mig["id"]]
+    assert ids(migration_target_id=target["id"]) == sorted([mig["id"], other["id"]])
+    assert ids(cloud_type="VCLOUD", source_id=other_source["id"]) == [other["id"]]
+    assert ids(cloud_type="AWS") == []
+    assert ids(state="NOT_STARTED", migration_target_id=target["id"], limit=1) == [min(mig["id"], other["id"])]
+
+    client.delete(f"/migrations/{mig['id']}")
+    assert ids(source_id=source["id"]) == []
+
+
+def test_run_migration_in_background(client):
+    source = client.post("/workloads/", json=workload_dict()).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    mig = create_migration(client, source, target)
+
+    resp = client.post(f"/migrations/{mig['id']}/run")
+    assert resp.status_code == 202
+    assert resp.json() == {"status": "RUNNING"}
+
+    migrations.migration_runner.wait(mig["id"], timeout=5)
+    status = client.get(f"/migrations/{mig['id']}/status").json()
+    progress = status.pop("progress")
+    assert status == {"status": "SUCCESS", "phase": None, "queue_position": None}
+    assert progress["state"] == "DONE"
+    assert (progress["bytes_done"], progress["total_bytes"], progress["eta_seconds"]) == (100, 100, 0.0)
+    assert [(mp["name"], mp["bytes_done"]) for mp in progress["mount_points"]] == [("D:\\", 100)]
+    assert client.post(f"/migrations/{mig['id']}/run").status_code == 422
+
+
+def test_migration_status_events(client):
+    source = client.post("/workloads/", json=workload_dict()).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    mig = create_migration(client, source, target)
+    transfer = migrations.migration_runner.transfer
+    transfer.bandwidth, transfer.chunk_size, transfer.report_interval = 1000, 10, 0.02
+
+    # the stream stays open until the migration is finished
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(resp=client.get(f"/migrations/{mig['id']}/events")))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while EVENTS.subscriber_count() == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    assert client.post(f"/migrations/{mig['id']}/run").status_code == 202
+    thread.join(5)
+
+    resp = result["resp"]
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    events = [json.loads(line[len("data: "):]) for line in resp.text.splitlines() if line.startswith("data: ")]
+    assert events[0]["type"] == "status" and events[0]["state"] == "NOT_STARTED"
+    assert [e["phase"] for e in events if e["type"] == "phase"] == ["QUEUED", "EXECUTING", None]
+    assert [e["state"] for e in events if e["type"] == "state"] == ["RUNNING", "SUCCESS"]
+    progress = [e["progress"] for e in events if e["type"] == "progress"]
+    assert progress[-1]["state"] == "DONE" and len(progress) >= 3
+    assert EVENTS.subscriber_count() == 0
+
+    # finished migrations only get their status
+    events = client.get(f"/migrations/{mig['id']}/events").text
+    assert events.count("data: ") == 1 and '"state":"SUCCESS"' in events
+    assert client.get("/migrations/missing/events").status_code == 404
+
+
+def test_bulk_create_and_update_workloads(client):
+    client.post("/workloads/", json=workload_dict("10.0.0.1"))
+    items = [
+        workload_dict("10.0.0.2"),
+        workload_dict("10.0.0.1"),  # already stored
+        workload_dict("10.0.0.2"),  # repeated in the batch
+        workload_dict(""),          # invalid
+        {"ip": "10.0.0.5"},         # malformed
+        workload_dict("10.0.0.3"),
+    ]
+    resp = client.post("/workloads/bulk", json=items)
+    assert resp.status_code == 200
+    body = resp.json()
+    assert [r["status"] for r in body["results"]] == [201, 400, 400, 422, 422, 201]
+    assert (body["written"], body["failed"]) == (2, 4)
+    assert len(client.get("/workloads/").json()) == 3
+
+    created = client.get(f"/workloads/{body['results'][0]['id']}").json()
+    changed = created | {"credentials": {"username": "u2", "password": "p", "domain": "d"}}
+    other = client.get(f"/workloads/{body['results'][5]['id']}").json()
+    resp = client.put("/workloads/bulk", json=[changed, other | {"ip": "9.9.9.9"}, workload_dict("1.1.1.1")])
+    assert [r["status"] for r in resp.json()["results"]] == [200, 422, 404]
+    assert client.get(f"/workloads/{created['id']}").json()["credentials"]["username"] == "u2"
+
+
+def test_bulk_create_migrations(client):
+    source = client.post("/workloads/", json=workload_dict()).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    item = {"selected_mount_points": [{"name": "D:\\", "total_size": 100}], "source": source, "migration_target": target}
+
+    resp = client.post("/migrations/bulk", json=[item, item])
+    assert resp.json()["written"] == 2
+    assert len({r["id"] for r in resp.json()["results"]}) == 2
+
+
+def test_conditional_get_and_put(client):
+    workload = client.post("/workloads/", json=workload_dict()).json()
+    url = f"/workloads/{workload['id']}"
+
+    resp = client.get(url)
+    etag = resp.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    # a stale If-Match is rejected, the current one is accepted
+    changed = workload | {"credentials": {"username": "other", "password": "pass", "domain": "dom"}}
+    resp = client.put(url, json=changed, headers={"If-Match": etag})
+    assert resp.status_code == 200
+    new_etag = resp.headers["ETag"]
+    assert new_etag != etag
+    assert client.put(url, json=changed, headers={"If-Match": etag}).status_code == 412
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+    assert client.get(url, headers={"If-None-Match": new_etag}).status_code == 304
+
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    resp = client.get(f"/migration_targets/{target['id']}")
+    assert resp.status_code == 200
+    assert client.get(f"/migration_targets/{target['id']}",
+                      headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+
+    mig = create_migration(client, workload, target)
+    status = client.get(f"/migrations/{mig['id']}/status")
+    assert client.get(f"/migrations/{mig['id']}/status",
+                      headers={"If-None-Match": status.headers["ETag"]}).status_code == 304
+
+
+def test_conditional_list(client):
+    client.post("/workloads/", json=workload_dict())
+    resp = client.get("/workloads/")
+    etag = resp.headers["ETag"]
+    assert client.get("/workloads/", headers={"If-None-Match": etag}).status_code == 304
+    # the query is part of the version
+    assert client.get("/workloads/", params={"limit": 1}, headers={"If-None-Match": etag}).status_code == 200
+
+    client.post("/workloads/", json=workload_dict("10.0.0.2"))
+    resp = client.get("/workloads/", headers={"If-None-Match": etag})
+    assert resp.status_code == 200 and len(resp.json()) == 2
+
+
+def test_raw_responses(client, monkeypatch):
+    workload = client.post("/workloads/", json=workload_dict()).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    mig = create_migration(client, workload, target)
+
+    assert client.get(f"/workloads/{workload['id']}").json() == workload
+    assert client.get(f"/migrations/{mig['id']}").json() == mig
+    assert client.get("/workloads/missing").status_code == 404
+    assert client.get("/migrations/", params={"limit": 1}).json() == [mig]
+    lines = client.get("/migrations/", params={"format": "ndjson"}).text.splitlines()
+    assert [json.loads(line) for line in lines] == [mig]
+
+    monkeypatch.setattr(workloads, "settings", replace(workloads.settings, redact_credentials=True))
+    monkeypatch.setattr(migrations, "settings", replace(migrations.settings, redact_credentials=True))
+    assert client.get(f"/workloads/{workload['id']}").json()["credentials"]["password"] == "***"
+    assert client.get("/workloads/").json()[0]["credentials"]["password"] == "***"
+    assert client.get("/workloads/", params={"ip_prefix": "10."}).json()[0]["credentials"]["password"] == "***"
+    listed = json.loads(client.get("/migrations/", params={"format": "ndjson"}).text)
+    assert listed["source"]["credentials"]["password"] == "***"
+    assert listed["migration_target"]["cloud_credentials"]["password"] == "***"
+
+
+def test_field_projection(client):
+    workload = client.post("/workloads/", json=workload_dict()).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    mig = create_migration(client, workload, target)
+
+    fields = {"fields": "id,state,source.ip,source.storage.name"}
+    expected = {"id": mig["id"], "state": "NOT_STARTED", "source": {"ip": "10.0.0.1", "storage": [{"name": "D:\\"}]}}
+    resp = client.get(f"/migrations/{mig['id']}", params=fields)
+    assert resp.json() == expected
+    # every selection has its own version
+    assert resp.headers["ETag"] != client.get(f"/migrations/{mig['id']}").headers["ETag"]
+    assert client.get(f"/migrations/{mig['id']}", params=fields,
+                      headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+
+    assert client.get("/migrations/", params=fields).json() == [expected]
+    assert client.get("/migrations/", params=fields | {"limit": 1, "format": "ndjson"}).json() == expected
+    assert client.get(f"/workloads/{workload['id']}", params={"fields": "ip"}).json() == {"ip": "10.0.0.1"}
+    assert client.get("/workloads/", params={"ip": "10.0.0.1", "fields": "id"}).json() == [{"id": workload["id"]}]
+    assert client.get("/workloads/", params={"ip_prefix": "10.", "fields": "id"}).json() == [{"id": workload["id"]}]
+    assert client.get("/migration_targets/", params={"fields": "target_vm.ip"}).json() == \
+        [{"target_vm": {"ip": "10.0.1.1"}}]
+
+    assert client.get("/workloads/", params={"fields": "id,"}).status_code == 422
+    assert client.get(f"/migrations/{mig['id']}", params={"fields": "password"}).status_code == 422
+
+
+def test_list_cache(client):
+    source = client.post("/workloads/", json=workload_dict()).json()
+    target = client.post("/migration_targets/", json=migration_target_dict()).json()
+    for _ in range(5):
+        create_migration(client, source, target)
+
+    hits = LIST_CACHE_REQUESTS.value(result="hit")
+    first = client.get("/migrations/", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["Content-Encoding"] == "gzip" and len(first.json()) == 5
+    assert int(first.headers["Content-Length"]) < len(first.content)
+    identity = client.get("/migrations/", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in identity.headers and identity.json() == first.json()
+    assert LIST_CACHE_REQUESTS.value(result="hit") == hits + 1
+    # both representations have their own strong ETag, both are revalidated
+    assert first.headers["ETag"] == identity.headers["ETag"][:-1] + '-gz"'
+    for resp in (first, identity):
+        unchanged = client.get("/migrations/",
+                               headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]})
+        assert unchanged.status_code == 304 and unchanged.headers["ETag"] == resp.headers["ETag"]
+    # every query has its own entry
+    assert len(client.get("/migrations/", params={"limit": 2}).json()) == 2
+    assert LIST_CACHE_REQUESTS.value(result="hit") == hits + 1
+
+    # any write replaces the entry
+    migration = first.json()[0]
+    assert client.put(f"/migrations/{migration['id']}", json=migration | {"state": "ERROR"}).status_code == 200
+    assert {m["state"] for m in client.get("/migrations/").json()} == {"NOT_STARTED", "ERROR"}
+    client.delete(f"/migrations/{migration['id']}")
+    assert len(client.get("/migrations/").json()) == 4
+    assert LIST_CACHE_REQUESTS.value(result="hit") == hits + 1
+
+
+def test_update_conflict(client):
+    workload = client.post("/workloads/", json=workload_dict()).json()
+    assert workload["version"] == 1
+    url = f"/workloads/{workload['id']}"
+
+    resp = client.put(url, json=workload)
+    assert resp.status_code == 200 and resp.json()["version"] == 2
+    # the body still carries version 1
+    assert client.put(url, json=workload).status_code == 409
+
+    resp = client.put("/workloads/bulk", json=[workload])
+    assert resp.json()["results"][0]["status"] == 409
+
+
+def test_metrics(client):
+    workload = client.post("/workloads/", json=workload_dict()).json()
+    client.get(f"/workloads/{workload['id']}")
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    lines = resp.text.splitlines()
+    assert any(line.startswith('cloudshift_http_request_duration_seconds_count{method="GET",'
+                               'route="/workloads/{workload_id}",status="200"}') for line in lines)
+    assert any(line.startswith('cloudshift_storage_written_bytes_total{collection="workloads"}') for line in lines)
+    assert 'cloudshift_migrations{state="NOT_STARTED"} 0' in lines
+    assert "cloudshift_migration_queue_depth 0" in lines
+
+
+def test_profiling(client, monkeypatch):
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setattr(admin, "request_profiler", RequestProfiler(ProfileStore(Path(d), keep=2), token="secret"))
+        workload = client.post("/workloads/", json=workload_dict()).json()
+
+        # only requests of trusted clients are profiled
+        assert "X-Profile-Id" not in client.get(f"/workloads/{workload['id']}").headers
+        assert "X-Profile-Id" not in client.get("/workloads/", headers={"X-Profile-Token": "wrong"}).headers
+        trusted = {"X-Profile-Token": "secret"}
+        ids = [client.get(f"/workloads/{workload['id']}", headers=trusted).headers["X-Profile-Id"] for _ in range(3)]
+
+        assert client.get("/admin/profiles").status_code == 403
+        profiles = client.get("/admin/profiles", headers=trusted).json()
+        # bounded ring: the oldest profile was deleted
+        assert [p["id"] for p in profiles] == ids[:0:-1]
+        assert profiles[0]["route"] == "/workloads/{workload_id}"
+
+        report = client.get(f"/admin/profiles/{ids[-1]}", headers=trusted)
+        assert "get_raw" in report.text
+        raw = client.get(f"/admin/profiles/{ids[-1]}/raw", headers=trusted)
+        assert raw.status_code == 200 and raw.content
+        assert client.get(f"/admin/profiles/{ids[0]}", headers=trusted).status_code == 404
+
+
+def test_profiling_wraps_endpoints_once(client, monkeypatch):
+    # the routes of the app are built again by include_router()
+    for route in app.routes:
+        endpoint = getattr(route, "endpoint", None)
+        if getattr(endpoint, "__profiled__", False):
+            assert not getattr(endpoint.__wrapped__, "__profiled__", False), route.path
+
+    enables = []
+    enable = cProfile.Profile.enable
+
+    class CountingProfile(cProfile.Profile):
+        def enable(self, *args, **kwargs):
+            enables.append(self)
+            return enable(self, *args, **kwargs)
+
+    monkeypatch.setattr(cProfile, "Profile", CountingProfile)
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setattr(admin, "request_profiler", RequestProfiler(ProfileStore(Path(d)), enabled=True))
+        resp = client.get("/workloads/")
+        assert resp.status_code == 200 and "X-Profile-Id" in resp.headers
+        assert len(enables) == 1
+
+        # the body of a streaming response is produced without the profiler, no partial profile is stored
+        resp = client.get("/workloads/", params={"format": "ndjson"})
+        assert resp.status_code == 200 and "X-Profile-Id" not in resp.headers
+        assert len(admin.request_profiler.store.ids()) == 1
+
+
+def test_profiling_concurrent_requests(client, monkeypatch):
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setattr(admin, "request_profiler", RequestProfiler(ProfileStore(Path(d)), enabled=True))
+        workload = client.post("/workloads/", json=workload_dict()).json()
+        get_raw = workloads.workload_repository.get_raw
+
+        def slow_get_raw(*args, **kwargs):
+            time.sleep(0.2)
+            return get_raw(*args, **kwargs)
+
+        monkeypatch.setattr(workloads.workload_repository, "get_raw", slow_get_raw)
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(client.get(f"/workloads/{workload['id']}")))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # one request at a time is profiled, the other one is still served
+        assert [resp.status_code for resp in responses] == [200, 200]
+        assert sorted("X-Profile-Id" in resp.headers for resp in responses) == [False, True]
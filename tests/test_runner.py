@@ -0,0 +1,315 @@
+import asyncio
+import pytest
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from src import (
+    Credentials,
+    MountPoint,
+    MigrationTarget,
+    CloudType,
+    Migration,
+    MigrationRepository,
+    MigrationRunner,
+    MigrationState,
+    BusinessRuleError,
+    CapacityError,
+    FileStorage,
+)
+from src.events import EVENTS
+from src.transfer import DataTransfer
+from tests.test_core import constructor_workload
+
+
+@pytest.fixture
+def migration_repository():
+    with tempfile.TemporaryDirectory() as d:
+        yield MigrationRepository(Path(d))
+
+
+def constructor_migration(migration_repository, extra_mount_point=None, target_id=None):
+    src = constructor_workload(ip="0.0.0.0")
+    if extra_mount_point is not None:
+        src.storage.append(extra_mount_point)
+    migration = Migration(
+        selected_mount_points=[src.storage[-1]],
+        source=src,
+        migration_target=MigrationTarget(
+            cloud_type=CloudType.VCLOUD,
+            cloud_credentials=Credentials("u", "p", "d"),
+            target_vm=constructor_workload(ip="1.1.1.1"),
+        ),
+    )
+    if target_id is not None:
+        migration.migration_target.id = target_id
+    return migration_repository.create(migration)
+
+
+def wait_for_phase(runner, migration_id, phase):
+    deadline = time.monotonic() + 5
+    while runner.phase(migration_id) != phase:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_runner_executes_in_background(migration_repository):
+    runner = MigrationRunner(migration_repository, max_workers=1)
+    migration = constructor_migration(migration_repository)
+
+    assert runner.submit(migration.id).state == MigrationState.RUNNING
+    runner.wait(migration.id, timeout=5)
+
+    assert migration_repository.get(migration.id).state == MigrationState.SUCCESS
+    assert runner.phase(migration.id) is None
+    runner.shutdown()
+
+
+def test_runner_rejects_invalid_migration(migration_repository):
+    runner = MigrationRunner(migration_repository, max_workers=1)
+    migration = constructor_migration(migration_repository, MountPoint("C:\\", 10))
+
+    with pytest.raises(BusinessRuleError):
+        runner.submit(migration.id)
+    assert migration_repository.get(migration.id).state == MigrationState.NOT_STARTED
+    assert runner.phase(migration.id) is None
+    runner.shutdown()
+
+
+def test_runner_survives_failures(migration_repository, monkeypatch):
+    runner = MigrationRunner(migration_repository, max_workers=1)
+    first = constructor_migration(migration_repository)
+    second = constructor_migration(migration_repository)
+
+    update = migration_repository.update
+    failures = []
+
+    def failing_update(migration):
+        if migration.id == first.id and migration.state == MigrationState.SUCCESS and not failures:
+            failures.append(migration.id)
+            raise OSError("No space left on device")
+        return update(migration)
+
+    monkeypatch.setattr(migration_repository, "update", failing_update)
+
+    runner.submit(first.id)
+    runner.wait(first.id, timeout=5)
+    assert failures == [first.id]
+    assert migration_repository.get(first.id).state == MigrationState.ERROR
+
+    # the only worker is still alive
+    runner.submit(second.id)
+    runner.wait(second.id, timeout=5)
+    assert migration_repository.get(second.id).state == MigrationState.SUCCESS
+    runner.shutdown()
+
+
+def test_runner_queue_is_bounded(migration_repository, monkeypatch):
+    release = threading.Event()
+    original_execute = Migration.execute
+
+    def blocking_execute(self, min_to_sleep=1):
+        release.wait(5)
+        original_execute(self, 0)
+
+    monkeypatch.setattr(Migration, "execute", blocking_execute)
+    runner = MigrationRunner(migration_repository, max_workers=1, max_queue=1)
+    first = constructor_migration(migration_repository)
+    second = constructor_migration(migration_repository)
+    third = constructor_migration(migration_repository)
+
+    runner.submit(first.id)
+    wait_for_phase(runner, first.id, MigrationRunner.EXECUTING)
+    runner.submit(second.id)
+    with pytest.raises(CapacityError):
+        runner.submit(third.id)
+    # the same migration cannot be queued twice
+    with pytest.raises(BusinessRuleError):
+        runner.submit(second.id)
+
+    release.set()
+    runner.shutdown()
+    assert migration_repository.get(first.id).state == MigrationState.SUCCESS
+    assert migration_repository.get(second.id).state == MigrationState.SUCCESS
+
+
+def test_runner_recovers_running_migrations(migration_repository):
+    # left RUNNING by a previous process
+    migration = constructor_migration(migration_repository)
+    migration.start()
+    migration_repository.update(migration)
+    done = constructor_migration(migration_repository)
+
+    runner = MigrationRunner(migration_repository, max_workers=1)
+    assert runner.recover() == [migration.id]
+    runner.wait(migration.id, timeout=5)
+    assert migration_repository.get(migration.id).state == MigrationState.SUCCESS
+    assert migration_repository.get(done.id).state == MigrationState.NOT_STARTED
+    assert runner.recover() == []
+    runner.shutdown()
+
+
+def test_runner_shutdown_cancels_pending(migration_repository, monkeypatch):
+    release = threading.Event()
+    original_execute = Migration.execute
+
+    def blocking_execute(self, min_to_sleep=1):
+        release.wait(5)
+        original_execute(self, 0)
+
+    monkeypatch.setattr(Migration, "execute", blocking_execute)
+    runner = MigrationRunner(migration_repository, max_workers=1)
+    first = constructor_migration(migration_repository)
+    second = constructor_migration(migration_repository)
+
+    runner.submit(first.id)
+    wait_for_phase(runner, first.id, MigrationRunner.EXECUTING)
+    runner.submit(second.id)
+
+    threading.Timer(0.05, release.set).start()
+    runner.shutdown(cancel_pending=True)
+    assert migration_repository.get(first.id).state == MigrationState.SUCCESS
+    assert migration_repository.get(second.id).state == MigrationState.NOT_STARTED
+    assert runner.phase(second.id) is None
+
+
+def test_runner_rejects_migrations_after_shutdown(migration_repository, monkeypatch):
+    runner = MigrationRunner(migration_repository, max_workers=1)
+    migration = constructor_migration(migration_repository)
+    # shut down while the migration is started
+    update = migration_repository.update
+
+    def update_then_shutdown(migration):
+        result = update(migration)
+        if migration.state == MigrationState.RUNNING:
+            runner.shutdown()
+        return result
+
+    monkeypatch.setattr(migration_repository, "update", update_then_shutdown)
+    with pytest.raises(CapacityError):
+        runner.submit(migration.id)
+    assert migration_repository.get(migration.id).state == MigrationState.NOT_STARTED
+    assert runner.queue_depth() == 0 and runner.phase(migration.id) is None
+
+    with pytest.raises(CapacityError):
+        runner.submit(migration.id)
+
+    # left RUNNING by a previous process, not queued by a runner which is shut down
+    monkeypatch.setattr(migration_repository, "update", update)
+    migration = migration_repository.get(migration.id)
+    migration.start()
+    migration_repository.update(migration)
+    assert runner.recover() == []
+    assert migration_repository.get(migration.id).state == MigrationState.NOT_STARTED
+
+
+def test_runner_per_target_limit_and_priority(migration_repository, monkeypatch):
+    release = threading.Event()
+    started = []
+    original_execute = Migration.execute
+
+    def blocking_execute(self, min_to_sleep=1):
+        started.append(self.id)
+        release.wait(5)
+        original_execute(self, 0)
+
+    monkeypatch.setattr(Migration, "execute", blocking_execute)
+    runner = MigrationRunner(migration_repository, max_workers=3, max_per_target=1)
+    busy = constructor_migration(migration_repository, target_id="vsphere-1")
+    low = constructor_migration(migration_repository, target_id="vsphere-1")
+    high = constructor_migration(migration_repository, target_id="vsphere-1")
+    other = constructor_migration(migration_repository, target_id="vsphere-2")
+
+    runner.submit(busy.id)
+    wait_for_phase(runner, busy.id, MigrationRunner.EXECUTING)
+    runner.submit(low.id)
+    runner.submit(high.id, priority=10)
+    runner.submit(other.id)
+
+    # Only one migration per target, the other target is not blocked
+    wait_for_phase(runner, other.id, MigrationRunner.EXECUTING)
+    assert runner.running_count() == 2
+    assert runner.queue_position(high.id) == 1
+    assert runner.queue_position(low.id) == 2
+
+    release.set()
+    runner.shutdown()
+    assert started.index(high.id) < started.index(low.id)
+    assert all(migration_repository.get(m.id).state == MigrationState.SUCCESS for m in (busy, low, high, other))
+
+
+def test_runner_transfers_data(migration_repository):
+    with tempfile.TemporaryDirectory() as d:
+        transfer = DataTransfer(Path(d) / "sink", FileStorage(Path(d) / "progress"), bandwidth=100_000,
+                                chunk_size=1000, unit=100, report_interval=0.05, keep_data=True)
+        reports = []
+        write = transfer.progress_storage.write
+        transfer.progress_storage.write = lambda id_obj, doc: reports.append(doc) or write(id_obj, doc)
+        runner = MigrationRunner(migration_repository, max_workers=1, transfer=transfer)
+        migration = constructor_migration(migration_repository)
+
+        start = time.monotonic()
+        runner.submit(migration.id)
+        runner.wait(migration.id, timeout=5)
+        elapsed = time.monotonic() - start
+
+        # 200 units of 100 bytes at 100 kB/s
+        assert elapsed >= 0.19
+        assert (Path(d) / "sink" / migration.id / "0.img").stat().st_size == 20_000
+        assert migration_repository.get(migration.id).state == MigrationState.SUCCESS
+
+        # the progress is written at the report interval, not after every chunk
+        assert 3 <= len(reports) <= elapsed / 0.05 + 3
+        assert [report["bytes_done"] for report in reports] == sorted(report["bytes_done"] for report in reports)
+        running = reports[len(reports) // 2]
+        assert running["state"] == "TRANSFERRING" and 0 < running["bytes_done"] < 20_000
+        assert running["mount_points"][0]["eta_seconds"] > 0
+        assert transfer.progress(migration.id)["state"] == "DONE"
+        assert transfer.progress(migration.id)["mount_points"][0]["bytes_done"] == 20_000
+
+
+def test_transfer_limits_the_data_of_a_migration(migration_repository):
+    with tempfile.TemporaryDirectory() as d:
+        transfer = DataTransfer(Path(d) / "sink", FileStorage(Path(d) / "progress"), unit=100, max_bytes=10_000)
+        runner = MigrationRunner(migration_repository, max_workers=1, transfer=transfer)
+        migration = constructor_migration(migration_repository)
+
+        runner.submit(migration.id)
+        runner.wait(migration.id, timeout=5)
+
+        # 200 units of 100 bytes
+        assert migration_repository.get(migration.id).state == MigrationState.ERROR
+        assert transfer.progress(migration.id)["state"] == "FAILED"
+        assert transfer.progress(migration.id)["bytes_done"] == 0
+        assert not (Path(d) / "sink").exists()
+        runner.shutdown()
+
+
+def test_runner_publishes_events(migration_repository):
+    runner = MigrationRunner(migration_repository, max_workers=1)
+    migration = constructor_migration(migration_repository)
+    other = constructor_migration(migration_repository)
+
+    async def watch():
+        by_filter = EVENTS.subscribe(cloud_type="VCLOUD", state="RUNNING")
+        by_id = EVENTS.subscribe({migration.id})
+        unrelated = EVENTS.subscribe({other.id})
+        await asyncio.get_running_loop().run_in_executor(None, runner.submit, migration.id)
+
+        events = []
+        while not events or events[-1] != ("phase", None):
+            event = await by_id.get(5)
+            events.append((event["type"], event.get("phase", event["state"])))
+        filtered = [(await by_filter.get(5))["type"] for _ in range(3)]
+        for subscription in (by_filter, by_id, unrelated):
+            EVENTS.unsubscribe(subscription)
+        return events, filtered, unrelated._queue.qsize()
+
+    events, filtered, unrelated = asyncio.run(watch())
+    assert events == [("state", "RUNNING"), ("phase", "QUEUED"), ("phase", "EXECUTING"),
+                      ("state", "SUCCESS"), ("phase", None)]
+    # the final SUCCESS state does not match the filter
+    assert filtered == ["state", "phase", "phase"]
+    assert unrelated == 0
+    assert EVENTS.subscriber_count() == 0